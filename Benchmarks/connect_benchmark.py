@@ -0,0 +1,106 @@
+"""Measures how many new connections per second the server accepts.
+
+Every benchmark client connects, sends its hello, waits for the server's reply (public key, options and the encrypted
+AES key) and closes. A connection counts once the server has registered it, that is after its state machine was made.
+
+shared          -> the server as it is. One RSA key made at startup and used by all the connections.
+per-connection  -> the same server generating an RSA-2048 key for every connection, like the state machine used to.
+
+The clients share one RSA key, otherwise generating their keys would be most of what gets measured.
+
+Run it from the Server folder like the server:  python ../Benchmarks/connect_benchmark.py
+"""
+
+
+
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Server"))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Client"))
+
+import ClientEncryption
+import ClientLogger
+import ClientProtocol
+import Encryption
+import ServerLogger
+from Server import Server
+
+ServerLogger.server_logger.setLevel(logging.WARNING) # Logging every connection would be most of what gets measured
+ClientLogger.client_logger.setLevel(logging.WARNING)
+
+CLIENTS = 8 # Clients connecting at the same time
+SECONDS = 5.0
+
+
+class PerConnectionKeygenServer(Server):
+    """The server before the crypto services were shared"""
+
+    def register_connection(self, connection, client_public_key, session=None):
+        Encryption.RsaEncryption()
+        return super().register_connection(connection, client_public_key, session)
+
+
+def connect_once(port, client_rsa):
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        hello = {"version": ClientProtocol.PROTOCOL_VERSION,
+                 "framing": ClientProtocol.SUPPORTED_FRAMING,
+                 "envelope": ClientProtocol.SUPPORTED_ENVELOPES,
+                 "compression": ClientProtocol.SUPPORTED_COMPRESSION,
+                 "public_key": client_rsa.getPublicKey().decode('utf-8')}
+        ClientProtocol.send_handshake(s, hello)
+        if ClientProtocol.recv_exact(s, len(ClientProtocol.HANDSHAKE_MAGIC)) != ClientProtocol.HANDSHAKE_MAGIC:
+            raise ConnectionError("Unexpected handshake reply")
+        reply = ClientProtocol.recv_handshake_body(s)
+        client_rsa.decrypt(reply["aes_key"])
+
+
+def connections_per_second(server_class, port, client_rsa):
+    server = server_class("127.0.0.1", port)
+    server.start_listen_thread()
+    time.sleep(0.3)
+
+    stop = threading.Event()
+
+    def client_loop():
+        while not stop.is_set():
+            try:
+                connect_once(port, client_rsa)
+            except OSError:
+                pass
+
+    clients = [threading.Thread(target=client_loop, daemon=True) for _ in range(CLIENTS)]
+    start = time.perf_counter()
+    completed_at_start = server.handshake_stats["completed"]
+    for client in clients:
+        client.start()
+    time.sleep(SECONDS)
+    completed = server.handshake_stats["completed"] - completed_at_start
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for client in clients:
+        client.join()
+    server.quit_server()
+    return completed / elapsed
+
+
+def main():
+    client_rsa = ClientEncryption.RsaEncryption()
+    print(f"{CLIENTS} clients connecting for {SECONDS:.0f} seconds")
+    print(f"{'server':<16}{'connections/s':>16}")
+    results = {}
+    for name, server_class, port in (("per-connection", PerConnectionKeygenServer, 8091),
+                                     ("shared", Server, 8092)):
+        results[name] = connections_per_second(server_class, port, client_rsa)
+        print(f"{name:<16}{results[name]:>16.1f}")
+    if results["per-connection"]:
+        print(f"{'shared/per-connection':<22}{results['shared'] / results['per-connection']:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
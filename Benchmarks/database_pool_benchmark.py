@@ -0,0 +1,94 @@
+"""Measures the Database calls a logged in client makes, with a new SQLite connection per call against the pool.
+
+per call  -> Database.connect as it was, sqlite3.connect for every call and close after it.
+pool      -> Database.connect now, the thread's connection from ConnectionPool.
+
+THREADS threads (like the dispatcher's workers) run each call in a loop for SECONDS seconds on a copy of
+task_manager.db with TASKS extra tasks. The copy is deleted afterwards.
+
+Run it from the Server folder like the server:  python ../Benchmarks/database_pool_benchmark.py
+"""
+
+
+
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Server"))
+
+import ConnectionPool
+import Database
+import ServerLogger
+
+ServerLogger.server_logger.setLevel(logging.WARNING)
+
+THREADS = 8
+SECONDS = 2.0
+TASKS = 1000
+
+
+class PerCallDatabase(Database.Database):
+    def connect(self):
+        return sqlite3.connect(self.manager_db)
+
+
+def make_db(directory):
+    db_file = os.path.join(directory, "task_manager.db")
+    shutil.copy(os.path.join(BENCHMARK_DIR, "..", "Server", "task_manager.db"), db_file)
+    db = Database.Database(db_file)
+    db.create_table_task_version()
+    db.create_table_task_changes()
+    for number in range(TASKS):
+        db.insert_task(f"Task number {number}", "2030-01-01", 1, "john" if number % 2 else "admin", "admin")
+    return db_file
+
+
+def calls(db):
+    return {"get_userID_fromDB": lambda: db.get_userID_fromDB("john"),
+            "task_version": db.task_version,
+            "show_tasks (user)": lambda: db.show_tasks("john"),
+            "update_task": lambda: db.update_task(5, "Updated", "2030-01-01", 1, "john", "admin")}
+
+
+def measure(call):
+    counts = [0] * THREADS
+    deadline = time.perf_counter() + SECONDS
+
+    def run(index):
+        while time.perf_counter() < deadline:
+            call()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / SECONDS
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        db_file = make_db(directory)
+        print(f"{THREADS} threads, {TASKS} extra tasks")
+        print(f"{'call':<20}{'per call /s':>14}{'pool /s':>14}{'speedup':>10}")
+        per_call, pooled = calls(PerCallDatabase(db_file)), calls(Database.Database(db_file))
+        for name in per_call:
+            before = measure(per_call[name])
+            after = measure(pooled[name])
+            print(f"{name:<20}{before:>14.0f}{after:>14.0f}{after / before:>9.1f}x")
+        print(f"pool: {ConnectionPool.get_pool(db_file).stats()}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compares the message envelopes of the ConnectionHandler.
+
+json   -> the original format. AES output hexlified and wrapped in a second json message.
+binary -> nonce | tag | ciphertext as raw bytes.
+zlib   -> the binary envelope with compression over the default threshold.
+
+All of them are measured in binary frames, legacy frames cannot carry more than 9999 bytes.
+
+For a few typical messages it prints the bytes each message takes on the wire and how many messages per second go through
+pushMessage + getMessage (json, AES and the envelope, no network).
+
+Run it from the Server folder like the server:  python ../Benchmarks/envelope_benchmark.py
+"""
+
+
+
+import logging
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+
+import Encryption
+import Protocol
+import ServerLogger
+from ServerLib import ConnectionHandler
+
+ServerLogger.server_logger.setLevel(logging.WARNING) # Logging every message would be most of what gets measured
+
+
+def make_tasks(count):
+    return [{"TaskID": str(i),
+             "Description": f"Task number {i} with a short description",
+             "due_date": "2025-03-01",
+             "active": "1",
+             "assigned_to": "john"} for i in range(count)]
+
+
+MESSAGES = {
+    "login reply": {"action": "Login", "message": "Provide Access"},
+    "view tasks (10)": {"action": "View Tasks", "message": make_tasks(10)},
+    "view tasks (100)": {"action": "View Tasks", "message": make_tasks(100)},
+    "view tasks (1000)": {"action": "View Tasks", "message": make_tasks(1000)},
+}
+
+ENVELOPES = {
+    "json": {"framing": Protocol.FRAMING_BINARY, "envelope": Protocol.ENVELOPE_JSON},
+    "binary": {"framing": Protocol.FRAMING_BINARY, "envelope": Protocol.ENVELOPE_BINARY},
+    "zlib": {"framing": Protocol.FRAMING_BINARY, "envelope": Protocol.ENVELOPE_BINARY,
+             "compression": Protocol.COMPRESSION_ZLIB, "compression_threshold": Protocol.COMPRESSION_THRESHOLD},
+}
+
+
+def make_connection(options):
+    # The socket is never used, the benchmark only goes through the buffers
+    left, right = socket.socketpair()
+    return ConnectionHandler(left, "benchmark", aes_encryption=Encryption.AESencryption(), options=dict(options))
+
+
+def wire_size(connection, message):
+    """Returns the size of the frame and what the read thread would put in the iBuffer for it"""
+    connection.pushMessage(message)
+    frame = connection.oBuffer.get()
+    header = Protocol.header_length(connection.framing)
+    flags, length = Protocol.decode_header(frame[:header], connection.framing)
+    return len(frame), (frame[header:], flags)
+
+
+def messages_per_second(connection, message, received, seconds=1.0):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        connection.pushMessage(message)
+        connection.oBuffer.get()
+        connection.iBuffer.put(received)
+        connection.getMessage()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    print(f"{'message':<20}{'envelope':<12}{'bytes':>10}{'msg/s':>12}")
+    for name, message in MESSAGES.items():
+        results = {}
+        for envelope, options in ENVELOPES.items():
+            connection = make_connection(options)
+            size, received = wire_size(connection, message)
+            rate = messages_per_second(connection, message, received)
+            results[envelope] = (size, rate)
+            print(f"{name:<20}{envelope:<12}{size:>10}{rate:>12.0f}")
+        json_size, json_rate = results["json"]
+        for envelope in ("binary", "zlib"):
+            size, rate = results[envelope]
+            print(f"{'':<20}{envelope + '/json':<12}{size / json_size:>10.2f}{rate / json_rate:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
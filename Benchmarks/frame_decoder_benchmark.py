@@ -0,0 +1,112 @@
+"""Measures how fast the read loop turns received bytes into frames.
+
+A thread writes binary frames into one end of a socketpair as fast as it can, the other end is read until all of them
+have been decoded. Nothing is encrypted, only the receiving and the framing are measured.
+
+recv 1024       -> the read loop before the FrameDecoder. recv(1024), append to a bytearray and delete every header
+                   and payload from its front.
+FrameDecoder    -> Protocol.FrameDecoder. recv_into one buffer with an adaptive receive size.
+
+Run it from the Server folder like the server:  python ../Benchmarks/frame_decoder_benchmark.py
+"""
+
+
+
+import os
+import socket
+import sys
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Server"))
+
+import Protocol
+
+TOTAL_BYTES = 64 * 1024 * 1024 # Payload bytes sent for every message size
+MESSAGE_SIZES = (100, 2 * 1024, 64 * 1024, 1024 * 1024)
+
+
+def old_read_loop(sock, frames_expected):
+    """The read loop of ConnectionHandler before the FrameDecoder"""
+    network_buffer = bytearray()
+    in_progress = False
+    remaining = 0
+    frames = 0
+    header_length = Protocol.FRAME_HEADER_LENGTH
+    while frames < frames_expected:
+        data = sock.recv(1024)
+        if not data:
+            break
+        network_buffer += data
+        while len(network_buffer) > 0:
+            if not in_progress:
+                if len(network_buffer) >= header_length:
+                    _, remaining = Protocol.decode_header(network_buffer[:header_length], Protocol.FRAMING_BINARY)
+                    del network_buffer[:header_length]
+                    in_progress = True
+                else:
+                    break
+            if len(network_buffer) >= remaining:
+                bytes(network_buffer[:remaining])
+                del network_buffer[:remaining]
+                in_progress = False
+                frames += 1
+            else:
+                break
+    return frames
+
+
+def decoder_read_loop(sock, frames_expected):
+    decoder = Protocol.FrameDecoder(Protocol.FRAMING_BINARY)
+    frames = 0
+    while frames < frames_expected:
+        if not decoder.recv_from(sock):
+            break
+        for _ in decoder.frames():
+            frames += 1
+    return frames
+
+
+def measure(read_loop, message_size):
+    count = max(TOTAL_BYTES // message_size, 1)
+    frame = Protocol.encode_frame(os.urandom(message_size), Protocol.FRAMING_BINARY)
+    reader, writer = socket.socketpair()
+
+    def write_frames():
+        # Many frames per sendall, like the write thread's batches
+        batch = frame * max(1, 256 * 1024 // len(frame))
+        frames_per_batch = len(batch) // len(frame)
+        sent = 0
+        while sent + frames_per_batch <= count:
+            writer.sendall(batch)
+            sent += frames_per_batch
+        writer.sendall(frame * (count - sent))
+
+    thread = threading.Thread(target=write_frames, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    decoded = read_loop(reader, count)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    reader.close()
+    writer.close()
+    if decoded != count:
+        raise RuntimeError(f"Decoded {decoded} of {count} frames")
+    return count * message_size / elapsed / (1024 * 1024), count / elapsed
+
+
+def main():
+    print(f"{TOTAL_BYTES // (1024 * 1024)} MB of payload for every message size")
+    print(f"{'message bytes':<15}{'read loop':<15}{'MB/s':>10}{'frames/s':>14}")
+    for message_size in MESSAGE_SIZES:
+        results = {}
+        for name, read_loop in (("recv 1024", old_read_loop), ("FrameDecoder", decoder_read_loop)):
+            results[name] = measure(read_loop, message_size)
+            mb_per_second, frames_per_second = results[name]
+            print(f"{message_size:<15}{name:<15}{mb_per_second:>10.1f}{frames_per_second:>14.0f}")
+        print(f"{'':<15}{'speedup':<15}{results['FrameDecoder'][0] / results['recv 1024'][0]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compares the handshake latency of the 2 key exchanges.
+
+rsa     -> the client sends its RSA public key, the server imports it and sends back the AES key wrapped with PKCS1_OAEP.
+x25519  -> both ends make an ephemeral X25519 key and derive the AES key from the shared secret with HKDF.
+
+A handshake is measured from connecting until the client has the AES key, one after another against a server running in
+this process. The rsa client reuses one RSA key like the real client does, the time to generate it is printed apart
+because every client start pays it once. The x25519 client makes its key inside every handshake.
+
+Run it from the Server folder like the server:  python ../Benchmarks/handshake_benchmark.py
+"""
+
+
+
+import logging
+import os
+import socket
+import statistics
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Server"))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Client"))
+
+import ClientEncryption
+import ClientLogger
+import ClientProtocol
+import ServerLogger
+from Server import Server
+
+ServerLogger.server_logger.setLevel(logging.WARNING) # Logging every connection would be most of what gets measured
+ClientLogger.client_logger.setLevel(logging.WARNING)
+
+HANDSHAKES = 200
+PORT = 8093
+
+
+def handshake(key_exchange, client_rsa):
+    """One handshake like Client.connect_to_server does it. Returns the AES key"""
+    with socket.create_connection(("127.0.0.1", PORT)) as s:
+        hello = {"version": ClientProtocol.PROTOCOL_VERSION,
+                 "framing": ClientProtocol.SUPPORTED_FRAMING,
+                 "envelope": ClientProtocol.SUPPORTED_ENVELOPES,
+                 "compression": ClientProtocol.SUPPORTED_COMPRESSION,
+                 "key_exchange": [key_exchange]}
+        if key_exchange == ClientProtocol.KEY_EXCHANGE_X25519:
+            ecdh = ClientEncryption.X25519KeyExchange()
+            hello["ecdh_public_key"] = ecdh.getPublicKey()
+        else:
+            hello["public_key"] = client_rsa.getPublicKey().decode('utf-8')
+        ClientProtocol.send_handshake(s, hello)
+        if ClientProtocol.recv_exact(s, len(ClientProtocol.HANDSHAKE_MAGIC)) != ClientProtocol.HANDSHAKE_MAGIC:
+            raise ConnectionError("Unexpected handshake reply")
+        reply = ClientProtocol.recv_handshake_body(s)
+        if reply["key_exchange"] != key_exchange:
+            raise ConnectionError(f"Server picked {reply['key_exchange']} instead of {key_exchange}")
+        if key_exchange == ClientProtocol.KEY_EXCHANGE_X25519:
+            return ecdh.derive_key(reply["ecdh_public_key"], hello["ecdh_public_key"], reply["ecdh_public_key"])
+        return client_rsa.decrypt(reply["aes_key"])
+
+
+def measure(key_exchange, client_rsa):
+    handshake(key_exchange, client_rsa) # Warm up
+    timings = []
+    for _ in range(HANDSHAKES):
+        start = time.perf_counter()
+        handshake(key_exchange, client_rsa)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    start = time.perf_counter()
+    client_rsa = ClientEncryption.RsaEncryption()
+    keygen = (time.perf_counter() - start) * 1000
+
+    server = Server("127.0.0.1", PORT)
+    server.start_listen_thread()
+    time.sleep(0.3)
+    try:
+        print(f"{HANDSHAKES} handshakes each, RSA-2048 client key generation took {keygen:.1f} ms")
+        # first connection -> what a client that just started waits for, the rsa client generates its key first
+        print(f"{'key exchange':<14}{'median ms':>12}{'p95 ms':>12}{'first connection ms':>22}")
+        results = {}
+        for key_exchange in (ClientProtocol.KEY_EXCHANGE_RSA, ClientProtocol.KEY_EXCHANGE_X25519):
+            median, p95 = measure(key_exchange, client_rsa)
+            first = median + (keygen if key_exchange == ClientProtocol.KEY_EXCHANGE_RSA else 0)
+            results[key_exchange] = (median, first)
+            print(f"{key_exchange:<14}{median:>12.2f}{p95:>12.2f}{first:>22.1f}")
+        rsa_median, rsa_first = results[ClientProtocol.KEY_EXCHANGE_RSA]
+        x25519_median, x25519_first = results[ClientProtocol.KEY_EXCHANGE_X25519]
+        print(f"{'rsa/x25519':<14}{rsa_median / x25519_median:>12.2f}{'':>12}{rsa_first / x25519_first:>22.1f}")
+    finally:
+        server.quit_server()
+
+
+if __name__ == "__main__":
+    main()
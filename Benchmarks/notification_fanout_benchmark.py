@@ -0,0 +1,115 @@
+"""Measures sending one task notification to many clients, and how long a login waits for the registry meanwhile.
+
+The connections are ConnectionHandlers over socketpairs with their threads not started, so only the work of the fan-out
+is measured: json, compression, AES and queueing the frame in the oBuffer.
+
+locked loop     -> Server.notify_clients before the copy on write registry. It holds the server lock for the whole loop
+                   and every connection serializes the message again (pushMessage).
+registry        -> Server.notify_clients now. No lock, the message is serialized once (pushSerialized).
+
+While the fan-out runs another thread keeps registering connections (a dict copy under the lock, like
+register_connection) and records the longest it waited for the lock.
+
+Run it from the Server folder like the server:  python ../Benchmarks/notification_fanout_benchmark.py
+"""
+
+
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "Server"))
+
+import Encryption
+import Protocol
+import ServerLib
+import ServerLogger
+
+CLIENTS = (100, 1000, 3000)
+CHANGES = 20 # Changed tasks in the notification
+
+
+def make_connections(count):
+    ServerLogger.server_logger.setLevel(logging.WARNING) # pushMessage logs every frame at INFO
+    options = Protocol.negotiate({"framing": Protocol.SUPPORTED_FRAMING, "envelope": Protocol.SUPPORTED_ENVELOPES,
+                                  "compression": Protocol.SUPPORTED_COMPRESSION})
+    connections, sockets = [], []
+    for _ in range(count):
+        server_end, client_end = socket.socketpair()
+        sockets += [server_end, client_end]
+        connection = ServerLib.ConnectionHandler(server_end, "benchmark", aes_encryption=Encryption.AESencryption(),
+                                                 options=options)
+        connection.oBuffer.max_messages = 10 ** 6
+        connection.oBuffer.max_bytes = 2 ** 40
+        connections.append(connection)
+    return connections, sockets
+
+
+def notification():
+    return {"action": "notification",
+            "message": "A task has been created or modified",
+            "changes": [{"version": version,
+                         "task": {"TaskID": str(version), "Description": f"Task number {version}", "due_date": "2030-01-01",
+                                  "active": "1", "assigned_to": "john", "created_by": "admin"}}
+                        for version in range(CHANGES)]}
+
+
+def locked_loop(lock, connections, message):
+    with lock:
+        for connection in connections:
+            connection.pushMessage(message, ServerLib.FRAME_NOTIFICATION)
+
+
+def registry(lock, connections, message):
+    data = json.dumps(message).encode('utf-8')
+    for connection in connections:
+        connection.pushSerialized(data, ServerLib.FRAME_NOTIFICATION)
+
+
+def measure(fan_out, connections):
+    lock = threading.Lock()
+    registered = {}
+    waits = []
+    done = threading.Event()
+
+    def register():
+        while not done.is_set():
+            start = time.perf_counter()
+            with lock:
+                waits.append(time.perf_counter() - start)
+                registered.update({len(registered): None}) # Stands for the copy of register_connection
+            time.sleep(0.0005)
+
+    thread = threading.Thread(target=register)
+    thread.start()
+    time.sleep(0.01)
+    start = time.perf_counter()
+    fan_out(lock, connections, notification())
+    elapsed = time.perf_counter() - start
+    done.set()
+    thread.join()
+    for connection in connections:
+        connection.oBuffer.clear()
+    return elapsed, max(waits)
+
+
+def main():
+    print(f"One notification with {CHANGES} changed tasks, binary envelope with zlib")
+    print(f"{'clients':<10}{'fan-out':<15}{'ms':>10}{'us/client':>12}{'max login wait ms':>20}")
+    for count in CLIENTS:
+        connections, sockets = make_connections(count)
+        for name, fan_out in (("locked loop", locked_loop), ("registry", registry)):
+            elapsed, wait = measure(fan_out, connections)
+            print(f"{count:<10}{name:<15}{elapsed * 1000:>10.1f}{elapsed / count * 1e6:>12.1f}{wait * 1000:>20.2f}")
+        for sock in sockets:
+            sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,14 @@
 it establishes a connection and then exchanges RSA keys. Then the server sends the AES key encrypted,
 Then the communication between the server and the client is enctypted with AES. In addition, it initialiazes
 a connectionhandler in clientLib and a gui in GUI and passes incoming messages to the client state machine."""
+import argparse
+import os
 import socket
 import threading
+import time
 import ClientLogger
 import ClientEncryption
+import ClientProtocol
 from ClientLib import ConnectionHandler
 import GUI
 from ClientStateMachine import ClientStateMachine
@@ -13,16 +17,24 @@ import json
 
 
 class Client:
-    def __init__(self, ADDRESS, PORT):
+    def __init__(self, ADDRESS, PORT, key_exchange=ClientProtocol.KEY_EXCHANGE_X25519):
         self.ADDRESS = ADDRESS
         self.PORT = PORT
         self.logger = ClientLogger.client_logger
         self.lock = threading.Lock()
-        self.RsaEncryption = ClientEncryption.RsaEncryption()
+        # x25519 makes a small key for every handshake, the RSA key is only generated (slowly) for the rsa key exchange
+        self.key_exchange = key_exchange
+        self.RsaEncryption = ClientEncryption.RsaEncryption() if key_exchange == ClientProtocol.KEY_EXCHANGE_RSA else None
         self.running = True
         self.connection_handler = None
         self.state_machine = None
         self.server_socket = None
+        self.server_public_key = None
+        self.aes_key = None
+
+        # The session ticket the server gave after the login and the AES key it goes with. If the connection drops,
+        # the client reconnects with it and skips the RSA handshake and the login.
+        self.session = None
 
 
         self.gui = GUI.ClientUI(self)
@@ -51,64 +63,76 @@ class Client:
 
             # Key exchange
             try:
-                #RSA KEY EXHCHANGE PROTOCOL
-
-
-                #Send the public key with length and header
-                client_public_key = self.RsaEncryption.getPublicKey()
-                key_length = len(client_public_key)
-                length_header = str(key_length).zfill(4).encode('utf-8')
-
-                server_socket.sendall(length_header)
-                server_socket.sendall(client_public_key)
-                self.logger.debug("Sent client public key")
-
-                # Receive server's public key
-                length_data = server_socket.recv(4)
-                if not length_data:
-                    raise ConnectionError("No key length received from server")
-
-                key_length = int(length_data.decode('utf-8'))
-
-                server_public_key = b""
-                while len(server_public_key) < key_length:
-                    remaining = key_length - len(server_public_key)
-                    chunk = server_socket.recv(min(remaining, 2048))
-                    if not chunk:
-                        raise ConnectionError("Connection closed while receiving key")
-                    server_public_key += chunk
-
-                #AES key receive protocol
-
-
-                #Receive the key length of the data first
-                length = server_socket.recv(4)
-                if not length:
-                    raise ConnectionError("Connection closed while receiving key")
-
-                aes_key_length = int(length.decode('utf-8'))
-                self.logger.debug(f"AES key length: {aes_key_length}")
-                encrypted_aes_key = b""
-
-                # Receive the aes key and check if all of it arrived
-                while len(encrypted_aes_key) < aes_key_length:
-                    remaining = aes_key_length - len(encrypted_aes_key)
-                    chunk1 = server_socket.recv(min(remaining, 2048))
-                    if not chunk1:
-                        raise ConnectionError("Connection closed while receiving AES key")
-                    encrypted_aes_key += chunk1
-
-                #Decrypt the key using RSA
-                encrypted_key_string = encrypted_aes_key.decode('utf-8')
-                decrypted_aes_key = self.RsaEncryption.decrypt(encrypted_key_string)
-
-
-                self.connection = ConnectionHandler(server_socket, self.ADDRESS, server_public_key, self.RsaEncryption, decrypted_aes_key)
+                #HANDSHAKE PROTOCOL
+
+                # Send a hello with the public key and the protocol options the client supports.
+                # The server answers with its public key, the options it picked and either the AES key encrypted with our
+                # RSA public key or its own X25519 public key to derive the AES key with.
+                hello = {"version": ClientProtocol.PROTOCOL_VERSION,
+                         "framing": ClientProtocol.SUPPORTED_FRAMING,
+                         "envelope": ClientProtocol.SUPPORTED_ENVELOPES,
+                         "compression": ClientProtocol.SUPPORTED_COMPRESSION,
+                         "session_tickets": True,
+                         "key_exchange": [self.key_exchange]}
+                if self.key_exchange == ClientProtocol.KEY_EXCHANGE_X25519:
+                    ecdh = ClientEncryption.X25519KeyExchange()
+                    hello["ecdh_public_key"] = ecdh.getPublicKey()
+                else:
+                    hello["public_key"] = self.RsaEncryption.getPublicKey().decode('utf-8')
+                session = self.session
+                if session:
+                    # The keys stay in the hello, the server falls back to the full handshake if the ticket expired
+                    resume_nonce = os.urandom(16)
+                    hello["resume"] = session["ticket"]
+                    hello["resume_nonce"] = resume_nonce.hex()
+                ClientProtocol.send_handshake(server_socket, hello)
+                self.logger.debug("Sent client hello")
+
+                magic = ClientProtocol.recv_exact(server_socket, len(ClientProtocol.HANDSHAKE_MAGIC))
+                if magic != ClientProtocol.HANDSHAKE_MAGIC:
+                    raise ConnectionError("Server does not support the handshake protocol. Update the server first")
+                reply = ClientProtocol.recv_handshake_body(server_socket)
+                if "error" in reply:
+                    raise ConnectionError(f"Server refused the handshake: {reply['error']}")
+                options = dict(ClientProtocol.LEGACY_OPTIONS)
+                options.update((name, value) for name, value in reply.items() if name not in ("public_key", "aes_key", "ecdh_public_key", "session"))
+                self.logger.debug(f"Server hello received, options: {options}")
+
+                resumed = reply.get("session")
+                if resumed:
+                    # Session resumed, the AES key is derived from the previous one
+                    decrypted_aes_key = ClientEncryption.derive_session_key(session["key"], resume_nonce,
+                                                                            bytes.fromhex(resumed["server_nonce"]))
+                    self.session = {"ticket": resumed["ticket"], "key": decrypted_aes_key}
+                    server_public_key = self.server_public_key
+                else:
+                    if reply.get("key_exchange") == ClientProtocol.KEY_EXCHANGE_X25519:
+                        decrypted_aes_key = ecdh.derive_key(reply["ecdh_public_key"], hello["ecdh_public_key"], reply["ecdh_public_key"])
+                    else:
+                        #Decrypt the key using RSA
+                        decrypted_aes_key = self.RsaEncryption.decrypt(reply["aes_key"])
+                    server_public_key = reply["public_key"].encode('utf-8')
+                    self.session = None
+                self.aes_key = decrypted_aes_key
+                self.server_public_key = server_public_key
+
+
+                self.connection = ConnectionHandler(server_socket, self.ADDRESS, server_public_key, self.RsaEncryption, decrypted_aes_key,
+                                                    options=options)
+                previous = self.state_machine
                 self.state_machine = ClientStateMachine(self.connection, server_public_key, self,self.gui)
+                if resumed:
+                    self.state_machine.resume(resumed["username"], resumed["state"])
                 self.connection.set_state_machine(self.state_machine)
+                self.connection.on_disconnect = self.connection_lost
                 # Set up message handling and start the connection
                 self.connection.on_message_ready = lambda conn=self.connection: self.process_message(conn)
                 self.connection.start()
+                if resumed and previous is not None:
+                    # Changes the old connection sent and never got a response to, maybe the server did them
+                    self.state_machine.resend_changes(previous.unanswered_changes())
+                    # And the task changes it missed while it was away
+                    self.state_machine.continue_tasks(previous)
 
             except Exception as e:
                 self.logger.error(f"Key exchange error: {e}")
@@ -119,6 +143,28 @@ class Client:
             self.logger.error(f"Connection error: {e}")
             return
 
+    def store_session_ticket(self, ticket):
+        self.session = {"ticket": ticket["ticket"], "key": self.aes_key}
+
+    def connection_lost(self):
+        """The server went away. A logged in client reconnects and resumes its session with the ticket"""
+        if not self.running or not self.session:
+            return
+        threading.Thread(target=self.reconnect, daemon=True).start()
+
+    def reconnect(self, attempts=5):
+        delay = 0.5
+        for attempt in range(attempts):
+            time.sleep(delay)
+            if not self.running:
+                return
+            self.logger.info(f"Reconnecting to the server (attempt {attempt + 1})")
+            self.connect_to_server()
+            if self.connection and self.connection.running:
+                return
+            delay *= 2
+        self.logger.error("Could not reconnect to the server")
+
     def process_message(self, connection):
         try:
             message = connection.getMessage()
@@ -173,5 +219,10 @@ class Client:
 
 
 if __name__ == "__main__":
-    client = Client(ADDRESS="127.0.0.1", PORT=8080)
+    parser = argparse.ArgumentParser(description="Task manager client")
+    parser.add_argument("--key-exchange", choices=ClientProtocol.SUPPORTED_KEY_EXCHANGE, default=ClientProtocol.KEY_EXCHANGE_X25519,
+                        help="x25519: ephemeral elliptic curve key agreement. rsa: the server sends the AES key encrypted with RSA")
+    args = parser.parse_args()
+
+    client = Client(ADDRESS="127.0.0.1", PORT=8080, key_exchange=args.key_exchange)
     client.start()
\ No newline at end of file
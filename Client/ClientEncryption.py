@@ -26,6 +26,10 @@ from Crypto.Cipher import PKCS1_OAEP
 import hashlib
 import ClientLogger
 from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Protocol.DH import key_agreement
+from Crypto.PublicKey import ECC
 import os
 
 
@@ -118,6 +122,30 @@ class RsaEncryption:
             raise
 
 
+class X25519KeyExchange:
+    """Same as the server's, one side of an ephemeral X25519 key agreement"""
+
+    def __init__(self):
+        self.private_key = ECC.generate(curve="curve25519")
+
+    def getPublicKey(self):
+        return self.private_key.public_key().export_key(format="PEM")
+
+    def derive_key(self, peer_public_key, client_public_key, server_public_key):
+        """The AES key. Both public keys go into the salt, so the key is bound to this handshake"""
+        salt = (client_public_key + server_public_key).encode("utf-8")
+        kdf = lambda secret: HKDF(secret, 32, salt, SHA256, context=b"task manager x25519")
+        peer_key = ECC.import_key(peer_public_key)
+        if peer_key.curve != "Curve25519" or peer_key.has_private():
+            raise ValueError("Received key is not an X25519 public key")
+        return key_agreement(static_priv=self.private_key, static_pub=peer_key, kdf=kdf)
+
+
+def derive_session_key(previous_key, client_nonce, server_nonce):
+    """Same as the server's, the AES key of a resumed session"""
+    return HKDF(previous_key, 32, client_nonce + server_nonce, SHA256, context=b"task manager session resume")
+
+
 class AESencryption:
     def __init__(self):
         self.logger = ClientLogger.client_logger
@@ -139,6 +167,29 @@ class AESencryption:
         self.logger.debug(f"Text decrypted AES")
         return text.decode('utf-8')
 
+    # Binary envelope: nonce | tag | ciphertext as raw bytes. Used when both ends negotiate it in the handshake,
+    # instead of putting the 3 parts hexlified into a json message (which more than doubles every message).
+    NONCE_LENGTH = 12
+    TAG_LENGTH = 16
+
+    def encrypt_envelope(self, text):
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+
+        aesCipher = AES.new(self.key, AES.MODE_GCM, nonce=os.urandom(self.NONCE_LENGTH))
+        ciphertext, authTag = aesCipher.encrypt_and_digest(text)
+        return aesCipher.nonce + authTag + ciphertext
+
+    def decrypt_envelope(self, envelope):
+        if len(envelope) < self.NONCE_LENGTH + self.TAG_LENGTH:
+            raise ValueError("Envelope too short")
+        envelope = memoryview(envelope)
+        nonce = envelope[:self.NONCE_LENGTH]
+        authTag = envelope[self.NONCE_LENGTH:self.NONCE_LENGTH + self.TAG_LENGTH]
+        aesCipher = AES.new(self.key, AES.MODE_GCM, nonce=bytes(nonce))
+        # Returns bytes, the message may still be compressed
+        return aesCipher.decrypt_and_verify(envelope[self.NONCE_LENGTH + self.TAG_LENGTH:], bytes(authTag))
+
     def get_key(self):
         return self.key
 
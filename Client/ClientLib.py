@@ -30,14 +30,14 @@ import threading
 import queue
 import socket
 import json
-import time
-import errno
 import ClientEncryption
+import ClientProtocol
 import binascii
 
 # Same class as the server's ConnectionHandler. The client will have a read and write threads too to allow seamless communication with minimal delay.
 class ConnectionHandler:
-    def __init__(self, server_socket, server_address, server_public_key=None, RsaEncryption=None, aes_key=None):
+    def __init__(self, server_socket, server_address, server_public_key=None, RsaEncryption=None, aes_key=None,
+                 options=None):
         self.socket = server_socket
         self.address = server_address
         self.server_public_key = server_public_key
@@ -47,17 +47,20 @@ class ConnectionHandler:
         self.iBuffer = queue.Queue()
         self.oBuffer = queue.Queue()
 
-        self.packetHeaderLength = 4
-        self.networkBuffer = ""
-        self.messageBuffer = ""
-        self.messageInProgress = False
-        self.messageBytesRemaining = 0
+        # Negotiated in the handshake
+        self.options = options or dict(ClientProtocol.LEGACY_OPTIONS)
+        self.framing = self.options["framing"]
+        self.envelope = self.options["envelope"]
+        self.compressionStats = ClientProtocol.CompressionStats()
+        self.packetHeaderLength = ClientProtocol.header_length(self.framing)
+        self.decoder = ClientProtocol.FrameDecoder(self.framing) # Cuts what the read thread receives into frames
 
         self.running = True
         self.writing = True
         self.reading = True
 
         self.on_message_ready = lambda: None
+        self.on_disconnect = lambda: None # Called when the server goes away, not when the client stops the connection
 
         self.readThread = threading.Thread(target=self.read, daemon=True)
         self.writeThread = threading.Thread(target=self.write, daemon=True)
@@ -78,25 +81,20 @@ class ConnectionHandler:
     def write(self):
         try:
             while self.writing:
-                if not self.running and self.oBuffer.empty():
+                # Blocks until there is something to send instead of checking the buffer every 100 ms.
+                # None is put in the buffer by stop_threads_on_exit to wake the thread up.
+                message = self.oBuffer.get()
+                if message is None:
                     self.writing = False
-                    self.logger.error("Write thread stopped")
-                if not self.oBuffer.empty():
-                    try:
-                        with self.lock:
-                            message = self.oBuffer.get()
-
-                            # Determine if the message is bytes or string
-                            if isinstance(message, str):
-                                message = message.encode("utf-8")
-
-                            messageLength = str(len(message)).zfill(self.packetHeaderLength).encode("utf-8")
-                            self.socket.sendall(messageLength + message)
+                    break
+                try:
+                    with self.lock:
+                        # The frame was built by pushMessage
+                        self.socket.sendall(message)
 
-                    except Exception as e:
-                        self.logger.error(f"Write error: {str(e)}")
-                        self.writing = False
-                time.sleep(0.1) # Added this to prevent cpu spinning (continously checking for a message in the obuffer)
+                except Exception as e:
+                    self.logger.error(f"Write error: {str(e)}")
+                    self.writing = False
 
         except Exception as e:
             self.logger.error(f"Write thread error: {str(e)}")
@@ -106,69 +104,47 @@ class ConnectionHandler:
     def read(self):
         try:
             with self.socket:
-                self.socket.setblocking(False)
+                self.socket.settimeout(None) # Blocking reads, stop_threads_on_exit wakes recv by shutting the socket down
                 self.logger.info(f"Connection established with server at {self.address}")
 
                 while self.reading:
-                    if not self.running:
-                        self.reading = False
-                        self.stop_threads_on_exit()
-                        break
                     try:
-                        data = self.socket.recv(1024)
-
-                        if data:
-                            message = data.decode("utf-8")
-                            self.networkBuffer += message
-                            self.logger.debug(f"Received data from server: {message}")
-
-                            while len(self.networkBuffer) > 0:
-                                if not self.messageInProgress:
-                                    if len(self.networkBuffer) >= self.packetHeaderLength:
-                                        self.messageBytesRemaining = int(self.networkBuffer[:self.packetHeaderLength])
-                                        self.networkBuffer = self.networkBuffer[self.packetHeaderLength:]
-                                        self.messageInProgress = True
-                                    else:
-                                        break
-
-                                if self.messageInProgress:
-                                    if len(self.networkBuffer) >= self.messageBytesRemaining:
-                                        message_content = self.networkBuffer[:self.messageBytesRemaining]
-                                        self.networkBuffer = self.networkBuffer[self.messageBytesRemaining:]
-
-                                        with self.lock:
-                                            self.iBuffer.put(message_content)
-                                            self.logger.debug(f"Message added to input buffer: {message_content}")
-
-                                        self.messageInProgress = False
-                                        self.messageBytesRemaining = 0
-
-                                        self.on_message_ready()
-                                    else:
-                                        break
-
-                        elif data == b'':
+                        received = self.decoder.recv_from(self.socket)
+
+                        if received:
+                            self.logger.debug(f"Received {received} bytes from server")
+
+                            for message_content, flags in self.decoder.frames():
+                                with self.lock:
+                                    self.iBuffer.put((message_content, flags))
+                                    self.logger.debug(f"Message of {len(message_content)} bytes added to input buffer")
+
+                                self.on_message_ready()
+
+                        else:
                             if self.running:
                                 self.logger.info("Server disconnected")
                                 self.running = False
+                                self.oBuffer.put(None) # Wake the write thread so it can finish
+                                self.on_disconnect()
 
                             break
 
-                    except OSError as e:
-                        err = e.args[0]
-                        if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                            time.sleep(0.1)
-                        else:
-                            self.logger.error(f"Socket error: {e}")
-                            self.running = False
-                            try:
-                                self.socket.shutdown(socket.SHUT_RDWR)
-                            except OSError as e:
-                                if e.errno == 10038:
-                                    self.logger.error("Socket already closed")
-                            finally:
-                                self.socket.close()
+                    except (OSError, ValueError) as e: # ValueError -> a broken frame header or a frame over the size limit
+                        if not self.running: # The socket was shut down by stop_threads_on_exit
                             break
+                        self.logger.error(f"Connection error: {e}")
+                        self.running = False
+                        self.oBuffer.put(None)
+                        try:
+                            self.socket.shutdown(socket.SHUT_RDWR)
+                        except OSError as e:
+                            if e.errno == 10038:
+                                self.logger.error("Socket already closed")
+                        finally:
+                            self.socket.close()
+                        self.on_disconnect()
+                        break
 
         except Exception as e:
             self.logger.error(f"Read thread error: {str(e)}")
@@ -180,9 +156,18 @@ class ConnectionHandler:
 
         self.running = False
         self.reading = False
-        self.writing = False
 
         try:
+            # Wake the write thread. It sends what is already queued (e.g. the disconnect message) and then exits
+            self.oBuffer.put(None)
+            current = threading.current_thread()
+
+            if hasattr(self, 'writeThread') and self.writeThread.is_alive() and self.writeThread is not current:
+                self.writeThread.join(timeout=2.0)
+                if self.writeThread.is_alive():
+                    self.logger.warning("Write thread did not terminate cleanly")
+
+            # Shutting the socket down wakes the read thread from recv
             if hasattr(self, 'socket') and not self.socket._closed:
                 try:
                     self.socket.shutdown(socket.SHUT_RDWR)
@@ -193,16 +178,11 @@ class ConnectionHandler:
                 except (OSError, socket.error):
                     pass
 
-            if hasattr(self, 'readThread'):
+            if hasattr(self, 'readThread') and self.readThread.is_alive() and self.readThread is not current:
                 self.readThread.join(timeout=2.0)
                 if self.readThread.is_alive():
                     self.logger.warning("Read thread did not terminate cleanly")
 
-            if hasattr(self, 'writeThread'):
-                self.writeThread.join(timeout=2.0)
-                if self.writeThread.is_alive():
-                    self.logger.warning("Write thread did not terminate cleanly")
-
         except Exception as e:
             self.logger.error(f"Error during thread cleanup: {str(e)}")
         finally:
@@ -213,18 +193,46 @@ class ConnectionHandler:
         self.readThread.start()
         self.writeThread.start()
 
-    def pushMessage(self, message_dict):
-        try:
-            if "password" in message_dict.keys():
-                message_dict["password"] = self.hashEncryption.encrypt_password(message_dict["password"])
-            message = json.dumps(message_dict)
+    def encode_message(self, message_dict):
+        """Builds the frame of a message: json -> compression (if negotiated and over the threshold) -> AES -> frame"""
+        message = json.dumps(message_dict).encode('utf-8')
+        if self.envelope == ClientProtocol.ENVELOPE_BINARY:
+            message, flags = ClientProtocol.compress_payload(message, self.options, self.compressionStats)
+            payload = self.AesEncryption.encrypt_envelope(message)
+        else:
+            flags = 0
             encrypted_data = self.AesEncryption.encrypt_text(message)
             message_to_send = {
                 'ciphertext': binascii.hexlify(encrypted_data[0]).decode('utf-8'),
                 'aesIV': binascii.hexlify(encrypted_data[1]).decode('utf-8'),
                 'authTag': binascii.hexlify(encrypted_data[2]).decode('utf-8')
             }
-            self.oBuffer.put(json.dumps(message_to_send))
+            payload = json.dumps(message_to_send).encode('utf-8')
+        return ClientProtocol.encode_frame(payload, self.framing, flags)
+
+    def decode_message(self, payload, flags=0):
+        """The reverse of encode_message, from the payload of a frame to the message dict"""
+        if self.envelope == ClientProtocol.ENVELOPE_BINARY:
+            message = self.AesEncryption.decrypt_envelope(payload)
+            return json.loads(ClientProtocol.decompress_payload(message, flags, self.compressionStats))
+
+        encrypted_dict = json.loads(payload)
+
+        # Convert from hex strings back to bytes
+        encrypted_data = (
+            binascii.unhexlify(encrypted_dict['ciphertext']),
+            binascii.unhexlify(encrypted_dict['aesIV']),
+            binascii.unhexlify(encrypted_dict['authTag'])
+        )
+
+        decrypted_message = self.AesEncryption.decrypt_text(encrypted_data)
+        return json.loads(decrypted_message)
+
+    def pushMessage(self, message_dict):
+        try:
+            if "password" in message_dict.keys():
+                message_dict["password"] = self.hashEncryption.encrypt_password(message_dict["password"])
+            self.oBuffer.put(self.encode_message(message_dict))
             self.logger.info("Message encrypted and queued for sending")
 
         except Exception as e:
@@ -234,26 +242,11 @@ class ConnectionHandler:
     def getMessage(self):
         if not self.iBuffer.empty():
             try:
-                message = self.iBuffer.get()
-                if isinstance(message, bytes):
-                    message = message.decode('utf-8')
-                encrypted_dict = json.loads(message)
-
-                # Convert from hex strings back to bytes
-                encrypted_data = (
-                    binascii.unhexlify(encrypted_dict['ciphertext']),
-                    binascii.unhexlify(encrypted_dict['aesIV']),
-                    binascii.unhexlify(encrypted_dict['authTag'])
-                )
-
-                decrypted_message = self.AesEncryption.decrypt_text(encrypted_data)
-                return json.loads(decrypted_message)
+                payload, flags = self.iBuffer.get()
+                return self.decode_message(payload, flags)
 
             except Exception as e:
                 self.logger.error(f"Error decrypting message: {e}")
                 raise
 
         return None
-
-
-
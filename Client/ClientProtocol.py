@@ -0,0 +1,323 @@
+"""Same as the server's Protocol.
+
+This file holds the wire protocol shared by the client's handshake and the ConnectionHandler.
+
+There are 2 frame formats.
+
+Legacy frames -> 4 ASCII digits with the payload length followed by the payload. Kept so older clients can still
+connect. It cannot carry more than 9999 bytes.
+
+Binary frames -> 1 byte version, 1 byte flags and an unsigned 32-bit payload length (network byte order) followed by
+the payload.
+
+The format is negotiated during the handshake. A new client starts the connection with a hello (magic bytes, a 4 byte
+length and a JSON body) listing what it supports. An old client starts with its public key behind a legacy 4 digit
+header, so the server can tell them apart from the first 4 bytes and answer each one in its own format.
+"""
+
+
+
+import json
+import socket
+import struct
+import threading
+import time
+import zlib
+
+
+PROTOCOL_VERSION = 1
+
+FRAMING_LEGACY = "legacy"
+FRAMING_BINARY = "binary"
+SUPPORTED_FRAMING = [FRAMING_BINARY, FRAMING_LEGACY] # In order of preference
+
+# How the AES output is put in a frame. json -> hexlified ciphertext, nonce and tag in a json message (the original).
+# binary -> nonce | tag | ciphertext as raw bytes (AESencryption.encrypt_envelope)
+ENVELOPE_JSON = "json"
+ENVELOPE_BINARY = "binary"
+SUPPORTED_ENVELOPES = [ENVELOPE_BINARY, ENVELOPE_JSON]
+
+# Compression happens before encryption and only for messages over the threshold, so small control messages skip it.
+# It needs binary frames and the binary envelope, the flags byte tells the other end which frames are compressed.
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+SUPPORTED_COMPRESSION = [COMPRESSION_ZLIB]
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+
+FLAG_COMPRESSED = 0x01
+
+# How the AES key is agreed on. rsa -> the server encrypts a random AES key with the client's RSA public key (the original).
+# x25519 -> both ends make an ephemeral X25519 key, send the public half in the hello and its reply, and derive the AES
+# key from the shared secret with HKDF. No RSA key has to be generated or imported.
+KEY_EXCHANGE_RSA = "rsa"
+KEY_EXCHANGE_X25519 = "x25519"
+SUPPORTED_KEY_EXCHANGE = [KEY_EXCHANGE_X25519, KEY_EXCHANGE_RSA]
+
+# The options of a client that connects with the old handshake
+LEGACY_OPTIONS = {"framing": FRAMING_LEGACY,
+                  "envelope": ENVELOPE_JSON,
+                  "compression": COMPRESSION_NONE}
+
+LEGACY_HEADER_LENGTH = 4
+LEGACY_MAX_PAYLOAD = 9999
+
+FRAME_HEADER = struct.Struct("!BBI") # version, flags, payload length
+FRAME_HEADER_LENGTH = FRAME_HEADER.size
+MAX_PAYLOAD = 0xFFFFFFFF
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Frames the FrameDecoder accepts. The header allows 4 GB, a peer must not make us buffer that
+
+# The FrameDecoder asks recv for RECV_SIZE_MIN bytes and doubles it while recv keeps filling it, up to RECV_SIZE_MAX
+RECV_SIZE_MIN = 4096
+RECV_SIZE_MAX = 256 * 1024
+
+# The first byte is not an ASCII digit so it can never be mistaken for a legacy length header
+HANDSHAKE_MAGIC = b"\x00TMS"
+HANDSHAKE_LENGTH = struct.Struct("!I")
+MAX_HANDSHAKE_LENGTH = 64 * 1024
+
+
+def recv_exact(sock, length, deadline=None):
+    """Receives exactly length bytes or raises ConnectionError if the peer closes first.
+    With a deadline (a time.monotonic() value) it raises socket.timeout once it passes, even if the peer keeps
+    trickling bytes in slowly enough to never hit the socket timeout."""
+    data = bytearray()
+    while len(data) < length:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Handshake phase timed out")
+            sock.settimeout(remaining)
+        chunk = sock.recv(min(length - len(data), 4096))
+        if not chunk:
+            raise ConnectionError("Connection closed during handshake")
+        data += chunk
+    return bytes(data)
+
+
+def is_legacy_header(prefix):
+    return len(prefix) == LEGACY_HEADER_LENGTH and prefix.isdigit()
+
+
+def send_legacy_block(sock, data):
+    """Sends data behind a 4 digit ASCII length header (the original key exchange format)"""
+    if len(data) > LEGACY_MAX_PAYLOAD:
+        raise ValueError(f"Block of {len(data)} bytes does not fit in a legacy header")
+    sock.sendall(str(len(data)).zfill(LEGACY_HEADER_LENGTH).encode("utf-8") + data)
+
+
+def recv_legacy_block(sock, prefix=None, deadline=None):
+    """Receives a block sent with send_legacy_block. The header can be passed in if it was already read"""
+    if prefix is None:
+        prefix = recv_exact(sock, LEGACY_HEADER_LENGTH, deadline)
+    if not is_legacy_header(prefix):
+        raise ValueError(f"Invalid legacy length header: {prefix!r}")
+    return recv_exact(sock, int(prefix), deadline)
+
+
+def send_handshake(sock, message_dict):
+    body = json.dumps(message_dict).encode("utf-8")
+    sock.sendall(HANDSHAKE_MAGIC + HANDSHAKE_LENGTH.pack(len(body)) + body)
+
+
+def recv_handshake_body(sock, deadline=None):
+    """Receives the rest of a handshake message after its magic bytes have been read"""
+    (length,) = HANDSHAKE_LENGTH.unpack(recv_exact(sock, HANDSHAKE_LENGTH.size, deadline))
+    if length > MAX_HANDSHAKE_LENGTH:
+        raise ValueError(f"Handshake message too large: {length} bytes")
+    return json.loads(recv_exact(sock, length, deadline).decode("utf-8"))
+
+
+def encode_frame(payload, framing, flags=0):
+    """Puts the frame header in front of the payload"""
+    if framing == FRAMING_BINARY:
+        if len(payload) > MAX_PAYLOAD:
+            raise ValueError(f"Payload of {len(payload)} bytes is too large for a frame")
+        return FRAME_HEADER.pack(PROTOCOL_VERSION, flags, len(payload)) + payload
+
+    if len(payload) > LEGACY_MAX_PAYLOAD:
+        raise ValueError(f"Payload of {len(payload)} bytes does not fit in a legacy frame")
+    return str(len(payload)).zfill(LEGACY_HEADER_LENGTH).encode("utf-8") + payload
+
+
+def header_length(framing):
+    return FRAME_HEADER_LENGTH if framing == FRAMING_BINARY else LEGACY_HEADER_LENGTH
+
+
+def decode_header(header, framing):
+    """Returns (flags, payload length) from a frame header"""
+    if framing == FRAMING_BINARY:
+        version, flags, length = FRAME_HEADER.unpack(header)
+        if version != PROTOCOL_VERSION:
+            raise ValueError(f"Unsupported frame version {version}")
+        return flags, length
+
+    if not bytes(header).isdigit():
+        raise ValueError(f"Invalid legacy frame header: {bytes(header)!r}")
+    return 0, int(header)
+
+
+class FrameDecoder:
+    """Cuts the byte stream of a connection into frames. Used by the read loop of the ConnectionHandler.
+
+    recv_from receives straight into one bytearray with recv_into and frames() returns the whole frames in it. Consumed
+    bytes are not deleted from the front of the buffer one frame at a time, only start moves forward. The leftover of a
+    partial frame is moved to the front when more room is needed, so every byte is copied about once on its way in and
+    once more into its payload. The receive size grows while recv fills it (large messages, bursts) and shrinks back for
+    a connection that only sends small requests."""
+
+    def __init__(self, framing, max_frame_size=MAX_FRAME_SIZE):
+        self.framing = framing
+        self.header_length = header_length(framing)
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(RECV_SIZE_MIN)
+        self.start = 0 # First byte not returned as a frame yet
+        self.end = 0 # End of the received bytes
+        self.recv_size = RECV_SIZE_MIN
+        self.frame = None # (flags, length) of the frame whose header was read but not its payload
+        self.recv_calls = 0
+        self.bytes_received = 0
+        self.frames_decoded = 0
+
+    def recv_from(self, sock):
+        """Receives once from sock. Returns the number of bytes received, 0 if the peer closed the connection"""
+        size = self.recv_size
+        if self.frame is not None:
+            # The rest of a large frame can come in one call
+            size = max(size, self.frame[1] - (self.end - self.start))
+        self.reserve(size)
+        with memoryview(self.buffer) as view, view[self.end:self.end + size] as free:
+            received = sock.recv_into(free, size)
+        self.end += received
+        self.recv_calls += 1
+        self.bytes_received += received
+
+        if received == self.recv_size:
+            self.recv_size = min(self.recv_size * 2, RECV_SIZE_MAX)
+        elif received < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, RECV_SIZE_MIN)
+        return received
+
+    def feed(self, data):
+        """Adds bytes that were received some other way"""
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self.bytes_received += len(data)
+
+    def reserve(self, size):
+        """Makes room for size bytes after the received ones"""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        missing = size - (len(self.buffer) - self.end)
+        if missing > 0:
+            self.buffer.extend(bytes(missing))
+
+    def frames(self):
+        """Yields (payload, flags) for every whole frame received so far"""
+        view = memoryview(self.buffer) # Released before recv_from can resize the buffer again
+        try:
+            while True:
+                if self.frame is None:
+                    if self.end - self.start < self.header_length:
+                        break
+                    flags, length = self.read_header()
+                    if length > self.max_frame_size:
+                        raise ValueError(f"Frame of {length} bytes is over the limit of {self.max_frame_size}")
+                    self.start += self.header_length
+                    self.frame = (flags, length)
+
+                flags, length = self.frame
+                if self.end - self.start < length:
+                    break
+                payload = bytes(view[self.start:self.start + length])
+                self.start += length
+                self.frame = None
+                self.frames_decoded += 1
+                yield payload, flags
+        finally:
+            view.release()
+
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > 2 * RECV_SIZE_MAX:
+                self.buffer = bytearray(RECV_SIZE_MIN) # Do not keep the memory of one very large frame
+
+    def read_header(self):
+        if self.framing == FRAMING_BINARY:
+            # Straight from the buffer, a small frame should not cost a slice of its own
+            version, flags, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if version != PROTOCOL_VERSION:
+                raise ValueError(f"Unsupported frame version {version}")
+            return flags, length
+        return decode_header(self.buffer[self.start:self.start + self.header_length], self.framing)
+
+    def stats(self):
+        return {"recv_calls": self.recv_calls,
+                "bytes_received": self.bytes_received,
+                "frames": self.frames_decoded,
+                "recv_size": self.recv_size,
+                "buffer_size": len(self.buffer)}
+
+
+class CompressionStats:
+    """Compression counters of one connection. The ratio and the cpu time spent are used to tune the threshold."""
+
+    def __init__(self):
+        self.lock = threading.Lock() # pushMessage is called from other connections' threads too (notifications)
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def as_dict(self):
+        with self.lock:
+            return {"compressed": self.compressed,
+                    "skipped": self.skipped,
+                    "bytes_in": self.bytes_in,
+                    "bytes_out": self.bytes_out,
+                    "ratio": round(self.ratio(), 3),
+                    "compress_ms": round(self.compress_seconds * 1000, 3),
+                    "decompressed": self.decompressed,
+                    "decompress_ms": round(self.decompress_seconds * 1000, 3)}
+
+
+def compress_payload(data, options, stats):
+    """Compresses data if the connection negotiated it and it is over the threshold. Returns (data, flags)"""
+    if options.get("compression") != COMPRESSION_ZLIB or len(data) < options.get("compression_threshold", COMPRESSION_THRESHOLD):
+        with stats.lock:
+            stats.skipped += 1
+        return data, 0
+
+    start = time.perf_counter()
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    elapsed = time.perf_counter() - start
+    with stats.lock:
+        stats.compressed += 1
+        stats.bytes_in += len(data)
+        stats.bytes_out += len(compressed)
+        stats.compress_seconds += elapsed
+    return compressed, FLAG_COMPRESSED
+
+
+def decompress_payload(data, flags, stats):
+    if not flags & FLAG_COMPRESSED:
+        return data
+
+    start = time.perf_counter()
+    data = zlib.decompress(data)
+    elapsed = time.perf_counter() - start
+    with stats.lock:
+        stats.decompressed += 1
+        stats.decompress_seconds += elapsed
+    return data
@@ -14,9 +14,23 @@ and all the way to the server's StateMachine.
 
 
 from enum import Enum
+import itertools
+import threading
+import time
+import uuid
 import ClientLogger
 import ClientEncryption
 
+# Batches of task operations, sent in one message and run by the server in one transaction. The message is a list of
+# what the single action takes, e.g. {"action": "Batch Delete Tasks", "message": [{"task_id": 1}, {"task_id": 2}]}
+BATCH_ACTIONS = ("Batch Create Tasks", "Batch Update Tasks", "Batch Delete Tasks")
+
+# Task changes get an idempotency key. If the connection drops before the response came, the client sends them again
+# with the same key after it reconnects, and the server does not run one twice.
+IDEMPOTENT_ACTIONS = ("Create Task", "Update Task", "Delete Task") + BATCH_ACTIONS
+
+MAX_BUFFERED_CHANGES = 1000 # Notifications kept while waiting for View Tasks, more and they are dropped
+
 class State(Enum):
     Start = 1
     LoggingIn = 2
@@ -35,6 +49,14 @@ class ClientStateMachine:
         self.logger = ClientLogger.client_logger
 
         self.tasks = []
+        # The version of the task list View Tasks sent. The notifications carry the changed tasks with their versions and
+        # are applied to the list. None -> a View Tasks is needed first, the changes wait in bufferedChanges until then.
+        # A user only gets the changes of its own tasks, so the versions have gaps. taskVersions has the version of
+        # the last change applied to each task, an older one that arrives late is skipped.
+        self.tasksVersion = None
+        self.taskVersions = {}
+        self.bufferedChanges = []
+        self.tasksLock = threading.Lock()
 
 
         self.connectionHandler = connectionHandler
@@ -43,10 +65,42 @@ class ClientStateMachine:
         self.username = None
         self.gui = gui
 
-        self.rsaEncryption = ClientEncryption.RsaEncryption()
+        self.rsaEncryption = client.RsaEncryption # The key the client made for the handshake, no need for a second one
         self.md5Encryption = ClientEncryption.HashEncryption()
         self.caesarCipher = ClientEncryption.CaesarCipher()
 
+        # Requests sent and not answered yet, by request id. The server echoes the id back, so several requests can be
+        # in flight at once and their responses can arrive in any order.
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {} # request id -> (action, sent at, the message if it has an idempotency key)
+        self.pending_lock = threading.Lock()
+        self.refreshTimer = None # A View Tasks the server asked to send again later
+
+    def send_request(self, message):
+        """Gives the message a request id and sends it to the server. A task change also gets an idempotency key,
+        unless it is sent again and already has one"""
+        retry = None
+        if message.get("action") in IDEMPOTENT_ACTIONS:
+            message.setdefault("idempotency_key", uuid.uuid4().hex)
+            retry = message
+        with self.pending_lock:
+            request_id = next(self.request_ids)
+            self.pending_requests[request_id] = (message.get("action"), time.perf_counter(), retry)
+        message["request_id"] = request_id
+        self.connectionHandler.pushMessage(message)
+
+    def unanswered_changes(self):
+        """The task changes sent on this connection that got no response"""
+        with self.pending_lock:
+            return [retry for _, _, retry in self.pending_requests.values() if retry is not None]
+
+    def resend_changes(self, messages):
+        """Sends the unanswered changes of the old connection again after a reconnect. They keep their idempotency
+        keys, so the ones the server already did are not done twice"""
+        for message in messages:
+            self.logger.info(f"Sending {message['action']} again after the reconnect")
+            self.send_request(dict(message))
+
     def handle_action(self, message):
         """Handles actions"""
         self.logger.debug(f"Handling action: {message}")
@@ -54,6 +108,24 @@ class ClientStateMachine:
             self.logger.error("No action in message")
             return
         action = message['action']
+
+        if action == "Session Ticket": # Can arrive in any state, lets the client resume the session if it reconnects
+            self.client.store_session_ticket(message["message"])
+            return
+
+        request_id = message.get("request_id")
+        if request_id is not None:
+            with self.pending_lock:
+                request = self.pending_requests.pop(request_id, None)
+            if request is None:
+                self.logger.warning(f"Response to an unknown request {request_id} ignored")
+                return
+            request_action, sent_at, retry = request
+            self.logger.debug(f"Response to request {request_id} ({request_action}) after {(time.perf_counter() - sent_at) * 1000:.1f} ms")
+
+        if action == "Retry Later": # The server's rate limit turned the request down
+            self.handle_retry_later(message["message"], retry if request_id is not None else None)
+            return
         try:
             if self.currentState == State.Start:
                 self.handle_start(action, message)
@@ -71,11 +143,11 @@ class ClientStateMachine:
             self.previousState = State.Start
             if 'username' in message:
                 self.username = message['username']
-            self.connectionHandler.pushMessage(message)
+            self.send_request(message)
             self.logger.debug("Login message sent to server")
         elif action == "signup":
             self.currentState = State.Start
-            self.connectionHandler.pushMessage(message)
+            self.send_request(message)
             self.logger.debug("Signup message sent to server")
 
 
@@ -137,26 +209,34 @@ class ClientStateMachine:
         if action == "Create Task":
             if message.get("message") == "Task created successfully.":
                 self.gui.show_notification("Success", "Task created successfully!")
-                self.request_tasks()
+                self.refresh_after_replay(message)
+            elif "request_id" in message: # A response, do not send it back
+                self.gui.show_notification("Error", "Failed to create task.", type="error")
             else:
                 self.create_task(message)
 
         elif action == "Update Task":
             if message.get("message") == "Success":
                 self.gui.show_notification("Success", "Task updated successfully!")
-                self.request_tasks()
+                self.refresh_after_replay(message)
+            elif "request_id" in message:
+                self.gui.show_notification("Error", "Failed to update task.", type="error")
             else:
                 self.update_task(message)
 
         elif action == "Delete Task":
             if message.get("message") == "Success":
                 self.gui.show_notification("Success", "Task deleted successfully!")
-                self.request_tasks()
+                self.refresh_after_replay(message)
+            elif "request_id" in message:
+                self.gui.show_notification("Error", "Failed to delete task.", type="error")
             else:
                 self.delete_task(message)
         elif action == "View Tasks":
             self.show_tasks(message)
-        elif action == "Notification":
+        elif action == "Sync Tasks":
+            self.sync_result(message)
+        elif action == "notification":
             self.handle_notification(message)
         elif action == "Exit":
             self.logger.info(f"{self.client.ADDRESS} requesting exit.")
@@ -165,11 +245,24 @@ class ClientStateMachine:
                 "message": "Exiting... Goodbye..."
             }
             self.connectionHandler.pushMessage(message)
+            self.client.session = None # Logged out, nothing to resume
             self.client.close_client(self.connectionHandler)
         elif action == "View users":
             users_data = message.get("message", [])
             self.gui.display_users(users_data)
+        elif action in BATCH_ACTIONS:
+            if "request_id" in message: # The results of a batch this client sent
+                self.handle_batch_result(action, message.get("message"))
+                self.refresh_after_replay(message)
+            else:
+                self.send_request(message)
+
 
+    def resume(self, username, state):
+        """The server resumed the session, the client continues logged in without going through the login again"""
+        self.username = username
+        self.currentState = State[state]
+        self.logger.info(f"Session of {username} resumed")
 
     def getUsername(self):
         return self.username
@@ -178,70 +271,198 @@ class ClientStateMachine:
     def create_task(self, task):
         if self.currentState == State.Dashboard or self.currentState == State.AdminDashboard:
             self.logger.debug("Creating task")
-            self.connectionHandler.pushMessage(task)
+            self.send_request(task)
 
     def show_tasks(self, message):
         """Handles task display response from server"""
         try:
             if message.get("message") == "No tasks available.":
-                self.tasks = []
-                self.gui.display_tasks(self.tasks)
-                return
-
-            # Convert string representation to list if needed
-            task_data = message.get("message")
-            if isinstance(task_data, str):
-                import ast
-                self.tasks = ast.literal_eval(task_data)
-            elif isinstance(task_data, list):
-                self.tasks = task_data
+                tasks = []
             else:
-                self.logger.error(f"Unexpected task data type: {type(task_data)}")
-                return
-
-            self.gui.display_tasks(self.tasks)
+                # Convert string representation to list if needed
+                task_data = message.get("message")
+                if isinstance(task_data, str):
+                    import ast
+                    tasks = ast.literal_eval(task_data)
+                elif isinstance(task_data, list):
+                    tasks = task_data
+                else:
+                    self.logger.error(f"Unexpected task data type: {type(task_data)}")
+                    return
+
+            with self.tasksLock:
+                self.tasks = tasks
+                self.tasksVersion = message.get("version")
+                self.taskVersions = {}
+                # Notifications that came while the View Tasks was on its way, the newer ones are not in the list yet
+                buffered, self.bufferedChanges = self.bufferedChanges, []
+                if self.tasksVersion is not None and buffered:
+                    self.apply_changes(buffered)
+                tasks = list(self.tasks)
+            self.gui.display_tasks(tasks)
 
         except Exception as e:
             self.logger.error(f"Error showing tasks: {e}")
             self.logger.error(f"Message content: {message}")
 
     def request_tasks(self):
-        """Send request to server for tasks"""
+        """Send request to server for tasks. With a list to start from only the tasks changed since its version"""
+        with self.tasksLock:
+            version = self.tasksVersion
+        if version is not None:
+            self.sync_tasks(version)
+            return
         try:
             message = {
                 "action": "View Tasks",
                 "username": self.getUsername()
             }
             self.logger.debug(f"Requesting tasks with message: {message}")
-            self.connectionHandler.pushMessage(message)
+            self.send_request(message)
         except Exception as e:
             self.logger.error(f"Error requesting tasks: {e}")
 
+    def sync_tasks(self, version):
+        """Asks for the tasks changed since version, the server answers from its change log (Sync Tasks)"""
+        self.logger.debug(f"Syncing tasks since version {version}")
+        self.send_request({"action": "Sync Tasks", "message": {"version": version}})
+
+    def sync_result(self, message):
+        """Applies the changes Sync Tasks sent, or the whole list if the server could not send only the changes"""
+        result = message.get("message")
+        if not isinstance(result, dict):
+            self.logger.warning(f"Sync Tasks failed: {result}, getting all the tasks")
+            self.resync_tasks(full=True)
+            return
+        if result.get("full"):
+            self.show_tasks({"message": result["tasks"], "version": result["version"]})
+            return
+
+        with self.tasksLock:
+            if self.tasksVersion is None: # A View Tasks is on its way and brings all of them
+                return
+            self.apply_changes(result["changes"])
+            self.tasksVersion = max(self.tasksVersion, result["version"])
+            tasks = list(self.tasks)
+        self.logger.info(f"Synced {len(result['changes'])} changed tasks, now at version {result['version']}")
+        self.gui.display_tasks(tasks)
+
+    def continue_tasks(self, previous):
+        """After a reconnect, starts from the task list of the old connection and gets only what changed since"""
+        with previous.tasksLock:
+            tasks, version, task_versions = list(previous.tasks), previous.tasksVersion, dict(previous.taskVersions)
+        with self.tasksLock:
+            self.tasks, self.tasksVersion, self.taskVersions = tasks, version, task_versions
+        if version is not None:
+            self.sync_tasks(version)
+
     def update_task(self, message):
         """Handles task update request"""
         try:
             self.logger.debug(f"Sending update task request: {message}")
-            self.connectionHandler.pushMessage(message)
+            self.send_request(message)
             self.logger.debug("Update task request sent")
         except Exception as e:
             self.logger.error(f"Error updating task: {e}")
 
 
     def delete_task(self,message):
-        self.connectionHandler.pushMessage(message)
+        self.send_request(message)
+
+    def handle_batch_result(self, action, result):
+        if not isinstance(result, dict):
+            self.gui.show_notification("Error", f"{action} failed.", type="error")
+            return
+        for item in result["results"]:
+            if item["result"] != "Success":
+                self.logger.warning(f"{action}: task {item['index']} failed: {item.get('error')}")
+        total = result["succeeded"] + result["failed"]
+        if result["failed"]:
+            self.gui.show_notification("Error", f"{result['failed']} of {total} tasks failed.", type="error")
+        else:
+            self.gui.show_notification("Success", f"{total} tasks done!")
+
+    def handle_retry_later(self, details, retry=None):
+        retry_after = details.get("retry_after", 1)
+        self.logger.warning(f"Server busy, {details.get('action')} can be sent again in {retry_after} s")
+        if retry is not None:
+            # A task change with an idempotency key, safe to send again as it is
+            timer = threading.Timer(retry_after, self.send_request, args=(dict(retry),))
+            timer.daemon = True
+            timer.start()
+        elif details.get("action") in ("View Tasks", "Sync Tasks"):
+            # Only a refresh, one more later is enough however many were turned down
+            if self.refreshTimer is None or not self.refreshTimer.is_alive():
+                self.refreshTimer = threading.Timer(retry_after, self.request_tasks)
+                self.refreshTimer.daemon = True
+                self.refreshTimer.start()
+        else:
+            self.gui.show_notification("Error", "The server is busy, please try again.", type="error")
 
     def handle_notification(self, message):
-        text = message.get("message", "")
-        self.gui.show_notification("Notification", text)
+        """Applies the changed tasks of a notification to the task list. A notification without changes (a resync after
+        the server dropped some, or from an older server) gets all the tasks again"""
+        changes = message.get("changes")
+        self.logger.info(f"Notification: {message.get('message', '')}")
+        if message.get("resync") or not changes:
+            self.resync_tasks()
+            return
+
+        with self.tasksLock:
+            if self.tasksVersion is None:
+                # Waiting for View Tasks, they are applied to its tasks
+                self.bufferedChanges.extend(changes)
+                if len(self.bufferedChanges) <= MAX_BUFFERED_CHANGES:
+                    return
+                self.bufferedChanges = []
+                resync = True
+            else:
+                self.apply_changes(changes)
+                resync = False
+            tasks = list(self.tasks)
+        if resync:
+            self.resync_tasks()
+        else:
+            self.gui.display_tasks(tasks)
+
+    def apply_changes(self, changes):
+        """Applies changes in version order, skipping the ones the list already has. Called with tasksLock held"""
+        for change in sorted(changes, key=lambda change: change["version"]):
+            task_id = change["deleted"] if "deleted" in change else change["task"]["TaskID"]
+            if change["version"] <= max(self.tasksVersion, self.taskVersions.get(task_id, 0)):
+                continue # Already in the list
+            self.taskVersions[task_id] = change["version"]
+
+            self.tasks = [task for task in self.tasks if task["TaskID"] != task_id]
+            if "deleted" not in change and self.is_my_task(change["task"]):
+                self.tasks.append(change["task"])
+                self.tasks.sort(key=lambda task: int(task["TaskID"]), reverse=True) # Newest first, like View Tasks
+
+    def is_my_task(self, task):
+        """The tasks View Tasks shows. A task given to someone else leaves the list of a user, admins see all of them"""
+        return (self.currentState == State.AdminDashboard
+                or self.username in (task.get("assigned_to"), task.get("created_by")))
+
+    def resync_tasks(self, full=False):
+        """Catches up after the server dropped notifications, with the changes since the version of the list. full gets
+        all the tasks again, the notifications until they come are kept and applied to them"""
+        if full:
+            with self.tasksLock:
+                self.tasksVersion = None
         self.request_tasks()
 
+    def refresh_after_replay(self, message):
+        """The server sent a stored response again (idempotency key), there is no notification with the change"""
+        if message.get("replayed"):
+            self.request_tasks()
+
     def view_users(self):
         message = {
             "action": "View Users",
             "username": self.getUsername()
         }
         self.logger.debug(f"Requesting users list")
-        self.connectionHandler.pushMessage(message)
+        self.send_request(message)
 
 
 
@@ -0,0 +1,186 @@
+"""This file is the asyncio engine of the server. It is picked at startup with 'python Server.py --engine asyncio'.
+
+The threaded engine in Server.py starts 2 threads for every client plus the listen thread. Here one event loop accepts
+the clients and reads and writes all the sockets, so an idle client only costs its socket and 2 coroutines.
+
+It uses the same wire protocol, the same handshake (Server.key_exchange) and the same StateMachine. Everything that
+blocks - the handshake, AES, json and the database calls of the state machine - runs in bounded thread pools so the
+loop never waits on it. The messages go to the server's Dispatcher like in the threaded engine, so they are processed
+in the order they came while the loop keeps reading the client.
+"""
+
+
+
+import asyncio
+import threading
+from collections import deque
+
+import Protocol
+from Server import Server
+from ServerLib import ConnectionHandler, FRAME_RESPONSE, MAX_INPUT_MESSAGES
+
+
+class AsyncConnectionHandler(ConnectionHandler):
+    """ConnectionHandler driven by the event loop instead of its own read and write threads.
+    The buffers, pushMessage, pushSerialized and getMessage are inherited, so the state machine and the server use it like the threaded one."""
+
+    def __init__(self, reader, writer, loop, client_socket, address, client_public_key=None, rsa_encryption=None,
+                 aes_encryption=None, options=None):
+        super().__init__(client_socket, address, client_public_key, rsa_encryption, aes_encryption, options=options)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+
+    def pushSerialized(self, message, kind=FRAME_RESPONSE):
+        # Called from the worker threads, the write coroutine is woken up through the loop. pushMessage comes here too
+        super().pushSerialized(message, kind)
+        self.wake_writer()
+
+    def wake_writer(self):
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError: # The loop has already been closed during shutdown
+            pass
+
+    async def write_async(self):
+        try:
+            while self.writing:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.writing and not self.oBuffer.empty():
+                    # Everything queued goes to the transport in one write, maxWriteBatch frames at a time
+                    batch = []
+                    while len(batch) < self.maxWriteBatch and not self.oBuffer.empty():
+                        message = self.oBuffer.get_nowait()
+                        if message is None: # Queued by stop_threads_on_exit after the last message
+                            self.writing = False
+                            break
+                        batch.append(message) # The frames were built by pushMessage
+                    if batch:
+                        self.writer.writelines(batch)
+                        self.framesSent += len(batch)
+                        self.sendCalls += 1
+                    await self.writer.drain()
+        except OSError as e:
+            self.logger.error(f"Write error: {e}")
+        finally:
+            # Closing the transport also ends read_async
+            self.writer.close()
+            self.logger.info("Write task finished")
+
+    async def read_async(self, dispatch):
+        pending = deque() # Futures of the messages handed to the dispatcher, oldest first
+        try:
+            while self.running:
+                header = await self.reader.readexactly(self.packetHeaderLength)
+                flags, length = Protocol.decode_header(header, self.framing)
+                if length > self.decoder.max_frame_size:
+                    raise ValueError(f"Frame of {length} bytes is over the limit of {self.decoder.max_frame_size}")
+                message_content = await self.reader.readexactly(length)
+                # A client that sends faster than its messages are processed is not read until the oldest are done
+                while pending and pending[0].done():
+                    pending.popleft()
+                if len(pending) >= MAX_INPUT_MESSAGES:
+                    await asyncio.wrap_future(pending.popleft())
+
+                self.iBuffer.put_nowait((message_content, flags))
+                pending.append(dispatch())
+        except (asyncio.IncompleteReadError, OSError) as e:
+            if self.running:
+                self.logger.info(f"Client {self.address} disconnected: {e!r}")
+        except ValueError as e: # A broken header or a frame over the size limit
+            self.logger.error(f"Invalid frame from {self.address}: {e}")
+        except Exception as e:
+            self.logger.critical(f"Unhandled exception in read task: {e}")
+        finally:
+            if self.running:
+                self.on_disconnect()
+            self.logger.info("Read task finished")
+
+    def stop_threads_on_exit(self):
+        """Stops the connection. It can be called from the loop and from the worker threads, so it does not wait."""
+        self.logger.info("Stopping connection")
+        self.running = False
+        self.reading = False
+        # The write coroutine sends what is already queued and then closes the transport
+        self.oBuffer.put(None)
+        self.wake_writer()
+
+
+class AsyncServer(Server):
+    def __init__(self, ADDRESS, PORT, **kwargs):
+        super().__init__(ADDRESS, PORT, **kwargs)
+        self.loop = None
+        self.client_tasks = set()
+        self.listen_thread = threading.Thread(target=self.listen)
+
+    def listen(self):
+        self.logger.debug("Event loop thread started")
+        try:
+            asyncio.run(self.listen_async())
+        finally:
+            self.logger.info("Event loop stopped")
+
+    async def listen_async(self):
+        self.loop = asyncio.get_running_loop()
+        wakeup = None
+        if self.wake_reader:
+            # A worker of the Supervisor, quit_server writes to the pipe instead of connecting
+            self.wake_reader.setblocking(False)
+            wakeup = self.loop.create_task(self.loop.sock_recv(self.wake_reader, 1))
+
+        with self.open_listen_socket() as s:
+            s.setblocking(False)
+            self.logger.info(f"Server listening on {self.ADDRESS}:{self.PORT} (asyncio engine)")
+
+            while self.running:
+                try:
+                    if wakeup is None:
+                        client_socket, client_address = await self.loop.sock_accept(s)
+                    else:
+                        accept = self.loop.create_task(self.loop.sock_accept(s))
+                        await asyncio.wait({accept, wakeup}, return_when=asyncio.FIRST_COMPLETED)
+                        if not accept.done():
+                            accept.cancel()
+                            break
+                        client_socket, client_address = accept.result()
+                except OSError as e:
+                    self.logger.error(f"Socket accept error: {e}")
+                    continue
+
+                if not self.running: # The connection quit_server makes to wake the loop up
+                    client_socket.close()
+                    break
+
+                if not self.admit_handshake(client_socket, client_address):
+                    continue
+
+                task = self.loop.create_task(self.handle_client(client_socket, client_address))
+                self.client_tasks.add(task)
+                task.add_done_callback(self.client_tasks.discard)
+
+    async def handle_client(self, client_socket, client_address):
+        self.logger.info(f"Accepted connection from {client_address}")
+        try:
+            # The handshake is written for a blocking socket, so it runs in the server's handshake pool
+            client_socket.setblocking(True)
+            client_public_key, aes_encryption, options, session = await self.loop.run_in_executor(
+                self.handshake_pool, self.key_exchange, client_socket)
+            reader, writer = await asyncio.open_connection(sock=client_socket)
+
+            connection = AsyncConnectionHandler(reader, writer, self.loop, client_socket, client_address, client_public_key,
+                                                self.RsaEncryption, aes_encryption, options=options)
+            await self.loop.run_in_executor(self.handshake_pool, self.register_connection, connection, client_public_key,
+                                            session)
+            self.count_handshake("completed")
+        except Exception as e:
+            self.handshake_failed(client_socket, client_address, e)
+            return
+        finally:
+            self.pending_handshakes.release()
+
+        def dispatch():
+            return self.dispatcher.submit(connection, self.process_message, connection)
+
+        await asyncio.gather(connection.read_async(dispatch), connection.write_async())
@@ -4,6 +4,7 @@ to determine if the credentials given by the client is correct and check if the
 
 import sqlite3
 from threading import Lock
+import ConnectionPool
 import ServerLogger
 
 
@@ -14,7 +15,7 @@ lock = Lock()
 def authenticate_user(username, password, manager_db="task_manager.db"):
     try:
         with lock: # Added a lock to prevent many threads from entering the database at the same time and creating conflict.
-            conn = sqlite3.connect(manager_db)
+            conn = ConnectionPool.get_pool(manager_db).connect()
             cursor = conn.cursor()
 
 
@@ -43,7 +44,7 @@ def authenticate_user(username, password, manager_db="task_manager.db"):
 def admin_right(username, manager_db="task_manager.db"):
     try:
         with lock: # Added a lock to prevent many threads from entering the database at the same time and creating conflict.
-            conn = sqlite3.connect(manager_db)
+            conn = ConnectionPool.get_pool(manager_db).connect()
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT Role FROM users WHERE Username = ?
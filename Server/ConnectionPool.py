@@ -0,0 +1,155 @@
+"""This file keeps the SQLite connections open, one per thread, instead of opening a new one for every query.
+
+Database, Authentication and the idempotency keys used to call sqlite3.connect around every statement and close the
+connection right after. Opening a connection reads the schema again, its prepared statements and page cache are thrown
+away with it. insert_task and update_task even opened a second one through get_userID_fromDB.
+
+Now get_pool(db_file) gives the pool of that file, shared by everybody in the process. pool.connect() returns the
+connection of the calling thread, opened the first time the thread asks. The code keeps calling conn.close() like
+before, for a pooled connection that only hands it back: a transaction left open is rolled back, the isolation level is
+set back to the default and the connection stays open for the next query of the thread. A method that calls another one (update_task -> get_userID_fromDB) gets the same
+connection, it is only handed back when the outer one closes it too.
+
+The connections keep cached_statements prepared statements (sqlite3's own statement cache). A connection that was not
+used for health_check_interval seconds runs "SELECT 1" before it is handed out, a broken one is replaced. Connections
+of threads that ended are closed when a new one is opened. A worker forked by the Supervisor does not use the
+connections it inherited, it opens its own.
+
+stats() has the pool size and how often a connection was reused, Server logs it when it stops.
+"""
+
+
+
+import os
+import sqlite3
+import threading
+import time
+
+import ServerLogger
+
+
+CACHED_STATEMENTS = 256 # Prepared statements kept per connection
+HEALTH_CHECK_INTERVAL = 30.0 # Seconds a connection can be idle before it is checked again
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection whose close() gives it back to the pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.thread = None
+        self.depth = 0 # Open connect() calls of the thread
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.pool.release(self)
+
+    def really_close(self):
+        try:
+            sqlite3.Connection.close(self)
+        except sqlite3.Error:
+            pass
+
+
+class ConnectionPool:
+    def __init__(self, db_file, cached_statements=CACHED_STATEMENTS, health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.logger = ServerLogger.server_logger
+        self.db_file = db_file
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.connections = {} # thread ident -> PooledConnection
+        self.pid = os.getpid()
+        self.stats_counters = {"opened": 0, "reused": 0, "health_checks": 0, "replaced": 0, "closed_ended": 0}
+        self.max_open = 0
+
+    def open(self):
+        # The pool closes the connections of ended threads from another thread, so sqlite3 must not check the thread.
+        # Every connection is still used by its own thread only.
+        conn = sqlite3.connect(self.db_file, factory=PooledConnection, cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        conn.pool = self
+        conn.thread = threading.current_thread()
+        return conn
+
+    def connect(self):
+        """The connection of the calling thread. Close it when done like a normal one"""
+        ident = threading.get_ident()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked, the connections belong to the parent. Closing them here could hurt its transactions.
+                self.pid = os.getpid()
+                self.connections = {}
+            conn = self.connections.get(ident)
+            if conn is not None and conn.thread is not threading.current_thread():
+                conn = None # An ended thread had the same ident
+            if conn is None:
+                self.close_ended_threads()
+                conn = self.open()
+                self.connections[ident] = conn
+                self.stats_counters["opened"] += 1
+                self.max_open = max(self.max_open, len(self.connections))
+            else:
+                self.stats_counters["reused"] += 1
+
+        if conn.depth == 0 and time.monotonic() - conn.last_used > self.health_check_interval:
+            conn = self.check(conn, ident)
+        conn.depth += 1
+        return conn
+
+    def check(self, conn, ident):
+        """Runs a query on an idle connection, opens a new one if it fails"""
+        with self.lock:
+            self.stats_counters["health_checks"] += 1
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return conn
+        except sqlite3.Error as e:
+            self.logger.warning(f"Database connection failed the health check, opening a new one: {e}")
+        conn.really_close()
+        new_conn = self.open()
+        with self.lock:
+            self.connections[ident] = new_conn
+            self.stats_counters["replaced"] += 1
+        return new_conn
+
+    def release(self, conn):
+        conn.depth = max(0, conn.depth - 1)
+        if conn.depth:
+            return
+        conn.last_used = time.monotonic()
+        if conn.in_transaction:
+            # Whatever the caller did not commit is not kept for the next query of the thread
+            try:
+                conn.rollback()
+            except sqlite3.Error as e:
+                self.logger.warning(f"Rollback of a pooled database connection failed: {e}")
+        if conn.isolation_level != "":
+            conn.isolation_level = "" # A caller that started its transactions by hand, the next one expects the default
+
+    def close_ended_threads(self):
+        """Closes the connections of threads that ended. Called with self.lock held"""
+        for ident, conn in list(self.connections.items()):
+            if not conn.thread.is_alive():
+                del self.connections[ident]
+                conn.really_close()
+                self.stats_counters["closed_ended"] += 1
+
+    def stats(self):
+        with self.lock:
+            in_use = sum(1 for conn in self.connections.values() if conn.depth)
+            return dict(self.stats_counters, open=len(self.connections), in_use=in_use, max_open=self.max_open)
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(db_file):
+    """The pool of db_file, made the first time it is asked for"""
+    with pools_lock:
+        pool = pools.get(db_file)
+        if pool is None:
+            pool = pools[db_file] = ConnectionPool(db_file)
+        return pool
@@ -12,18 +12,43 @@ Admin accounts can be created only via this file."""
 
 
 
+import json
 import sqlite3
 from threading import Lock
+import ConnectionPool
 import ServerLogger
 
+
+# The columns of a task the clients get, with the usernames it is assigned to and created by. show_tasks and the
+# notifications use it. Created_by holds the username, the join only finds the rows that have a UserID there.
+TASK_SELECT = """
+    SELECT
+        t.TaskID,
+        t.TaskDescription,
+        t.DueDate,
+        t.Active,
+        u1.Username as AssignedToUsername,
+        COALESCE(u2.Username, t.Created_by) as CreatedByUsername
+    FROM tasks t
+    LEFT JOIN users u1 ON t.Assigned_to = u1.UserID
+    LEFT JOIN users u2 ON t.Created_by = u2.UserID"""
+
+# The change log Sync Tasks reads. Every CHANGE_LOG_COMPACT_EVERY versions the changes older than the last
+# CHANGE_LOG_SIZE are deleted, a client further behind gets all its tasks again.
+CHANGE_LOG_SIZE = 10000
+CHANGE_LOG_COMPACT_EVERY = 100
+MAX_SYNC_CHANGES = 2000 # A client with more changes to catch up on gets all its tasks, it is not much more
+
 class Database:
     def __init__(self, manager_db):
         self.manager_db = manager_db
         self.lock = Lock()
         self.logger = ServerLogger.server_logger
+        self.pool = ConnectionPool.get_pool(manager_db)
 
     def connect(self):
-        return sqlite3.connect(self.manager_db)
+        """The thread's connection from the pool, close() gives it back (see ConnectionPool.py)"""
+        return self.pool.connect()
 
 
     def create_table_users(self):
@@ -59,6 +84,130 @@ class Database:
         cursor.close()
         conn.close()
 
+    def create_table_task_version(self):
+        """One row with the version of the task list. Every created, updated or deleted task adds 1 to it in the same
+        transaction, the notifications and View Tasks carry it so the clients know if they missed a change."""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("""CREATE TABLE IF NOT EXISTS task_version(
+                                                            Id INTEGER PRIMARY KEY CHECK(Id = 1),
+                                                            Version INTEGER NOT NULL)""")
+        cursor.execute("INSERT OR IGNORE INTO task_version (Id, Version) VALUES (1, 0)")
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def create_table_task_changes(self):
+        """The log of the task changes, one row per version with the task and the users its notification went to.
+        Sync Tasks sends a client that reconnects only the tasks changed since the version it has."""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("""CREATE TABLE IF NOT EXISTS task_changes(
+                                                            Version INTEGER PRIMARY KEY,
+                                                            TaskID INTEGER NOT NULL,
+                                                            Deleted BOOLEAN NOT NULL,
+                                                            Users TEXT NOT NULL)""")
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def task_dict(self, task):
+        """A row of TASK_SELECT as the clients get it"""
+        return {
+            "TaskID": str(task[0]),
+            "Description": str(task[1])[:50],
+            "due_date": str(task[2]) if task[2] else "",
+            "active": "1" if task[3] else "0",
+            "assigned_to": str(task[4]) if task[4] else "",
+            "created_by": str(task[5]) if task[5] else ""
+        }
+
+    def task_users(self, cursor, task_id):
+        """The usernames a task is assigned to and created by, the users its notifications go to"""
+        cursor.execute(TASK_SELECT + " WHERE t.TaskID = ?", (task_id,))
+        task = cursor.fetchone()
+        return {username for username in (task[4], task[5]) if username} if task else set()
+
+    def record_change(self, cursor, task_id, deleted=False, users_before=()):
+        """Gives a task change the next version, in the transaction of the change. Returns what the notification
+        carries, the task as it is now or its id if it was deleted, and in "users" whose clients get it: the users of
+        the task now and before the change (users_before, task_users read before updating or deleting it). The change goes
+        into task_changes too, for Sync Tasks."""
+        cursor.execute("UPDATE task_version SET Version = Version + 1 WHERE Id = 1")
+        cursor.execute("SELECT Version FROM task_version WHERE Id = 1")
+        version = cursor.fetchone()[0]
+        if deleted:
+            change = {"version": version, "deleted": str(task_id), "users": sorted(users_before)}
+        else:
+            cursor.execute(TASK_SELECT + " WHERE t.TaskID = ?", (task_id,))
+            task = cursor.fetchone()
+            users = set(users_before) | {username for username in (task[4], task[5]) if username}
+            change = {"version": version, "task": self.task_dict(task), "users": sorted(users)}
+
+        cursor.execute("INSERT INTO task_changes (Version, TaskID, Deleted, Users) VALUES (?, ?, ?, ?)",
+                       (version, task_id, deleted, json.dumps(change["users"])))
+        if version % CHANGE_LOG_COMPACT_EVERY == 0:
+            cursor.execute("DELETE FROM task_changes WHERE Version <= ?", (version - CHANGE_LOG_SIZE,))
+        return change
+
+    def task_version(self):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT Version FROM task_version WHERE Id = 1").fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error as e:
+            self.logger.error(f"Database error reading the task version: {e}")
+            return None
+        finally:
+            conn.close()
+
+    def changes_since(self, version, username=None, max_changes=MAX_SYNC_CHANGES):
+        """The tasks changed after version, for Sync Tasks. One change per task, with the task as it is now or its id if
+        it was deleted. With a username only the tasks whose changes that user got notifications for.
+
+        Returns (the current version, the changes). The changes are None when the log cannot tell: it was compacted
+        past version, version is newer than the database (another database) or there are over max_changes rows to
+        read. The client needs all the tasks then."""
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN") # One read transaction, so the log and the tasks are of the same moment
+            current = conn.execute("SELECT Version FROM task_version WHERE Id = 1").fetchone()[0]
+            oldest = conn.execute("SELECT MIN(Version) FROM task_changes").fetchone()[0]
+            # The log has every change after this one. Empty, it has all of them after the current version.
+            logged_from = oldest - 1 if oldest is not None else current
+            if version < logged_from or version > current:
+                return current, None
+            rows = conn.execute("""SELECT Version, TaskID, Users FROM task_changes WHERE Version > ?
+                                   ORDER BY Version LIMIT ?""", (version, max_changes + 1)).fetchall()
+            if len(rows) > max_changes:
+                return current, None
+
+            latest = {} # task id -> version of its last change
+            wanted = set()
+            for change_version, task_id, users in rows:
+                latest[task_id] = change_version
+                if username is None or username in json.loads(users):
+                    wanted.add(task_id)
+            task_ids = sorted(wanted)
+            tasks = {}
+            for start in range(0, len(task_ids), 500): # SQLite takes at most 999 parameters
+                chunk = task_ids[start:start + 500]
+                for task in conn.execute(TASK_SELECT + f" WHERE t.TaskID IN ({','.join('?' * len(chunk))})", chunk):
+                    tasks[task[0]] = self.task_dict(task)
+
+            changes = []
+            for task_id in sorted(wanted, key=latest.get):
+                if task_id in tasks:
+                    changes.append({"version": latest[task_id], "task": tasks[task_id]})
+                else:
+                    changes.append({"version": latest[task_id], "deleted": str(task_id)})
+            return current, changes
+        except sqlite3.Error as e:
+            self.logger.error(f"Database error in changes_since: {e}")
+            return None, None
+        finally:
+            conn.close()
+
     def insert_user(self, username, password, role='user'):
         conn = self.connect()
         cursor = conn.cursor()
@@ -79,7 +228,7 @@ class Database:
             cursor.close()
             conn.close()
 
-    def insert_task(self, task_description, due_date, active, assigned_to =None, created_by=None):
+    def insert_task(self, task_description, due_date, active, assigned_to =None, created_by=None, changes=None):
         if assigned_to == None:
             assigned_to = created_by
         assigned_to = self.get_userID_fromDB(assigned_to)
@@ -90,7 +239,10 @@ class Database:
                 cursor.execute("""INSERT INTO tasks (TaskDescription, DueDate, active, Created_by, Assigned_to) 
                                   VALUES (?, ?, ?, ?, ?)""",
                                (task_description, due_date, active, created_by, assigned_to))
+                change = self.record_change(cursor, cursor.lastrowid)
                 conn.commit()
+                if changes is not None:
+                    changes.append(change)
                 return "Success"
         except sqlite3.Error as e:
             self.logger.error(f"Database error: {e}")
@@ -124,14 +276,18 @@ class Database:
 
 
 
-    def delete_task(self,TaskID):
+    def delete_task(self,TaskID, changes=None):
         conn = self.connect()
         cursor = conn.cursor()
         task_id_number = int(TaskID)
         try:
             with self.lock:
+                users_before = self.task_users(cursor, task_id_number)
                 cursor.execute("DELETE FROM tasks WHERE TaskID = ?", (task_id_number,))
+                change = self.record_change(cursor, task_id_number, True, users_before) if cursor.rowcount else None
                 conn.commit()
+                if changes is not None and change:
+                    changes.append(change)
             self.logger.info(f"Successfully deleted task with taskID {task_id_number}")
             return "Success"
         except sqlite3.Error as e:
@@ -140,23 +296,18 @@ class Database:
             cursor.close()
             conn.close()
 
-    def show_tasks(self):
+    def show_tasks(self, username=None):
+        """All the tasks, or with a username only the ones assigned to or created by that user"""
         conn = self.connect()
         cursor = conn.cursor()
         try:
             with self.lock:
                 # Select only essential fields and join with users table to get usernames
-                cursor.execute("""
-                    SELECT 
-                        t.TaskID,
-                        t.TaskDescription,
-                        t.DueDate,
-                        t.Active,
-                        u1.Username as AssignedToUsername
-                    FROM tasks t
-                    LEFT JOIN users u1 ON t.Assigned_to = u1.UserID
-                    ORDER BY t.TaskID DESC
-                """)
+                if username is None:
+                    cursor.execute(TASK_SELECT + " ORDER BY t.TaskID DESC")
+                else:
+                    cursor.execute(TASK_SELECT + " WHERE AssignedToUsername = ? OR CreatedByUsername = ? ORDER BY t.TaskID DESC",
+                                   (username, username))
                 conn.commit()
                 result = cursor.fetchall()
 
@@ -168,14 +319,7 @@ class Database:
                 tasks = []
                 for task in result:
                     try:
-                        task_dict = {
-                            "TaskID": str(task[0]),
-                            "Description": str(task[1])[:50],
-                            "due_date": str(task[2]) if task[2] else "",
-                            "active": "1" if task[3] else "0",
-                            "assigned_to": str(task[4]) if task[4] else ""
-                        }
-                        tasks.append(task_dict)
+                        tasks.append(self.task_dict(task))
                     except Exception as e:
                         self.logger.error(f"Error processing task row {task}: {e}")
                         continue
@@ -189,7 +333,7 @@ class Database:
             cursor.close()
             conn.close()
 
-    def update_task(self, task_id, description, due_date, active, assigned_to, updated_by):
+    def update_task(self, task_id, description, due_date, active, assigned_to, updated_by, changes=None):
         try:
             with self.lock:
                 conn = self.connect()
@@ -200,6 +344,7 @@ class Database:
                 if not assigned_to_id:
                     return "Failed"
 
+                users_before = self.task_users(cursor, task_id)
                 cursor.execute("""
                     UPDATE tasks 
                     SET TaskDescription = ?, 
@@ -208,8 +353,11 @@ class Database:
                         Assigned_to = ?
                     WHERE TaskID = ?
                 """, (description, due_date, active, assigned_to_id, task_id))
+                change = self.record_change(cursor, task_id, users_before=users_before) if cursor.rowcount else None
 
                 conn.commit()
+                if changes is not None and change:
+                    changes.append(change)
                 return "Success"
         except sqlite3.Error as e:
             self.logger.error(f"Database error: {e}")
@@ -218,6 +366,92 @@ class Database:
             cursor.close()
             conn.close()
 
+    def apply_task_batch(self, operation, items, changes=None):
+        """Creates, updates or deletes (operation) a list of tasks in one transaction. The items look like the message
+        of the single action. Returns a result for every item, or None if the transaction failed.
+        Every item has its own savepoint, so an item that fails is rolled back on its own and the others are kept.
+        The changes of the items that worked are added to changes, see record_change."""
+        with self.lock:
+            conn = self.connect()
+            conn.isolation_level = None # The transaction and the savepoints are started by hand
+            cursor = conn.cursor()
+            user_ids = {} # Usernames already looked up in this batch
+            results = []
+            batch_changes = []
+            try:
+                # IMMEDIATE takes the write lock now. A deferred BEGIN reads first and SQLite cannot upgrade that to a
+                # write lock while another connection writes, it fails at once instead of waiting out the busy timeout
+                cursor.execute("BEGIN IMMEDIATE")
+                for index, item in enumerate(items):
+                    cursor.execute("SAVEPOINT item")
+                    kept = len(batch_changes)
+                    try:
+                        result = self.apply_task_operation(cursor, operation, item, user_ids, batch_changes)
+                        cursor.execute("RELEASE SAVEPOINT item")
+                    except (sqlite3.Error, KeyError, TypeError, ValueError) as e:
+                        del batch_changes[kept:]
+                        cursor.execute("ROLLBACK TO SAVEPOINT item")
+                        cursor.execute("RELEASE SAVEPOINT item")
+                        result = {"result": "Failed", "error": f"Missing {e}" if isinstance(e, KeyError) else str(e)}
+                    result["index"] = index
+                    results.append(result)
+                cursor.execute("COMMIT")
+                if changes is not None:
+                    changes.extend(batch_changes)
+                return results
+            except sqlite3.Error as e:
+                self.logger.error(f"Database error in task batch: {e}")
+                if conn.in_transaction:
+                    conn.rollback()
+                return None
+            finally:
+                cursor.close()
+                conn.isolation_level = "" # The pooled connection goes on to the thread's next query, see ConnectionPool
+                conn.close()
+
+    def apply_task_operation(self, cursor, operation, item, user_ids, changes):
+        """One item of apply_task_batch, the same statements as insert_task, update_task and delete_task"""
+        def user_id(username):
+            if username not in user_ids:
+                cursor.execute("SELECT UserID FROM users WHERE Username = ?", (username,))
+                row = cursor.fetchone()
+                user_ids[username] = row[0] if row else None
+            if user_ids[username] is None:
+                raise ValueError(f"Unknown user {username}")
+            return user_ids[username]
+
+        if not isinstance(item, dict):
+            raise ValueError("Item is not an object")
+        if operation == "create":
+            assigned_to = user_id(item.get("assigned_to") or item["username"])
+            cursor.execute("""INSERT INTO tasks (TaskDescription, DueDate, active, Created_by, Assigned_to)
+                              VALUES (?, ?, ?, ?, ?)""",
+                           (item["description"], item["due_date"], item["active"], item["username"], assigned_to))
+            task_id = cursor.lastrowid
+            changes.append(self.record_change(cursor, task_id))
+            return {"result": "Success", "TaskID": task_id}
+
+        task_id = item["TaskID"] if operation == "update" else int(item["task_id"])
+        users_before = self.task_users(cursor, task_id)
+        if operation == "update":
+            cursor.execute("""
+                UPDATE tasks
+                SET TaskDescription = ?,
+                    DueDate = ?,
+                    Active = ?,
+                    Assigned_to = ?
+                WHERE TaskID = ?
+            """, (item["description"], item["due_date"], item["active"], user_id(item["assigned_to"]), task_id))
+        elif operation == "delete":
+            cursor.execute("DELETE FROM tasks WHERE TaskID = ?", (task_id,))
+        else:
+            raise ValueError(f"Unknown batch operation {operation}")
+
+        if cursor.rowcount == 0:
+            raise ValueError("No such task")
+        changes.append(self.record_change(cursor, task_id, operation == "delete", users_before))
+        return {"result": "Success"}
+
     def show_users(self):
         conn = self.connect()
         cursor = conn.cursor()
@@ -0,0 +1,118 @@
+"""This file runs the requests of all the clients in one bounded pool of worker threads.
+
+The read thread of a connection used to call the state machine itself, so while a View Tasks query ran the client's
+socket was not read. Now the read thread only puts the frame in the iBuffer and hands the connection to the dispatcher.
+
+Every connection has a lane (a queue of its tasks). A lane is run by one worker at a time and one task at a time, so the
+messages of a connection are still handled in the order they came. After each task the lane goes to the back of the
+pool's queue, so a client with many queued requests cannot keep the workers from everyone else. Tasks that do not need
+the order (requests with a request_id) can go straight to the pool with submit_unordered.
+
+The queue of a lane is not limited here. It gets one task per message in the connection's iBuffer, which is bounded.
+
+Each task records how long it waited in the queue and how long it ran. A long wait with a short run means the pool is
+too small (--workers), a long run is a slow query.
+"""
+
+
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import ServerLogger
+
+
+class Dispatcher:
+    def __init__(self, workers=16):
+        self.logger = ServerLogger.server_logger
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="request")
+        self.lock = threading.Lock()
+        self.lanes = {} # key (the connection) -> deque of tasks. A key is here while its lane is queued or running
+        self.stats_lock = threading.Lock()
+        self.tasks = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.max_run_seconds = 0.0
+
+    def submit(self, key, function, *args):
+        """Runs function(*args) after everything submitted before with the same key. Returns a Future of the result"""
+        task = (time.monotonic(), function, args, Future())
+        with self.lock:
+            lane = self.lanes.get(key)
+            idle = lane is None
+            if idle:
+                lane = self.lanes[key] = deque()
+            lane.append(task)
+        if idle:
+            try:
+                self.pool.submit(self.run_lane, key)
+            except RuntimeError as e: # The pool was shut down, the server is stopping
+                with self.lock:
+                    del self.lanes[key]
+                task[3].set_exception(e)
+        return task[3]
+
+    def submit_unordered(self, function, *args):
+        task = (time.monotonic(), function, args, Future())
+        self.pool.submit(self.run_task, task)
+        return task[3]
+
+    def run_lane(self, key):
+        with self.lock:
+            task = self.lanes[key].popleft()
+        self.run_task(task)
+        with self.lock:
+            if self.lanes[key]:
+                requeue = True
+            else:
+                del self.lanes[key]
+                requeue = False
+        if requeue:
+            try:
+                self.pool.submit(self.run_lane, key)
+            except RuntimeError: # The pool was shut down, the server is stopping
+                pass
+
+    def run_task(self, task):
+        queued, function, args, future = task
+        start = time.monotonic()
+        failed = False
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            failed = True
+            self.logger.error(f"Request task failed: {e}")
+            future.set_exception(e)
+        finally:
+            end = time.monotonic()
+            with self.stats_lock:
+                self.tasks += 1
+                self.failed += failed
+                self.wait_seconds += start - queued
+                self.max_wait_seconds = max(self.max_wait_seconds, start - queued)
+                self.run_seconds += end - start
+                self.max_run_seconds = max(self.max_run_seconds, end - start)
+
+    def stats(self):
+        with self.lock:
+            queued = sum(len(lane) for lane in self.lanes.values())
+            lanes = len(self.lanes)
+        with self.stats_lock:
+            tasks = self.tasks or 1
+            return {"workers": self.workers,
+                    "tasks": self.tasks,
+                    "failed": self.failed,
+                    "lanes": lanes,
+                    "queued": queued,
+                    "avg_wait_ms": round(self.wait_seconds / tasks * 1000, 3),
+                    "max_wait_ms": round(self.max_wait_seconds * 1000, 3),
+                    "avg_run_ms": round(self.run_seconds / tasks * 1000, 3),
+                    "max_run_ms": round(self.max_run_seconds * 1000, 3)}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -1,7 +1,7 @@
 """This file contains all encryption classes used in the task management system. (All encryption methods)
 The application uses various encrypion methods to provide safe communication between server and clients.
 
-The application uses 4 encryption methods.
+The application uses 4 encryption methods (and X25519 key agreement as the alternative to the RSA key exchange).
 
 Rsa Encryption -> Generates public and private keys for the server. -> Encrypts data using client's public keys -> Decrypts
 messages using the server's own private key.
@@ -17,6 +17,9 @@ knows who he communicates with
 It generates a 256-bit encryption key for every client.
 Encrypts and decrypts messages using this key.
 If client receives the key, he can encrypt and derypt messages too.
+
+CryptoServices holds what is the same for every connection (the server's RSA key and the hash helper). The server
+makes it once and every connection and state machine uses it, generating an RSA key costs hundreds of milliseconds.
 """
 
 
@@ -26,6 +29,10 @@ from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP #stands for Public Key Cryptography Standards ,enhances security by adding randomness and structure to the plaintext before encryption
 import hashlib
 from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Protocol.DH import key_agreement
+from Crypto.PublicKey import ECC
 import os
 
 
@@ -133,10 +140,45 @@ class CaesarCipher:
 
 
 
-class AESencryption:
+class CryptoServices:
+    """The server's crypto objects that are shared by all the connections. RsaEncryption and HashEncryption keep no
+    per-message state, so one of each is used from all the threads."""
+
+    def __init__(self, rsa_encryption=None):
+        self.rsa = rsa_encryption or RsaEncryption() # The host key, generated once when the server starts
+        self.hash = HashEncryption()
+
+
+class X25519KeyExchange:
+    """One side of an ephemeral X25519 key agreement. A new one is made for every handshake and thrown away after it.
+    The public keys go over the network as PEM, pycryptodome 3.21 cannot import raw X25519 keys."""
+
     def __init__(self):
+        self.private_key = ECC.generate(curve="curve25519")
+
+    def getPublicKey(self):
+        return self.private_key.public_key().export_key(format="PEM")
+
+    def derive_key(self, peer_public_key, client_public_key, server_public_key):
+        """The AES key. Both public keys go into the salt, so the key is bound to this handshake"""
+        salt = (client_public_key + server_public_key).encode("utf-8")
+        kdf = lambda secret: HKDF(secret, 32, salt, SHA256, context=b"task manager x25519")
+        peer_key = ECC.import_key(peer_public_key)
+        if peer_key.curve != "Curve25519" or peer_key.has_private():
+            raise ValueError("Received key is not an X25519 public key")
+        return key_agreement(static_priv=self.private_key, static_pub=peer_key, kdf=kdf)
+
+
+def derive_session_key(previous_key, client_nonce, server_nonce):
+    """The AES key of a resumed session. Both ends derive it from the key of the old connection and the nonces they
+    sent, so it is new for every connection and never goes over the network."""
+    return HKDF(previous_key, 32, client_nonce + server_nonce, SHA256, context=b"task manager session resume")
+
+
+class AESencryption:
+    def __init__(self, key=None):
         self.logger = ServerLogger.server_logger
-        self.key = os.urandom(32)
+        self.key = key or os.urandom(32)
 
 
     def encrypt_text(self, text):
@@ -156,6 +198,29 @@ class AESencryption:
         self.logger.debug(f"Text decrypted AES")
         return text.decode('utf-8')
 
+    # Binary envelope: nonce | tag | ciphertext as raw bytes. Used when both ends negotiate it in the handshake,
+    # instead of putting the 3 parts hexlified into a json message (which more than doubles every message).
+    NONCE_LENGTH = 12
+    TAG_LENGTH = 16
+
+    def encrypt_envelope(self, text):
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+
+        aesCipher = AES.new(self.key, AES.MODE_GCM, nonce=os.urandom(self.NONCE_LENGTH))
+        ciphertext, authTag = aesCipher.encrypt_and_digest(text)
+        return aesCipher.nonce + authTag + ciphertext
+
+    def decrypt_envelope(self, envelope):
+        if len(envelope) < self.NONCE_LENGTH + self.TAG_LENGTH:
+            raise ValueError("Envelope too short")
+        envelope = memoryview(envelope)
+        nonce = envelope[:self.NONCE_LENGTH]
+        authTag = envelope[self.NONCE_LENGTH:self.NONCE_LENGTH + self.TAG_LENGTH]
+        aesCipher = AES.new(self.key, AES.MODE_GCM, nonce=bytes(nonce))
+        # Returns bytes, the message may still be compressed
+        return aesCipher.decrypt_and_verify(envelope[self.NONCE_LENGTH + self.TAG_LENGTH:], bytes(authTag))
+
 
     def get_key(self):
         return self.key
@@ -0,0 +1,151 @@
+"""This file remembers the task changes the clients already made, so a client can send one again without doing it twice.
+
+When the connection drops after a client sent a Create Task, the client does not know if the task was created. Sending it
+again could create it twice, and checking costs a whole View Tasks. So the client puts an "idempotency_key" (a random
+string it makes once per change) in Create/Update/Delete Task and the batch actions. The server stores the key with the
+response it sent. A request with a key it already has is not run again, the client gets the stored response back
+(with "replayed": True) and nobody gets a notification for it. Only responses of changes that were made are stored,
+a request that failed (the database was locked, say) runs again when the client retries it.
+
+The keys are per user and live in a table of task_manager.db, so they are the same for every worker of the Supervisor
+and survive a restart. They are kept for ttl seconds and at most max_keys of them, the oldest are deleted first. A key
+sent again with a different action or message gets "Failed", the client made a mistake.
+
+A request whose key is still running (the client reconnected and sent it again before the first one answered) gets a
+"Retry Later". That is checked in this process only, with the Supervisor 2 workers could both run it in that moment.
+The key is stored after the change is committed, so a server that dies between the 2 can still run a retry again.
+"""
+
+
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import ConnectionPool
+import ServerLogger
+
+
+IDEMPOTENCY_TTL = 3600 # Seconds a key is remembered, as long as a session ticket lets a client reconnect
+MAX_IDEMPOTENCY_KEYS = 100000
+MAX_KEY_LENGTH = 128
+RUNNING_RETRY_AFTER = 0.5 # Seconds a client waits before sending a request again whose key is still running
+
+# What begin() found
+NEW = "new"
+REPLAY = "replay"
+RUNNING = "running"
+CONFLICT = "conflict"
+
+
+def fingerprint(message):
+    """A hash of the request, to tell a real retry from another request that reused the key"""
+    return hashlib.sha256(json.dumps(message, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, db_file="task_manager.db", ttl=IDEMPOTENCY_TTL, max_keys=MAX_IDEMPOTENCY_KEYS):
+        self.logger = ServerLogger.server_logger
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.running = set() # (username, key) of the requests being handled right now
+        self.stats = {"stored": 0, "replayed": 0, "running": 0, "conflicts": 0, "expired": 0, "evicted": 0}
+        self.create_table()
+
+    def connect(self):
+        return ConnectionPool.get_pool(self.db_file).connect()
+
+    def create_table(self):
+        conn = self.connect()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS idempotency_keys(
+                                                            Username VARCHAR(50) NOT NULL,
+                                                            IdempotencyKey VARCHAR(128) NOT NULL,
+                                                            Action TEXT NOT NULL,
+                                                            Fingerprint TEXT NOT NULL,
+                                                            Response TEXT NOT NULL,
+                                                            CreatedAt REAL NOT NULL,
+                                                            PRIMARY KEY (Username, IdempotencyKey))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys(CreatedAt)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def begin(self, username, key, action, request_hash):
+        """Called before running a request with a key. Returns (NEW, None) if it has to run, (REPLAY, the stored
+        response), (RUNNING, None) or (CONFLICT, None). After NEW the caller must call finish()."""
+        with self.lock:
+            if (username, key) in self.running:
+                self.stats["running"] += 1
+                return RUNNING, None
+            self.running.add((username, key)) # Before the lookup, so a second retry does not run it too
+        stored = self.lookup(username, key)
+        if stored is None:
+            return NEW, None
+
+        stored_action, stored_hash, response = stored
+        with self.lock:
+            self.running.discard((username, key))
+            if stored_action != action or stored_hash != request_hash:
+                self.stats["conflicts"] += 1
+                return CONFLICT, None
+            self.stats["replayed"] += 1
+            return REPLAY, response
+
+    def finish(self, username, key, action, request_hash, response):
+        """Stores the response of a request begin() said to run. response None (the handler failed) stores nothing,
+        so the client can try again."""
+        try:
+            if response is not None:
+                self.store(username, key, action, request_hash, response)
+        finally:
+            with self.lock:
+                self.running.discard((username, key))
+
+    def lookup(self, username, key):
+        conn = self.connect()
+        try:
+            row = conn.execute("""SELECT Action, Fingerprint, Response FROM idempotency_keys
+                                  WHERE Username = ? AND IdempotencyKey = ? AND CreatedAt > ?""",
+                               (username, key, time.time() - self.ttl)).fetchone()
+        except sqlite3.Error as e:
+            self.logger.error(f"Database error looking up idempotency key: {e}")
+            return None
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def store(self, username, key, action, request_hash, response):
+        """Stores a response and deletes the expired keys and the oldest ones over max_keys"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("""INSERT OR REPLACE INTO idempotency_keys
+                                (Username, IdempotencyKey, Action, Fingerprint, Response, CreatedAt)
+                                VALUES (?, ?, ?, ?, ?, ?)""",
+                             (username, key, action, request_hash, json.dumps(response), time.time()))
+                expired = conn.execute("DELETE FROM idempotency_keys WHERE CreatedAt <= ?",
+                                       (time.time() - self.ttl,)).rowcount
+                # The rowids grow with every insert, so the newest max_keys rows are the ones over this. A cheap
+                # bound without counting the table, after deletes it keeps a few less.
+                evicted = conn.execute("""DELETE FROM idempotency_keys
+                                          WHERE rowid <= (SELECT MAX(rowid) FROM idempotency_keys) - ?""",
+                                       (self.max_keys,)).rowcount
+            with self.lock:
+                self.stats["stored"] += 1
+                self.stats["expired"] += expired
+                self.stats["evicted"] += evicted
+        except sqlite3.Error as e:
+            self.logger.error(f"Database error storing idempotency key: {e}")
+        finally:
+            conn.close()
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.stats, running_now=len(self.running))
@@ -0,0 +1,102 @@
+"""This file sends the task notifications. The changes are collected for a short window and go out together.
+
+Before, every change was broadcast on its own. A user saving 50 tasks one after another sent 50 notifications to every
+client. Now notification() only hands the changes to the notifier. Its thread waits until no new change came for
+window seconds and then sends one notification with all of them to every client (and to the other workers, see
+Supervisor.py). While changes keep coming it still sends at the latest max_delay seconds after the first one, so a
+busy server does not hold the notifications back forever.
+
+window 0 sends every change right away, like before.
+
+stats() tells how many notifications the window saved: changes published minus notifications broadcast.
+"""
+
+
+
+import threading
+import time
+
+import ServerLogger
+
+
+NOTIFICATION_WINDOW = 0.1 # Seconds without a new change before the notification goes out
+NOTIFICATION_MAX_DELAY = 0.5 # Seconds the first change of a notification waits at most
+MAX_NOTIFICATION_CHANGES = 1000 # A notification with this many changes goes out right away
+
+
+class Notifier:
+    def __init__(self, send, window=NOTIFICATION_WINDOW, max_delay=NOTIFICATION_MAX_DELAY):
+        self.logger = ServerLogger.server_logger
+        self.send = send # Called with the notification message
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self.condition = threading.Condition()
+        self.pending = [] # Changes waiting to be sent
+        self.first_change = 0.0 # When the oldest pending change came
+        self.last_change = 0.0
+        self.running = True
+        self.published = 0
+        self.changes = 0
+        self.broadcasts = 0
+        self.max_wait_seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name="notifier", daemon=True)
+        self.thread.start()
+
+    def publish(self, changes):
+        """Queues changed tasks (see Database.record_change) for the next notification"""
+        now = time.monotonic()
+        with self.condition:
+            if not self.pending:
+                self.first_change = now
+            self.pending.extend(changes)
+            self.last_change = now
+            self.published += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending: # Stopped and nothing left to send
+                    return
+                # Wait for the window to pass without a new change, but not past max_delay
+                while self.running and len(self.pending) < MAX_NOTIFICATION_CHANGES:
+                    now = time.monotonic()
+                    deadline = min(self.last_change + self.window, self.first_change + self.max_delay)
+                    if now >= deadline:
+                        break
+                    self.condition.wait(deadline - now)
+                changes, self.pending = self.pending, []
+                waited = time.monotonic() - self.first_change
+            self.broadcast(changes, waited)
+
+    def broadcast(self, changes, waited):
+        changes.sort(key=lambda change: change["version"]) # Changes of other threads can be published out of order
+        message = {"action": "notification",
+                   "message": "A task has been created or modified",
+                   "changes": changes}
+        try:
+            self.send(message)
+        except Exception as e:
+            self.logger.error(f"Error sending notification: {e}")
+        with self.condition:
+            self.changes += len(changes)
+            self.broadcasts += 1
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def stop(self):
+        """Sends what is still pending and stops the thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def stats(self):
+        with self.condition:
+            return {"published": self.published,
+                    "changes": self.changes,
+                    "broadcasts": self.broadcasts,
+                    "saved": self.published - self.broadcasts,
+                    "pending": len(self.pending),
+                    "max_wait_ms": round(self.max_wait_seconds * 1000, 3)}
@@ -0,0 +1,122 @@
+"""This file limits how often the clients can send each action, so one client cannot keep SQLite busy for everybody.
+
+The limits are token buckets. A bucket holds up to burst tokens and gets rate tokens a second, every request takes one.
+There are 2 buckets for every request: one of the connection and one of the logged in user (all the connections of the
+user share it). A request that does not find a token in both is not run. The client gets a "Retry Later" response with
+the seconds until it would get one.
+
+Limits are set per action. Actions without their own limit share one bucket, "*". With the Supervisor every worker has
+its own user buckets, so a user with connections on 2 workers gets the user limit twice.
+
+The counters (stats()) are logged when the server stops, and a warning is logged when a bucket starts rejecting.
+"""
+
+
+
+import threading
+import time
+
+import ServerLogger
+
+
+ANY_ACTION = "*"
+
+# action -> (tokens per second, burst)
+CONNECTION_LIMITS = {"login": (1, 5), # Guessing passwords
+                     "signup": (0.2, 3),
+                     "View Tasks": (5, 10), # The client asks for the tasks again after every notification
+                     "View Users": (2, 5),
+                     ANY_ACTION: (20, 40)}
+USER_LIMITS = {"View Tasks": (10, 20),
+               ANY_ACTION: (40, 80)}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.limited = False # Rejecting since the last request that got through
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until the bucket has a token"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, connection_limits=None, user_limits=None):
+        self.logger = ServerLogger.server_logger
+        self.connection_limits = CONNECTION_LIMITS if connection_limits is None else connection_limits
+        self.user_limits = USER_LIMITS if user_limits is None else user_limits
+        self.lock = threading.Lock()
+        self.user_buckets = {} # (username, action) -> TokenBucket. The connection's are on the connection
+        self.allowed = 0
+        self.rejected = {"connection": {}, "user": {}} # scope -> action -> count
+
+    def bucket(self, buckets, limits, key, action):
+        """Returns (the action the limit is for, its bucket). The bucket is None if there is no limit for action"""
+        limit = limits.get(action)
+        if limit is None:
+            action, limit = ANY_ACTION, limits.get(ANY_ACTION)
+            if limit is None:
+                return action, None
+        bucket = buckets.get((key, action))
+        if bucket is None:
+            bucket = buckets[(key, action)] = TokenBucket(*limit)
+        return action, bucket
+
+    def check(self, connection, username, action):
+        """Takes a token for the request. Returns 0 if it can run, otherwise the seconds the client should wait"""
+        now = time.monotonic()
+        with self.lock:
+            scopes = [("connection", *self.bucket(connection.rateBuckets, self.connection_limits, None, action))]
+            if username:
+                scopes.append(("user", *self.bucket(self.user_buckets, self.user_limits, username, action)))
+
+            wait = 0.0
+            for scope, limited_action, bucket in scopes:
+                if bucket is None:
+                    continue
+                bucket.refill(now)
+                if bucket.tokens < 1:
+                    wait = max(wait, bucket.wait_time())
+                    # Counted under the limit's action, made up action names all count as "*"
+                    self.rejected[scope][limited_action] = self.rejected[scope].get(limited_action, 0) + 1
+                    if not bucket.limited:
+                        bucket.limited = True
+                        self.logger.warning(f"Rate limit of {limited_action} reached for {scope} "
+                                            f"{username if scope == 'user' else connection.address}")
+
+            if wait:
+                return wait
+            # Only a request that runs takes its tokens
+            for _, _, bucket in scopes:
+                if bucket is not None:
+                    bucket.tokens -= 1
+                    bucket.limited = False
+            self.allowed += 1
+            return 0.0
+
+    def stats(self):
+        with self.lock:
+            return {"allowed": self.allowed,
+                    "rejected": sum(sum(actions.values()) for actions in self.rejected.values()),
+                    "rejected_connection": dict(self.rejected["connection"]),
+                    "rejected_user": dict(self.rejected["user"])}
+
+
+def parse_limit(text):
+    """Reads a limit given on the command line, 'View Tasks=5/10' -> ("View Tasks", (5.0, 10.0))"""
+    action, _, limit = text.rpartition("=")
+    rate, _, burst = limit.partition("/")
+    if not action or not rate:
+        raise ValueError(f"Invalid rate limit {text!r}, expected ACTION=RATE/BURST")
+    rate = float(rate)
+    if rate <= 0:
+        raise ValueError(f"Invalid rate limit {text!r}, the rate must be over 0")
+    return action, (rate, float(burst) if burst else max(rate, 1.0))
@@ -9,29 +9,110 @@ shutdowns gracefully, closing all threads and the socket."""
 
 
 
+import argparse
 import json
+import select
 import socket
 import ServerLogger
 import threading
-from ServerLib import ConnectionHandler
+import ServerLib
+from ServerLib import ConnectionHandler, MAX_WRITE_BATCH
 from StateMachine import StateMachine, State
+from Authentication import admin_right
 import Encryption
+import Protocol
+from Sessions import SessionTickets, SESSION_LIFETIME, MAX_SESSIONS
 from Crypto.PublicKey import RSA
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from Dispatcher import Dispatcher
+from RateLimits import RateLimiter
+import RateLimits
+from Idempotency import IdempotencyStore, IDEMPOTENCY_TTL, MAX_IDEMPOTENCY_KEYS
+import ConnectionPool
+import Database
+from Notifier import Notifier, NOTIFICATION_WINDOW, NOTIFICATION_MAX_DELAY
+
+
+# Time each phase of the handshake gets. hello -> receiving the client's hello (or legacy public key),
+# reply -> sending the server's public key and the encrypted AES key back.
+HELLO_TIMEOUT = 10
+REPLY_TIMEOUT = 10
 
 
 class Server:
-    def __init__(self, ADDRESS, PORT):
+    def __init__(self, ADDRESS, PORT, compression_threshold=Protocol.COMPRESSION_THRESHOLD, request_workers=16, max_in_flight=8,
+                 handshake_workers=16, max_pending_handshakes=256, hello_timeout=HELLO_TIMEOUT, reply_timeout=REPLY_TIMEOUT,
+                 session_lifetime=SESSION_LIFETIME, max_sessions=MAX_SESSIONS, key_exchanges=Protocol.SUPPORTED_KEY_EXCHANGE,
+                 max_write_batch=MAX_WRITE_BATCH, max_output_messages=ServerLib.MAX_OUTPUT_MESSAGES,
+                 max_output_bytes=ServerLib.MAX_OUTPUT_BYTES, slow_consumer_policy=ServerLib.POLICY_COALESCE,
+                 max_frame_size=Protocol.MAX_FRAME_SIZE, connection_rate_limits=None, user_rate_limits=None,
+                 idempotency_ttl=IDEMPOTENCY_TTL, max_idempotency_keys=MAX_IDEMPOTENCY_KEYS,
+                 notification_window=NOTIFICATION_WINDOW, notification_max_delay=NOTIFICATION_MAX_DELAY,
+                 listen_socket=None, crypto=None, ticket_key=None):
         self.ADDRESS = ADDRESS
         self.PORT = PORT
+        self.compression_threshold = compression_threshold # Messages smaller than this are not compressed
         self.logger = ServerLogger.server_logger
         self.running = True
+        # The connection registry. These are copy on write: they are changed only under self.lock, by building a new
+        # dict/frozenset and swapping it in, never in place. So the notifier, buffer_stats and process_message read
+        # them without the lock, and a big broadcast does not hold back the logins and disconnects.
         self.state_machines = {}
         self.active_connections = {}
-        self.lock = threading.Lock()
+        # The logged in connections by username, and the ones of admins. A task notification goes to the users of the
+        # task and to the admins only, see notify_clients. Kept with login (index_connection) and close_client.
+        self.user_connections = {} # username -> frozenset of connections
+        self.admin_connections = frozenset()
+        self.lock = threading.Lock() # Taken by the writers of the registry only
         self.listen_thread = threading.Thread(target=self.listen)
         self.state = State.Start
-        self.RsaEncryption = Encryption.RsaEncryption()
+        self.crypto = crypto or Encryption.CryptoServices() # One host key for all the connections
+        self.RsaEncryption = self.crypto.rsa
+        self.sessions = SessionTickets(session_lifetime, max_sessions, ticket_key) # Lets logged in clients reconnect without RSA
+        self.key_exchanges = key_exchanges # The key exchanges a client can pick in its hello (rsa, x25519)
+
+        # The requests of all the clients run in the dispatcher's pool, so a read thread never waits for the database.
+        # Each client's messages are handled in order, except the ones with a request_id: a client can have up to
+        # max_in_flight of those running at once, so a slow View Tasks does not hold back a quick update.
+        self.dispatcher = Dispatcher(request_workers)
+        self.max_in_flight = max_in_flight
+        # Requests over these limits get a Retry Later instead of running, see RateLimits.py
+        self.rate_limiter = RateLimiter(connection_rate_limits, user_rate_limits)
+        # Task changes sent again with the same idempotency key get the first response instead of running twice
+        self.idempotency = IdempotencyStore("task_manager.db", idempotency_ttl, max_idempotency_keys)
+        Database.Database("task_manager.db").create_table_task_version() # The version the notifications carry
+        Database.Database("task_manager.db").create_table_task_changes() # What Sync Tasks sends
+        self.max_write_batch = max_write_batch # Frames a connection sends with one system call at most
+        self.max_frame_size = max_frame_size # A client sending a larger frame is disconnected
+
+        # The listen thread only accepts. Handshakes run in their own pool so a slow client cannot hold the other
+        # logins back. Connections over max_pending_handshakes (running + waiting for a worker) are closed right away.
+        self.handshake_pool = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix="handshake")
+        self.pending_handshakes = threading.BoundedSemaphore(max_pending_handshakes)
+        self.hello_timeout = hello_timeout
+        self.reply_timeout = reply_timeout
+        self.handshake_stats = {"completed": 0, "failed": 0, "timed_out": 0, "rejected": 0}
+        self.handshake_stats_lock = threading.Lock()
+
+        # Caps of every client's oBuffer and what to do with a client that crosses them (see ServerLib.OutputBuffer)
+        if slow_consumer_policy not in ServerLib.SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.max_output_messages = max_output_messages
+        self.max_output_bytes = max_output_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self.evicted_connections = 0
+        self.eviction_lock = threading.Lock() # Evictions happen on the notifier thread and the request threads
+
+        # A worker of the Supervisor gets the listening socket it shares with the other workers. Connecting to it
+        # would not wake this worker's accept up (the connection can go to any worker), so quit_server uses a pipe.
+        self.listen_socket = listen_socket
+        self.wake_reader, self.wake_writer = socket.socketpair() if listen_socket else (None, None)
+        # Called with every notification, the Supervisor's workers pass it on to the other workers
+        self.on_notification = lambda message: None
+        # Task changes are collected for notification_window seconds and sent in one notification, see Notifier.py
+        self.notifier = Notifier(self.broadcast_notification, notification_window, notification_max_delay)
 
 
     def start_listen_thread(self):
@@ -41,111 +122,303 @@ class Server:
     # Listens for clients.
     def listen(self):
         self.logger.debug("Listening thread started")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ADDRESS, self.PORT))
-            s.listen(5)
+        with self.open_listen_socket() as s:
             self.logger.info(f"Server listening on {self.ADDRESS}:{self.PORT}")
 
             while self.running:
                 try:
-                    client_socket, client_address = s.accept()
+                    client_socket, client_address = self.accept_client(s)
+                    if client_socket is None: # Woken up by quit_server, or another worker took the client
+                        continue
+                    if not self.running: # The connection quit_server makes to wake accept up
+                        client_socket.close()
+                        break
                     self.logger.info(f"Accepted connection from {client_address}")
 
+                    if self.admit_handshake(client_socket, client_address):
+                        self.handshake_pool.submit(self.handshake, client_socket, client_address)
 
+                except socket.error as e:
+                    self.logger.error(f"Socket accept error: {e}")
+                    continue
 
-                    # RSA Key exchange protocol - The server sends its public key, it receives the client's public key,
-                    # verifies if it has indeed
-                    #received the whole key and validates the key.
-
-                    # Set a timeout for the key exchange
-                    client_socket.settimeout(30)
-
-                    try:
-                        # Send server's public key with length prefix
-                        server_public_key = self.RsaEncryption.getPublicKey()
-                        key_length = len(server_public_key)
-                        length_header = str(key_length).zfill(4).encode('utf-8')
-
-                        self.logger.info(f"Sending public key (length: {key_length})")
-                        client_socket.sendall(length_header)
-                        client_socket.sendall(server_public_key)
-
-                        # Receive client's public key with length prefix
-                        self.logger.info("Waiting for client's public key...")
-                        length_data = client_socket.recv(4)
-                        if not length_data:
-                            raise ConnectionError("No key length received from client")
-
-                        key_length = int(length_data.decode('utf-8'))
-                        self.logger.info(f"Expecting client key of length: {key_length}")
-
-                        # Receive the full key
-                        client_public_key_data = b""
-                        while len(client_public_key_data) < key_length:
-                            remaining = key_length - len(client_public_key_data)
-                            chunk = client_socket.recv(min(remaining, 2048))
-                            if not chunk:
-                                raise ConnectionError("Connection closed while receiving key")
-                            client_public_key_data += chunk
-
-                        self.logger.info(f"Received client's public key, length: {len(client_public_key_data)}")
-
-                        # Validate the key- Checks if the key given is indeed a public key and not a private key or invalid data
-                        try:
-                            client_public_key = RSA.import_key(client_public_key_data)
-                            if not client_public_key.has_private():
-                                self.logger.info("Successfully validated client's public key")
-                            else:
-                                raise ValueError("Received key is not a public key")
-                        except (ValueError, TypeError) as e:
-                            raise ValueError(f"Invalid public key received: {e}")
-
-
-
-                        # AES key exchange protocol
-
-                        #Create an aes instanse and get the key
-                        aes_encryption = Encryption.AESencryption()
-                        aes_key = aes_encryption.get_key()
-
-
-                        #encrypt the key using rsa
-                        encryptedAESkey = self.RsaEncryption.encrypt(aes_key,client_public_key)
-
-
-                        #Send the key to the client with the length and header
-                        key_length = len(encryptedAESkey)
-                        length_header = str(key_length).zfill(4).encode('utf-8')
-                        self.logger.debug(f"Sending encrypted AES key (length: {key_length})")
-                        client_socket.sendall(length_header)
-                        client_socket.sendall(encryptedAESkey.encode('utf-8'))
-
-
-                        # Create connection handler and state machine
-                        connection = ConnectionHandler(client_socket, client_address, client_public_key,self.RsaEncryption,aes_encryption)
-
-
+    def open_listen_socket(self):
+        if self.listen_socket:
+            return self.listen_socket
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.ADDRESS, self.PORT))
+        s.listen(128) # Room for every client reconnecting at once after a restart
+        return s
+
+    def accept_client(self, s):
+        """Waits for the next client. Returns (None, None) if there is no client to accept after all"""
+        if self.wake_reader is None:
+            return s.accept()
+
+        # The shared socket is non-blocking. Every worker is woken up for a new client and only one of them gets it
+        readable, _, _ = select.select([s, self.wake_reader], [], [])
+        if self.wake_reader in readable:
+            return None, None
+        try:
+            return s.accept()
+        except BlockingIOError:
+            return None, None
+
+    def wake_listener(self):
+        if self.wake_writer:
+            self.wake_writer.send(b"\0")
+            return
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.connect((self.ADDRESS, self.PORT))
+        except OSError:
+            pass
 
-                        state_machine = StateMachine(connection, client_public_key, self)
-                        connection.set_state_machine(state_machine)
+    def admit_handshake(self, client_socket, client_address):
+        """Takes a pending handshake slot for a new client, or closes it when there are too many already"""
+        if self.pending_handshakes.acquire(blocking=False):
+            return True
+        self.logger.warning(f"Too many pending handshakes, closing {client_address}")
+        self.count_handshake("rejected")
+        client_socket.close()
+        return False
+
+    def count_handshake(self, result):
+        with self.handshake_stats_lock:
+            self.handshake_stats[result] += 1
+
+    def handshake(self, client_socket, client_address):
+        """Runs in the handshake pool. Exchanges the keys and starts the connection"""
+        try:
+            client_public_key, aes_encryption, options, session = self.key_exchange(client_socket)
 
-                        with self.lock:
-                            self.active_connections[connection] = state_machine
-                            self.state_machines[connection] = state_machine
+            # Create connection handler and state machine
+            connection = ConnectionHandler(client_socket, client_address, client_public_key,self.RsaEncryption,aes_encryption,
+                                           options=options)
+            self.register_connection(connection, client_public_key, session)
 
-                        # Set up message handling and start the connection
-                        connection.on_message_ready = lambda conn=connection: self.process_message(conn)
-                        connection.start()
+            # Set up message handling and start the connection
+            connection.on_message_ready = lambda conn=connection: self.dispatcher.submit(conn, self.process_message, conn)
+            connection.start()
+            self.count_handshake("completed")
 
-                    except Exception as e:
-                        self.logger.error(f"Key exchange failed: {e}")
-                        client_socket.close()
-                        continue
+        except Exception as e:
+            self.handshake_failed(client_socket, client_address, e)
+        finally:
+            self.pending_handshakes.release()
+
+    def handshake_failed(self, client_socket, client_address, error):
+        if isinstance(error, socket.timeout):
+            self.logger.warning(f"Key exchange with {client_address} timed out")
+            self.count_handshake("timed_out")
+        else:
+            self.logger.error(f"Key exchange failed: {error}")
+            self.count_handshake("failed")
+        client_socket.close()
+
+    def key_exchange(self, client_socket):
+        """Runs the handshake on a freshly accepted (blocking) socket. Used by both server engines.
+        Returns the client's public key, the AES encryption of the connection, the negotiated options and the session
+        when the client resumed one with its ticket (None otherwise)."""
+
+        # Handshake - A new client starts with a hello that carries its public key and the protocol options it
+        # supports. An old client starts straight away with its public key behind a 4 digit length header.
+        # The first 4 bytes tell them apart, so both can connect while the clients get updated.
+
+        # Each phase has a deadline, a client that sends its hello one byte at a time cannot stretch it
+        deadline = time.monotonic() + self.hello_timeout
+
+        prefix = Protocol.recv_exact(client_socket, len(Protocol.HANDSHAKE_MAGIC), deadline)
+        if prefix == Protocol.HANDSHAKE_MAGIC:
+            hello = Protocol.recv_handshake_body(client_socket, deadline)
+            options = Protocol.negotiate(hello, self.compression_threshold, self.key_exchanges)
+            self.logger.info(f"Client hello received, negotiated {options}")
+
+            if hello.get("resume"):
+                resumed = self.resume_session(client_socket, hello, options)
+                if resumed:
+                    return resumed
+                # The ticket could not be used, the client gets the full handshake in the same round trip
+
+            if options["key_exchange"] is None:
+                # Tell the client why, then close. Falling back to RSA would fail anyway without its RSA key
+                client_socket.settimeout(self.reply_timeout)
+                Protocol.send_handshake(client_socket, {"error": f"No common key exchange, the server allows {', '.join(self.key_exchanges)}"})
+                raise ValueError(f"No common key exchange, the client offered {hello.get('key_exchange')}")
+
+            if options["key_exchange"] == Protocol.KEY_EXCHANGE_X25519:
+                return self.x25519_exchange(client_socket, hello, options)
+            client_public_key_data = hello["public_key"].encode('utf-8')
+        else:
+            # Receive client's public key with length prefix
+            self.logger.info("Waiting for client's public key...")
+            client_public_key_data = Protocol.recv_legacy_block(client_socket, prefix, deadline)
+            hello = None
+            options = dict(Protocol.LEGACY_OPTIONS)
+
+        self.logger.info(f"Received client's public key, length: {len(client_public_key_data)}")
+
+        # Validate the key- Checks if the key given is indeed a public key and not a private key or invalid data
+        try:
+            client_public_key = RSA.import_key(client_public_key_data)
+            if not client_public_key.has_private():
+                self.logger.info("Successfully validated client's public key")
+            else:
+                raise ValueError("Received key is not a public key")
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid public key received: {e}")
+
+
+
+        # AES key exchange protocol
+
+        #Create an aes instanse and get the key
+        aes_encryption = Encryption.AESencryption()
+        aes_key = aes_encryption.get_key()
+
+
+        #encrypt the key using rsa
+        encryptedAESkey = self.RsaEncryption.encrypt(aes_key,client_public_key)
+
+
+        server_public_key = self.RsaEncryption.getPublicKey()
+        client_socket.settimeout(self.reply_timeout)
+        if hello is None:
+            # Send server's public key and the AES key with length prefix
+            self.logger.info(f"Sending public key (length: {len(server_public_key)})")
+            Protocol.send_legacy_block(client_socket, server_public_key)
+            self.logger.debug(f"Sending encrypted AES key (length: {len(encryptedAESkey)})")
+            Protocol.send_legacy_block(client_socket, encryptedAESkey.encode('utf-8'))
+        else:
+            reply = dict(options)
+            reply["public_key"] = server_public_key.decode('utf-8')
+            reply["aes_key"] = encryptedAESkey
+            Protocol.send_handshake(client_socket, reply)
+
+        return client_public_key, aes_encryption, options, None
+
+    def x25519_exchange(self, client_socket, hello, options):
+        """The key exchange of a client that picked x25519. The server makes an ephemeral key, both ends derive the
+        same AES key from the shared secret, and the AES key itself never goes over the network."""
+        ecdh = Encryption.X25519KeyExchange()
+        server_ecdh_key = ecdh.getPublicKey()
+        aes_key = ecdh.derive_key(hello["ecdh_public_key"], hello["ecdh_public_key"], server_ecdh_key)
+
+        reply = dict(options)
+        reply["public_key"] = self.RsaEncryption.getPublicKey().decode('utf-8')
+        reply["ecdh_public_key"] = server_ecdh_key
+        client_socket.settimeout(self.reply_timeout)
+        Protocol.send_handshake(client_socket, reply)
+        return None, Encryption.AESencryption(aes_key), options, None
+
+    def resume_session(self, client_socket, hello, options):
+        """The symmetric handshake of a client that sent a session ticket. No RSA, the new AES key is derived from the
+        old one. The reply carries a new ticket because every ticket works only once."""
+        session = self.sessions.redeem(hello["resume"])
+        if session is None:
+            return None
+
+        # The role is read again, an admin demoted since the login does not stay admin through the ticket
+        if session["state"] in (State.Dashboard.name, State.AdminDashboard.name):
+            session["state"] = State.AdminDashboard.name if admin_right(session["username"]) else State.Dashboard.name
+
+        server_nonce = os.urandom(16)
+        aes_key = Encryption.derive_session_key(session["key"], bytes.fromhex(hello["resume_nonce"]), server_nonce)
+        # The new ticket keeps the expiry of the login, so a client still has to log in again after the lifetime
+        ticket, session["id"] = self.sessions.issue(aes_key, session["username"], session["state"], session["expires"])
+
+        reply = dict(options)
+        reply["session"] = {"server_nonce": server_nonce.hex(),
+                            "ticket": ticket,
+                            "lifetime": max(0, int(session["expires"] - time.time())),
+                            "username": session["username"],
+                            "state": session["state"]}
+        client_socket.settimeout(self.reply_timeout)
+        Protocol.send_handshake(client_socket, reply)
+        self.logger.info(f"Session of {session['username']} resumed")
+        return None, Encryption.AESencryption(aes_key), options, session
+
+    def issue_session_ticket(self, connection, username, state):
+        """Gives a logged in client a ticket to resume its session with, if it supports them"""
+        if not connection.options.get("session_tickets"):
+            return
+        ticket, session_id = self.sessions.issue(connection.AesEncryption.get_key(), username, state.name)
+        if connection.sessionId:
+            self.sessions.revoke(connection.sessionId)
+        connection.sessionId = session_id
+        connection.pushMessage({"action": "Session Ticket",
+                                "message": {"ticket": ticket, "lifetime": self.sessions.lifetime}})
+
+    def register_connection(self, connection, client_public_key, session=None):
+        """Creates the state machine of a new connection and adds it to the active connections"""
+        connection.inFlight = threading.BoundedSemaphore(self.max_in_flight)
+        connection.maxWriteBatch = self.max_write_batch
+        connection.decoder.max_frame_size = self.max_frame_size
+        connection.oBuffer.max_messages = self.max_output_messages
+        connection.oBuffer.max_bytes = self.max_output_bytes
+        connection.oBuffer.policy = self.slow_consumer_policy
+        connection.oBuffer.resyncFrame = connection.encode_message(ServerLib.RESYNC_NOTIFICATION)
+        connection.on_evicted = self.count_eviction
+        state_machine = StateMachine(connection, client_public_key, self)
+        connection.set_state_machine(state_machine)
+        if session:
+            # A resumed session continues logged in
+            state_machine.resume(session["username"], session["state"])
+            connection.sessionId = session["id"]
+        # A client that disconnects is removed from the active connections too, not only stopped
+        connection.on_disconnect = lambda conn=connection: self.close_client(conn)
 
-                except socket.error as e:
-                    self.logger.error(f"Socket accept error: {e}")
-                    continue
+        with self.lock:
+            self.active_connections = {**self.active_connections, connection: state_machine}
+            self.state_machines = {**self.state_machines, connection: state_machine}
+        if session:
+            self.index_connection(connection, session["username"], state_machine.currentState == State.AdminDashboard)
+        return state_machine
+
+    def index_connection(self, connection, username, admin):
+        """Adds a logged in connection to the index the notifications are sent by"""
+        with self.lock:
+            if connection not in self.active_connections: # Closed while logging in
+                return
+            self.unindex_connection(connection)
+            connection.indexedUser = (username, admin)
+            self.user_connections = {**self.user_connections,
+                                     username: self.user_connections.get(username, frozenset()) | {connection}}
+            if admin:
+                self.admin_connections = self.admin_connections | {connection}
+
+    def unindex_connection(self, connection):
+        """Removes a connection from the index. Called with self.lock held"""
+        indexed = connection.indexedUser
+        if indexed is None:
+            return
+        username, admin = indexed
+        user_connections = dict(self.user_connections)
+        connections = user_connections.pop(username, frozenset()) - {connection}
+        if connections:
+            user_connections[username] = connections
+        self.user_connections = user_connections
+        if admin:
+            self.admin_connections = self.admin_connections - {connection}
+        connection.indexedUser = None
+
+    def count_eviction(self):
+        with self.eviction_lock:
+            self.evicted_connections += 1
+
+    def buffer_stats(self):
+        """Depth of the output buffers of all the clients and how many clients were disconnected for not reading"""
+        buffers = [connection.oBuffer.stats() for connection in self.active_connections]
+        with self.eviction_lock:
+            evicted = self.evicted_connections
+        return {"connections": len(buffers),
+                "queued": sum(b["queued"] for b in buffers),
+                "queued_bytes": sum(b["queued_bytes"] for b in buffers),
+                "max_queued": max((b["queued"] for b in buffers), default=0),
+                "coalesced": sum(b["coalesced"] for b in buffers),
+                "resyncs": sum(b["resyncs"] for b in buffers),
+                "evicted": evicted}
 
     def process_message(self, connection):
         """Sends the message to state machine for processing."""
@@ -158,9 +431,14 @@ class Server:
                     self.logger.debug(f"Processing message: {message}")
                     try:
                         state_machine = self.active_connections[connection]
-                        self.logger.debug("Calling state machine handle_action...")
-                        state_machine.handle_action(message)
-                        self.logger.debug("State machine handle_action completed")
+                        # A client that already has max_in_flight requests running gets this one handled in order.
+                        # Waiting for a free slot here would hold a worker that the running requests may need.
+                        if state_machine.can_pipeline(message) and connection.inFlight.acquire(blocking=False):
+                            self.dispatcher.submit_unordered(self.process_pipelined, connection, state_machine, message)
+                        else:
+                            self.logger.debug("Calling state machine handle_action...")
+                            state_machine.handle_action(message)
+                            self.logger.debug("State machine handle_action completed")
                     except json.JSONDecodeError as e:
                         self.logger.error(f"Error. Invalid Json: {e}")
 
@@ -169,15 +447,32 @@ class Server:
             self.close_client(connection)
 
 
+    def process_pipelined(self, connection, state_machine, message):
+        try:
+            state_machine.handle_action(message)
+        except Exception as e:
+            self.logger.error(f"Error processing request {message.get('request_id')}: {e}")
+            self.close_client(connection)
+        finally:
+            connection.inFlight.release()
+
+
     def close_client(self, connection):
         """Closes the client"""
         try:
             with self.lock:
-                if connection in self.active_connections:
-                    connection.stop_threads_on_exit()
-                    del self.state_machines[connection]
-                    del self.active_connections[connection]
-                    self.logger.info(f"Client {connection.address} disconnected.")
+                if connection not in self.active_connections:
+                    return # Already closed by another thread
+                self.state_machines = {conn: sm for conn, sm in self.state_machines.items() if conn is not connection}
+                self.active_connections = {conn: sm for conn, sm in self.active_connections.items() if conn is not connection}
+                self.unindex_connection(connection)
+            # Out of the lock, joining the threads of a stalled client takes seconds and the logins would wait for it
+            connection.stop_threads_on_exit()
+            self.logger.info(f"Compression stats of {connection.address}: {connection.compressionStats.as_dict()}")
+            self.logger.info(f"Write stats of {connection.address}: {connection.write_stats()}")
+            self.logger.info(f"Read stats of {connection.address}: {connection.decoder.stats()}")
+            self.logger.info(f"Output buffer of {connection.address}: {connection.oBuffer.stats()}")
+            self.logger.info(f"Client {connection.address} disconnected.")
         except Exception as e:
             self.logger.error(f"Error during client closing connection: {e}")
 
@@ -187,35 +482,143 @@ class Server:
         """A method to shut down the server gracefully closing each connection and the associated threads."""
         self.running = False
         self.logger.info("Server is shutting down...")
-        with self.lock:
-            for connection in list(self.state_machines.keys()):
-                self.close_client(connection) # called the function to gracefully stop each connection
-            self.active_connections.clear()
-
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.ADDRESS, self.PORT))
-        except:
-            pass
+        self.logger.info(f"Output buffers: {self.buffer_stats()}")
+        self.logger.info(f"Handshakes: {self.handshake_stats}")
+        self.logger.info(f"Sessions: {self.sessions.as_dict()}")
+        self.logger.info(f"Requests: {self.dispatcher.stats()}")
+        self.logger.info(f"Actions: {StateMachine.router.stats()}")
+        self.logger.info(f"Rate limits: {self.rate_limiter.stats()}")
+        self.logger.info(f"Idempotency keys: {self.idempotency.as_dict()}")
+        self.logger.info(f"Database connections: {ConnectionPool.get_pool('task_manager.db').stats()}")
+        self.notifier.stop() # The changes still waiting go out before the clients are closed
+        self.logger.info(f"Notifications: {self.notifier.stats()}")
+        for connection in list(self.state_machines): # A copy on write dict, see __init__
+            self.close_client(connection) # called the function to gracefully stop each connection (it takes the lock itself)
+        self.dispatcher.shutdown()
+        self.handshake_pool.shutdown(wait=False)
+
+        self.wake_listener()
         if hasattr(self, 'listen_thread'):
             self.listen_thread.join()
         self.logger.info("Server shutdown complete...")
 
-    def notification(self):
-        with self.lock:
-            for connection in self.active_connections:
-                    try:
-                        message = {"action":"notification",
-                                   "message":"A task has been created or modified"}
-                        connection.pushMessage(message)
-                    except Exception as e:
-                        self.logger.error(f"Error during notification message: {e}")
+    def notification(self, changes):
+        """Tells the clients about changed tasks. changes are the tasks (or the ids of the deleted ones) with their
+        versions, see Database.record_change. The clients apply them to the tasks they show instead of asking for all
+        of them again. They are sent by the notifier together with the other changes of the next few milliseconds"""
+        self.notifier.publish(changes)
+
+    def broadcast_notification(self, message):
+        self.notify_clients(message)
+        self.on_notification(message)
+
+    def notify_clients(self, message):
+        """Sends a notification to the clients of this server (or of this worker, see Supervisor.py) it is for. Every
+        change goes to the admins and to the users in its "users", a user gets only the changes of its tasks.
+
+        Runs on the notifier thread (or the IPC channel's) without self.lock, on the registry as it is right now. Every
+        different message is serialized once, the connections only compress and encrypt it."""
+        changes_by_user = {}
+        for change in message["changes"]:
+            for username in change["users"]:
+                changes_by_user.setdefault(username, []).append(change)
+
+        def serialize(changes):
+            # Who else the task concerns is not sent
+            return json.dumps(dict(message, changes=[{name: value for name, value in change.items() if name != "users"}
+                                                     for change in changes])).encode('utf-8')
+
+        admins = self.admin_connections
+        user_connections = self.user_connections
+        recipients = [(connection, None) for connection in admins]
+        for username, changes in changes_by_user.items():
+            recipients.extend((connection, username) for connection in user_connections.get(username, ())
+                              if connection not in admins)
+
+        serialized = {}
+        for connection, username in recipients:
+            if username not in serialized:
+                serialized[username] = serialize(message["changes"] if username is None else changes_by_user[username])
+            try:
+                # A client that is not reading gets these dropped or is disconnected, see ServerLib.OutputBuffer
+                connection.pushSerialized(serialized[username], ServerLib.FRAME_NOTIFICATION)
+            except Exception as e:
+                self.logger.error(f"Error during notification message: {e}")
 
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Task manager server")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="threads: 2 threads per connection. asyncio: one event loop with a bounded worker pool")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Worker threads that run the requests (database, AES and json work) of all the clients")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Server processes sharing the port. More than 1 starts the Supervisor (Linux and macOS only)")
+    parser.add_argument("--write-batch", type=int, default=MAX_WRITE_BATCH,
+                        help="Most frames a connection sends with one system call")
+    parser.add_argument("--handshake-workers", type=int, default=16, help="Threads that run the key exchange of new clients")
+    parser.add_argument("--max-pending-handshakes", type=int, default=256,
+                        help="New clients waiting for their key exchange. More are disconnected right away")
+    parser.add_argument("--key-exchange", nargs="+", choices=Protocol.SUPPORTED_KEY_EXCHANGE,
+                        default=Protocol.SUPPORTED_KEY_EXCHANGE, help="Key exchanges the clients can pick")
+    parser.add_argument("--session-lifetime", type=int, default=SESSION_LIFETIME,
+                        help="Seconds a session ticket lets a client reconnect without logging in again")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS,
+                        help="Session tickets kept by the server, the oldest are dropped first")
+    parser.add_argument("--max-queued", type=int, default=ServerLib.MAX_OUTPUT_MESSAGES,
+                        help="Most messages waiting to be sent to one client")
+    parser.add_argument("--max-queued-bytes", type=int, default=ServerLib.MAX_OUTPUT_BYTES,
+                        help="Most bytes waiting to be sent to one client")
+    parser.add_argument("--slow-consumer", choices=ServerLib.SLOW_CONSUMER_POLICIES, default=ServerLib.POLICY_COALESCE,
+                        help="coalesce: drop repeated notifications for a client that is not reading. disconnect: disconnect it")
+    parser.add_argument("--max-frame-size", type=int, default=Protocol.MAX_FRAME_SIZE,
+                        help="Largest message a client can send in bytes. A client sending more is disconnected")
+    parser.add_argument("--rate-limit", action="append", type=RateLimits.parse_limit, default=[], metavar="ACTION=RATE/BURST",
+                        help="Requests per second one connection can send of an action ('*' for the others), e.g. 'View Tasks=5/10'")
+    parser.add_argument("--user-rate-limit", action="append", type=RateLimits.parse_limit, default=[], metavar="ACTION=RATE/BURST",
+                        help="Same for all the connections of one user together")
+    parser.add_argument("--idempotency-ttl", type=int, default=IDEMPOTENCY_TTL,
+                        help="Seconds the server remembers an idempotency key and its response")
+    parser.add_argument("--max-idempotency-keys", type=int, default=MAX_IDEMPOTENCY_KEYS,
+                        help="Idempotency keys kept by the server, the oldest are dropped first")
+    parser.add_argument("--notification-window", type=float, default=NOTIFICATION_WINDOW,
+                        help="Seconds the server collects task changes for one notification. 0 sends each one right away")
+    parser.add_argument("--notification-max-delay", type=float, default=NOTIFICATION_MAX_DELAY,
+                        help="Seconds a task change waits for its notification at most, however many more come")
+    parser.add_argument("--compression-threshold", type=int, default=Protocol.COMPRESSION_THRESHOLD,
+                        help="Messages of at least this many bytes are compressed, if the client supports it")
+    args = parser.parse_args()
+
+    options = {"compression_threshold": args.compression_threshold,
+               "request_workers": args.workers,
+               "connection_rate_limits": dict(RateLimits.CONNECTION_LIMITS, **dict(args.rate_limit)),
+               "user_rate_limits": dict(RateLimits.USER_LIMITS, **dict(args.user_rate_limit)),
+               "idempotency_ttl": args.idempotency_ttl,
+               "max_idempotency_keys": args.max_idempotency_keys,
+               "notification_window": args.notification_window,
+               "notification_max_delay": args.notification_max_delay,
+               "max_write_batch": args.write_batch,
+               "max_frame_size": args.max_frame_size,
+               "max_output_messages": args.max_queued,
+               "max_output_bytes": args.max_queued_bytes,
+               "slow_consumer_policy": args.slow_consumer,
+               "handshake_workers": args.handshake_workers,
+               "max_pending_handshakes": args.max_pending_handshakes,
+               "session_lifetime": args.session_lifetime,
+               "max_sessions": args.max_sessions,
+               "key_exchanges": args.key_exchange}
     try:
-        server = Server("127.0.0.1", 8080)
+        if args.processes > 1:
+            from Supervisor import Supervisor
+            Supervisor("127.0.0.1", 8080, args.processes, args.engine, options).run()
+            return
+
+        if args.engine == "asyncio":
+            from AsyncServer import AsyncServer
+            server = AsyncServer("127.0.0.1", 8080, **options)
+        else:
+            server = Server("127.0.0.1", 8080, **options)
         server.start_listen_thread()
 
         try:
@@ -13,42 +13,183 @@ The write function sends messages that are queued in the oBuffer
 The read function receives external messages from the clients and puts them into the iBuffer after verifying
 the message came whole and notifies the server.
 
+Both buffers are bounded. The iBuffer blocks the read thread when it is full, so a client that sends faster than its
+messages are handled is slowed down by TCP. A closed connection empties it, so a blocked read thread wakes up and exits. The oBuffer (an OutputBuffer) has a message and a byte cap, a client that
+stops reading crosses them and is handled by the slow consumer policy instead of growing the server's memory.
+
 
 """
-import errno
+import collections
 import queue
 import threading
-from socket import socket
-import time
 import socket
 import json
 import binascii
 import Encryption
+import Protocol
 import ServerLogger
 
 
+MAX_WRITE_BATCH = 64 # Frames sent with one system call at most
+
+MAX_INPUT_MESSAGES = 64
+INPUT_PUT_TIMEOUT = 0.5 # Seconds a read thread waits for room in the iBuffer before checking if it was stopped
+MAX_OUTPUT_MESSAGES = 1000
+MAX_OUTPUT_BYTES = 4 * 1024 * 1024
+
+# What happens to a client whose oBuffer crosses its caps.
+# coalesce -> notifications are dropped while one is already queued. The client would miss the changes in them, so after
+# the last queued notification it gets a resync one and asks for all the tasks. A response that does not fit still
+# disconnects the client, responses cannot be dropped.
+# disconnect -> the client is disconnected as soon as anything does not fit.
+POLICY_COALESCE = "coalesce"
+POLICY_DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICIES = [POLICY_COALESCE, POLICY_DISCONNECT]
+
+FRAME_RESPONSE = "response"
+FRAME_NOTIFICATION = "notification"
+
+# Tells a client whose notifications were dropped to ask for all the tasks again
+RESYNC_NOTIFICATION = {"action": "notification",
+                       "message": "Tasks have been modified",
+                       "resync": True}
+
+
+class OutputBuffer:
+    """The frames waiting to be sent to one client, capped in messages and bytes. It is used like the queue.Queue it
+    replaced (get, get_nowait, empty, put(None) to stop the writer) but put tells the caller when the caps are crossed."""
+
+    def __init__(self, max_messages=MAX_OUTPUT_MESSAGES, max_bytes=MAX_OUTPUT_BYTES, policy=POLICY_COALESCE):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.frames = collections.deque() # (frame, kind)
+        self.bytes = 0
+        self.notificationsQueued = 0
+        self.resyncFrame = None # The connection's RESYNC_NOTIFICATION, queued after notifications were dropped
+        self.resyncPending = False
+
+        self.peakMessages = 0
+        self.peakBytes = 0
+        self.coalesced = 0
+        self.resyncs = 0
+        self.overflows = 0
+
+    def put(self, frame, kind=FRAME_RESPONSE):
+        """Queues a frame. Returns False when it does not fit and the client has to be disconnected"""
+        with self.condition:
+            if frame is not None:
+                if len(self.frames) + 1 > self.max_messages or self.bytes + len(frame) > self.max_bytes:
+                    self.overflows += 1
+                    if self.policy == POLICY_COALESCE and kind == FRAME_NOTIFICATION and self.notificationsQueued:
+                        self.coalesced += 1
+                        self.resyncPending = self.resyncFrame is not None
+                        return True
+                    if self.policy == POLICY_DISCONNECT or kind != FRAME_NOTIFICATION:
+                        return False
+                    # No notification is queued, this one goes in over the cap so the client still refreshes
+
+                self.bytes += len(frame)
+                if kind == FRAME_NOTIFICATION:
+                    self.notificationsQueued += 1
+                self.peakMessages = max(self.peakMessages, len(self.frames) + 1)
+                self.peakBytes = max(self.peakBytes, self.bytes)
+
+            self.frames.append((frame, kind))
+            self.condition.notify()
+            return True
+
+    def get(self):
+        with self.condition:
+            while not self.frames:
+                self.condition.wait()
+            return self.pop()
+
+    def get_nowait(self):
+        with self.condition:
+            if not self.frames:
+                raise queue.Empty
+            return self.pop()
+
+    def pop(self):
+        frame, kind = self.frames.popleft()
+        if frame is not None:
+            self.bytes -= len(frame)
+            if kind == FRAME_NOTIFICATION:
+                self.notificationsQueued -= 1
+                if self.resyncPending and not self.notificationsQueued:
+                    # The last notification before the dropped ones is going out, the resync goes after it
+                    self.resyncPending = False
+                    self.resyncs += 1
+                    self.frames.append((self.resyncFrame, FRAME_NOTIFICATION))
+                    self.bytes += len(self.resyncFrame)
+                    self.notificationsQueued += 1
+        return frame
+
+    def empty(self):
+        with self.condition:
+            return not self.frames
+
+    def qsize(self):
+        with self.condition:
+            return len(self.frames)
+
+    def clear(self):
+        """Drops everything queued. Used when the client is evicted"""
+        with self.condition:
+            self.frames.clear()
+            self.bytes = 0
+            self.notificationsQueued = 0
+            self.resyncPending = False
+
+    def stats(self):
+        with self.condition:
+            return {"queued": len(self.frames),
+                    "queued_bytes": self.bytes,
+                    "peak": self.peakMessages,
+                    "peak_bytes": self.peakBytes,
+                    "coalesced": self.coalesced,
+                    "resyncs": self.resyncs,
+                    "overflows": self.overflows}
+
+
 class ConnectionHandler:
-    def __init__(self, client_socket, address, client_public_key=None,rsa_encryption = None, aes_encryption = None):
+    def __init__(self, client_socket, address, client_public_key=None,rsa_encryption = None, aes_encryption = None,
+                 options=None):
         self.client_socket = client_socket
         self.address = address
         self.client_public_key = client_public_key
         self.logger = ServerLogger.server_logger
         self.lock = threading.Lock()
 
-        self.iBuffer = queue.Queue()
-        self.oBuffer = queue.Queue()
-
-        self.packetHeaderLength = 4
-        self.networkBuffer = ""
-        self.messageBuffer = ""
-        self.messageInProgress = False
-        self.messageBytesRemaining = 0
+        self.iBuffer = queue.Queue(maxsize=MAX_INPUT_MESSAGES)
+        self.oBuffer = OutputBuffer()
+        self.evicted = False # Set when the client stopped reading and crossed the oBuffer caps
+        self.sessionId = None # The session ticket the client holds, see Sessions.py
+        self.rateBuckets = {} # The rate limits of this connection, see RateLimits.py
+        self.indexedUser = None # (username, admin) while logged in, see Server.index_connection
+
+        # Negotiated in the handshake. Legacy frames have a 4 digit header and cannot pass 9999 bytes
+        self.options = options or dict(Protocol.LEGACY_OPTIONS)
+        self.framing = self.options["framing"]
+        self.envelope = self.options["envelope"]
+        self.compressionStats = Protocol.CompressionStats()
+
+        # The write thread sends everything that is queued (up to maxWriteBatch frames) with one system call
+        self.maxWriteBatch = MAX_WRITE_BATCH
+        self.framesSent = 0
+        self.sendCalls = 0
+        self.packetHeaderLength = Protocol.header_length(self.framing)
+        self.decoder = Protocol.FrameDecoder(self.framing) # Cuts what the read thread receives into frames
 
         self.running = True
         self.writing = True
         self.reading = True
 
         self.on_message_ready = lambda: None
+        self.on_disconnect = self.stop_threads_on_exit # The server replaces it to also remove the connection
+        self.on_evicted = lambda: None
 
         self.readThread = threading.Thread(target=self.read, daemon=True)
         self.writeThread = threading.Thread(target=self.write, daemon=True)
@@ -65,113 +206,151 @@ class ConnectionHandler:
     def write(self):
         try:
             while self.writing:
-                if not self.running and self.oBuffer.empty():
+                # Blocks until there is something to send, so an idle connection does not wake the cpu.
+                # stop_threads_on_exit puts None in the buffer to wake the thread up, after any message already queued.
+                message = self.oBuffer.get()
+                if message is None:
                     self.writing = False
-                    self.logger.error("Write thread stopped")
-                if not self.oBuffer.empty():
-                    try:
-                        with self.lock:
-                            message = self.oBuffer.get()
+                    break
 
-                            # Determine if the message is bytes or string
-                            if isinstance(message, str):
-                                message = message.encode("utf-8")  # Convert string to bytes
+                # Take whatever else is already queued, so a burst of notifications goes out together
+                batch = [message]
+                while len(batch) < self.maxWriteBatch:
+                    try:
+                        message = self.oBuffer.get_nowait()
+                    except queue.Empty:
+                        break
+                    if message is None:
+                        self.writing = False
+                        break
+                    batch.append(message)
 
-                            messageLength = str(len(message)).zfill(self.packetHeaderLength).encode("utf-8")
-                            self.client_socket.sendall(messageLength + message)
+                try:
+                    with self.lock:
+                        # The frames were built by pushMessage
+                        self.send_batch(batch)
 
-                    except:
-                        self.logger.error("Write thread stopped. Network error")
-                else:
-                    time.sleep(0.1)
+                except OSError as e:
+                    self.logger.error(f"Write thread stopped. Network error: {e}")
+                    self.writing = False
         except Exception as e:
             self.logger.error(f"Write thread error: {str(e)}")
         finally:
             self.logger.info("Write thread finished")
 
+    def send_batch(self, frames):
+        """Sends the frames with as few system calls as possible. sendmsg sends them all from one list of buffers
+        (vectored send) without joining them first. Windows sockets have no sendmsg, there they are joined."""
+        self.framesSent += len(frames)
+        if len(frames) == 1 or not hasattr(self.client_socket, "sendmsg"):
+            self.client_socket.sendall(frames[0] if len(frames) == 1 else b"".join(frames))
+            self.sendCalls += 1
+            return
+
+        buffers = [memoryview(frame) for frame in frames]
+        first = 0
+        while first < len(buffers):
+            sent = self.client_socket.sendmsg(buffers[first:])
+            self.sendCalls += 1
+            # Skip what went out. A partial send leaves the rest of a frame for the next call
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:
+                buffers[first] = buffers[first][sent:]
+
+    def write_stats(self):
+        return {"frames": self.framesSent,
+                "send_calls": self.sendCalls,
+                "frames_per_call": round(self.framesSent / self.sendCalls, 2) if self.sendCalls else 0.0}
+
     def read(self):
         try:
             with self.client_socket:
-                self.client_socket.setblocking(False)
-                self.logger.info("Connection established by {client}".format(client=self.client_socket.getpeername()))
+                # Blocking reads. recv sleeps until data arrives and stop_threads_on_exit wakes it up by shutting the socket down.
+                # The timeout left over from the key exchange is removed.
+                self.client_socket.settimeout(None)
+                self.logger.info("Connection established by {client}".format(client=self.address))
 
                 while self.reading:
-                    if not self.running:
-                        self.reading = False
-                        self.stop_threads_on_exit()
-                        break
                     try:
-                        data = self.client_socket.recv(1024)
-
-                        if data:
-                            message = data.decode("utf-8")
-                            self.networkBuffer += message
-                            self.logger.info("Network buffer received {data} from {client}".format(client=self.client_socket.getpeername(), data=data))
-
-                            while len(self.networkBuffer) > 0:
-                                if not self.messageInProgress:
-                                    if len(self.networkBuffer) >= self.packetHeaderLength:
-
-                                        self.messageBytesRemaining = int(self.networkBuffer[:self.packetHeaderLength])
-                                        self.networkBuffer = self.networkBuffer[self.packetHeaderLength:]
-                                        self.messageInProgress = True
-                                    else:
-                                        break
-
-                                if self.messageInProgress:
-                                    if len(self.networkBuffer) >= self.messageBytesRemaining:
-                                        # Extract the message
-                                        message_content = self.networkBuffer[:self.messageBytesRemaining]
-                                        self.networkBuffer = self.networkBuffer[self.messageBytesRemaining:]
-
-                                        with self.lock:
-                                            self.iBuffer.put(message_content)
-                                            self.logger.info(f"Message added to iBuffer: {message_content}")
-
-                                        self.messageInProgress = False
-                                        self.messageBytesRemaining = 0
-
-                                        # Call state machine
-                                        self.logger.info("A new message has been added to the iBuffer")
-                                        self.on_message_ready()
-                                    else:
-                                        break
-
-                        elif data == b'':
-                            self.logger.info(f"Client {self.client_socket.getpeername()} disconnected.")
-                            self.running = False
-                            self.stop_threads_on_exit()
+                        received = self.decoder.recv_from(self.client_socket)
+
+                        if received:
+                            self.logger.debug("Network buffer received {length} bytes from {client}".format(client=self.address, length=received))
+
+                            for message_content, flags in self.decoder.frames():
+                                # Blocks while the iBuffer is full, this client is not read until it has room
+                                if not self.put_input((message_content, flags)):
+                                    break # Stopped while waiting
+                                self.logger.debug(f"Message of {len(message_content)} bytes added to iBuffer")
+
+                                # Call state machine
+                                self.logger.info("A new message has been added to the iBuffer")
+                                self.on_message_ready()
+
+                            if not self.running:
+                                break
+
+                        else:
+                            if self.running:
+                                self.logger.info(f"Client {self.address} disconnected.")
+                                self.on_disconnect()
                             break
 
+                    except ValueError as e: # A broken header or a frame over the size limit
+                        self.logger.error(f"Invalid frame from {self.address}: {e}")
+                        self.on_disconnect()
+                        break
+
                     except OSError as e:
-                        err = e.args[0]
-                        if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                            time.sleep(0.1)
-                        else:
-                            self.logger.critical(f"Socket error: {e}")
-                            self.running = False
-                            try:
-                                self.client_socket.shutdown(socket.SHUT_RDWR)
-                            except OSError as e:
-                                if e.errno == 10038:
-                                    self.logger.error("Socket already closed..")
-                            finally:
-                                self.client_socket.close()
+                        if not self.running: # The socket was shut down by stop_threads_on_exit
+                            break
+                        self.logger.critical(f"Socket error: {e}")
+                        self.on_disconnect()
+                        break
 
         except Exception as e:
             self.logger.critical("Unhandled exception in read thread: {e}".format(e=e))
         finally:
             self.logger.info("Read thread finished")
 
+    def put_input(self, item):
+        """Puts a received message in the iBuffer, waiting while it is full. Returns False if the connection was stopped
+        meanwhile, nobody handles its messages anymore then"""
+        while self.running:
+            try:
+                self.iBuffer.put(item, timeout=INPUT_PUT_TIMEOUT)
+                return self.running
+            except queue.Full:
+                pass
+        return False
+
     def stop_threads_on_exit(self):
         """Gracefully stop the connection threads"""
         self.logger.info("Stopping threads")
 
         self.running = False
         self.reading = False
-        self.writing = False
+        # Nobody reads the iBuffer of a closed connection. Emptying it wakes a read thread waiting for room right away
+        try:
+            while True:
+                self.iBuffer.get_nowait()
+        except queue.Empty:
+            pass
 
         try:
+            # Wake the write thread. It sends what is already queued and then exits
+            self.oBuffer.put(None)
+            current = threading.current_thread()
+
+            #If the threads havent finished their blocking operation, there are errors. So I put a timeout of 2 seconds to wait for the operations to finish
+            if hasattr(self, 'writeThread') and self.writeThread.is_alive() and self.writeThread is not current:
+                self.writeThread.join(timeout=2.0)
+                if self.writeThread.is_alive():
+                    self.logger.warning("Write thread did not terminate cleanly")
+
+            # Shutting the socket down wakes the read thread from recv
             if hasattr(self, 'client_socket') and not self.client_socket._closed:
                 try:
                     self.client_socket.shutdown(socket.SHUT_RDWR)
@@ -182,17 +361,11 @@ class ConnectionHandler:
                 except (OSError, socket.error):
                     pass
 
-            #If the threads havent finished their blocking operation, there are errors. So I put a timeout of 2 seconds to wait for the operations to finish
-            if hasattr(self, 'readThread'): #hasattr checks if there is a read thread and returns true if exists.
+            if hasattr(self, 'readThread') and self.readThread.is_alive() and self.readThread is not current: #hasattr checks if there is a read thread and returns true if exists.
                 self.readThread.join(timeout=2.0)
                 if self.readThread.is_alive():
                     self.logger.warning("Read thread did not terminate cleanly")
 
-            if hasattr(self, 'writeThread'):
-                self.writeThread.join(timeout=2.0)
-                if self.writeThread.is_alive():
-                    self.logger.warning("Write thread did not terminate cleanly")
-
         except Exception as e:
             self.logger.error(f"Error during thread cleanup: {str(e)}")
         finally:
@@ -204,43 +377,89 @@ class ConnectionHandler:
         self.readThread.start()
         self.writeThread.start()
 
-    def pushMessage(self, message_dict):
-        try:
-            message = json.dumps(message_dict)
+    def encode_message(self, message_dict):
+        """Builds the frame of a message: json -> compression (if negotiated and over the threshold) -> AES -> frame"""
+        return self.encode_serialized(json.dumps(message_dict).encode('utf-8'))
+
+    def encode_serialized(self, message):
+        """encode_message without the json step, for a message that is already json bytes"""
+        if self.envelope == Protocol.ENVELOPE_BINARY:
+            message, flags = Protocol.compress_payload(message, self.options, self.compressionStats)
+            payload = self.AesEncryption.encrypt_envelope(message)
+        else:
+            flags = 0
             encrypted_data = self.AesEncryption.encrypt_text(message)
             message_to_send = {
                 'ciphertext': binascii.hexlify(encrypted_data[0]).decode('utf-8'),
                 'aesIV': binascii.hexlify(encrypted_data[1]).decode('utf-8'),
                 'authTag': binascii.hexlify(encrypted_data[2]).decode('utf-8')
             }
-            self.oBuffer.put(json.dumps(message_to_send))
-            self.logger.info("Message encrypted and queued for sending")
-
+            payload = json.dumps(message_to_send).encode('utf-8')
+        return Protocol.encode_frame(payload, self.framing, flags)
+
+    def decode_message(self, payload, flags=0):
+        """The reverse of encode_message, from the payload of a frame to the message dict"""
+        if self.envelope == Protocol.ENVELOPE_BINARY:
+            message = self.AesEncryption.decrypt_envelope(payload)
+            return json.loads(Protocol.decompress_payload(message, flags, self.compressionStats))
+
+        encrypted_dict = json.loads(payload)
+
+        # Convert from hex strings back to bytes
+        encrypted_data = (
+            binascii.unhexlify(encrypted_dict['ciphertext']),
+            binascii.unhexlify(encrypted_dict['aesIV']),
+            binascii.unhexlify(encrypted_dict['authTag'])
+        )
+
+        decrypted_message = self.AesEncryption.decrypt_text(encrypted_data)
+        return json.loads(decrypted_message)
+
+    def pushMessage(self, message_dict, kind=FRAME_RESPONSE):
+        if self.evicted:
+            return
+        self.pushSerialized(json.dumps(message_dict).encode('utf-8'), kind)
+
+    def pushSerialized(self, message, kind=FRAME_RESPONSE):
+        """pushMessage of a message that is already json bytes. A notification is serialized once for all the clients
+        and only compressed and encrypted here, per connection"""
+        if self.evicted:
+            return
+        try:
+            frame = self.encode_serialized(message)
         except Exception as e:
             self.logger.error(f"Error encrypting message: {e}")
             raise
 
+        if self.oBuffer.put(frame, kind):
+            self.logger.info("Message encrypted and queued for sending")
+        else:
+            self.evict()
+
+    def evict(self):
+        """Disconnects a client that stopped reading. pushMessage can be called by another connection's thread while
+        the server holds its lock, so the connection is not closed from here. The socket is shut down instead, which
+        wakes the read thread up and it closes the connection like any other disconnect."""
+        if self.evicted:
+            return
+        self.evicted = True
+        self.logger.warning(f"Client {self.address} is not reading, disconnecting it. Output buffer: {self.oBuffer.stats()}")
+        self.oBuffer.clear()
+        self.on_evicted()
+        self.oBuffer.put(None)
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def getMessage(self):
         if not self.iBuffer.empty():
             try:
-                message = self.iBuffer.get()
-                if isinstance(message, bytes):
-                    message = message.decode('utf-8')
-                encrypted_dict = json.loads(message)
-
-                # Convert from hex strings back to bytes
-                encrypted_data = (
-                    binascii.unhexlify(encrypted_dict['ciphertext']),
-                    binascii.unhexlify(encrypted_dict['aesIV']),
-                    binascii.unhexlify(encrypted_dict['authTag'])
-                )
-
-                decrypted_message = self.AesEncryption.decrypt_text(encrypted_data)
-                return json.loads(decrypted_message)
+                payload, flags = self.iBuffer.get()
+                return self.decode_message(payload, flags)
 
             except Exception as e:
                 self.logger.error(f"Error decrypting message: {e}")
                 raise
 
         return None
-
@@ -0,0 +1,119 @@
+"""This file holds the session tickets that let a client reconnect without the RSA handshake.
+
+After a successful login the server gives the client a ticket. The ticket is the session (id, AES key, username,
+dashboard state and expiry) encrypted with AES-GCM under a ticket key that only the server knows, so the client cannot
+read or change it. When the connection drops the client sends the ticket in its hello. The server decrypts it, derives a
+fresh AES key from the old one and the nonces of both ends, and the connection continues logged in after one round trip.
+
+The server also keeps the ids of the tickets it gave out, oldest first and up to max_sessions. A ticket works once and
+only while its id is in the store, so it cannot be replayed, it is gone when the user exits, and a flood of logins
+evicts the oldest sessions instead of growing the memory.
+
+The ticket key is made when the server starts, a restart makes every ticket invalid and the clients do a full handshake.
+With the Supervisor every worker gets the same ticket key, and the workers tell each other about the tickets they give
+out and use up (on_issued, on_removed), so a client can resume on whichever worker its new connection lands on.
+"""
+
+
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from Crypto.Cipher import AES
+
+import ServerLogger
+
+
+SESSION_LIFETIME = 3600 # Seconds after the login a ticket (and the ones it is resumed into) can be used for
+MAX_SESSIONS = 10000
+NONCE_LENGTH = 12
+TAG_LENGTH = 16
+
+
+class SessionTickets:
+    def __init__(self, lifetime=SESSION_LIFETIME, max_sessions=MAX_SESSIONS, ticket_key=None):
+        self.logger = ServerLogger.server_logger
+        self.lifetime = lifetime
+        self.max_sessions = max_sessions
+        self.ticket_key = ticket_key or os.urandom(32) # The Supervisor gives all its workers the same one
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict() # session id -> expiry, oldest first
+        self.stats = {"issued": 0, "resumed": 0, "rejected": 0, "expired": 0, "evicted": 0, "revoked": 0}
+        self.on_issued = lambda session_id, expires: None
+        self.on_removed = lambda session_id: None
+
+    def issue(self, aes_key, username, state, expires=None):
+        """Returns a new ticket (hex) and its session id. expires is given when a ticket replaces a redeemed one, the
+        session does not get longer by resuming it"""
+        session_id = os.urandom(16).hex()
+        if expires is None:
+            expires = time.time() + self.lifetime
+        session = {"id": session_id,
+                   "key": aes_key.hex(),
+                   "username": username,
+                   "state": state,
+                   "expires": expires}
+
+        cipher = AES.new(self.ticket_key, AES.MODE_GCM, nonce=os.urandom(NONCE_LENGTH))
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(session).encode('utf-8'))
+
+        self.add(session_id, expires)
+        with self.lock:
+            self.stats["issued"] += 1
+        self.on_issued(session_id, expires)
+        return (cipher.nonce + tag + ciphertext).hex(), session_id
+
+    def add(self, session_id, expires):
+        """Stores the id of a ticket. Also used for the tickets the other workers give out"""
+        with self.lock:
+            self.sessions[session_id] = expires
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def discard(self, session_id):
+        """Forgets a ticket another worker used or revoked"""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def redeem(self, ticket):
+        """Returns the session of a ticket and removes it from the store, or None if the ticket cannot be used"""
+        try:
+            data = bytes.fromhex(ticket)
+            nonce, tag = data[:NONCE_LENGTH], data[NONCE_LENGTH:NONCE_LENGTH + TAG_LENGTH]
+            cipher = AES.new(self.ticket_key, AES.MODE_GCM, nonce=nonce)
+            session = json.loads(cipher.decrypt_and_verify(data[NONCE_LENGTH + TAG_LENGTH:], tag))
+        except (ValueError, TypeError, KeyError) as e:
+            self.logger.warning(f"Invalid session ticket: {e}")
+            with self.lock:
+                self.stats["rejected"] += 1
+            return None
+
+        with self.lock:
+            known = self.sessions.pop(session["id"], None) is not None
+            if not known:
+                self.stats["rejected"] += 1 # Used already, revoked or evicted
+                return None
+        self.on_removed(session["id"])
+        with self.lock:
+            if session["expires"] < time.time():
+                self.stats["expired"] += 1
+                return None
+            self.stats["resumed"] += 1
+
+        session["key"] = bytes.fromhex(session["key"])
+        return session
+
+    def revoke(self, session_id):
+        with self.lock:
+            if self.sessions.pop(session_id, None) is None:
+                return
+            self.stats["revoked"] += 1
+        self.on_removed(session_id)
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.stats, active=len(self.sessions))
@@ -23,10 +23,13 @@ Note: The exit state has not been used.
 
 
 from enum import Enum
+import threading
+import time
 import ServerLogger
 from Authentication import authenticate_user, admin_right
 import Database
 import Encryption
+import Idempotency
 
 
 
@@ -39,7 +42,85 @@ class State(Enum):
     Exit = 6
 
 
+# The batch actions and what they do to each task in their list. A batch runs in one transaction and sends one notification.
+BATCH_ACTIONS = {"Batch Create Tasks": "create",
+                 "Batch Update Tasks": "update",
+                 "Batch Delete Tasks": "delete"}
+MAX_BATCH_SIZE = 500
+
+# Who can send an action, as the states the client has to be in
+GUEST = (State.Start,)
+USER = (State.Dashboard, State.AdminDashboard)
+ADMIN = (State.AdminDashboard,)
+
+
+class Route:
+    def __init__(self, action, handler, states, pipelined, idempotent):
+        self.action = action
+        self.handler = handler
+        self.states = states
+        self.pipelined = pipelined
+        self.idempotent = idempotent
+
+
+class ActionRouter:
+    """The table of the actions the state machine handles. handle_action finds the handler of a message with one lookup
+    of (state, action), so the dashboards do not need their own if/elif chains. A new action is one add() call, also
+    from outside this file.
+
+    Every handler call is timed. The times are kept per action (stats()) and passed to the hooks, which are called
+    with (action, seconds, failed)."""
+
+    def __init__(self):
+        self.routes = {} # (state, action) -> Route
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.timings = {} # action -> [calls, failed, total seconds, max seconds]
+
+    def add(self, action, handler, states, pipelined=False, idempotent=False):
+        """handler is called as handler(state_machine, data). pipelined -> with a request_id it can run at the same time as
+        the other requests of the client (see Server.process_message). Actions that change the state must not be.
+        idempotent -> the client can send it with an idempotency_key, a retry then gets the first response back instead
+        of running again (see Idempotency.py). The handler must respond exactly once."""
+        route = Route(action, handler, states, pipelined, idempotent)
+        for state in states:
+            self.routes[(state, action)] = route
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def find(self, state, action):
+        return self.routes.get((state, action))
+
+    def call(self, route, state_machine, data):
+        start = time.perf_counter()
+        failed = True
+        try:
+            route.handler(state_machine, data)
+            failed = False
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                timing = self.timings.setdefault(route.action, [0, 0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += failed
+                timing[2] += elapsed
+                timing[3] = max(timing[3], elapsed)
+            for hook in self.hooks:
+                hook(route.action, elapsed, failed)
+
+    def stats(self):
+        with self.lock:
+            return {action: {"calls": calls,
+                             "failed": failed,
+                             "avg_ms": round(total / calls * 1000, 3),
+                             "max_ms": round(longest * 1000, 3)}
+                    for action, (calls, failed, total, longest) in self.timings.items()}
+
+
 class StateMachine:
+    router = ActionRouter() # Filled in at the end of this file
+
     def __init__(self,connection_handler,client_public_key, server):
         self.currentState = State.Start
         self.previousState = None
@@ -48,10 +129,37 @@ class StateMachine:
         self.connectionHandler = connection_handler
         self.client_public_key = client_public_key
         self.server = server
-        self.rsaEncryption = Encryption.RsaEncryption()
-        self.md5Encryption = Encryption.HashEncryption()
+        # Shared by the whole server, a new RSA key for every connection made each login take hundreds of milliseconds
+        self.rsaEncryption = server.crypto.rsa
+        self.md5Encryption = server.crypto.hash
         self.caesarCipher = Encryption.CaesarCipher()
+        self.request_context = threading.local() # The request being handled by each thread, see respond()
+        self.username = None
+
+
+    def respond(self, message):
+        """Pushes a response to the client. If the request had a request_id it is echoed back, so the client can match
+        the response even when it arrives out of order."""
+        request_id = getattr(self.request_context, "request_id", None)
+        if request_id is not None:
+            message["request_id"] = request_id
+        responses = getattr(self.request_context, "responses", None)
+        if responses is not None: # An idempotent request, sent by call_idempotent once its response is stored
+            responses.append(message)
+            return
+        self.connectionHandler.pushMessage(message)
 
+    def resume(self, username, state):
+        """Puts a resumed session back where it was, logged in on its dashboard"""
+        self.username = username
+        self.currentState = State[state]
+        self.logger.info(f"{username} resumed the session in {self.currentState}")
+
+    def can_pipeline(self, data):
+        """Dashboard requests with a request_id can run at the same time as other requests of the same client.
+        Login, signup and exit change the state and always run in order."""
+        route = self.router.find(self.currentState, data.get("action"))
+        return "request_id" in data and route is not None and route.pipelined
 
 
     def authenticate(self,username, password):
@@ -83,12 +191,15 @@ class StateMachine:
                           "message": "Provide Access"}
 
             self.logger.info(f"Pushing access message to client: {access}")
-            self.connectionHandler.pushMessage(access)
+            self.respond(access)
+            self.username = username
+            self.server.index_connection(self.connectionHandler, username, self.currentState == State.AdminDashboard)
+            self.server.issue_session_ticket(self.connectionHandler, username, self.currentState)
         else:
             self.logger.info("Login failed")
             fail_message = {"action": "Login", "message": "Failed"}
             self.currentState = State.Start
-            self.connectionHandler.pushMessage(fail_message)
+            self.respond(fail_message)
 
 
     # Takes the usernameas argument and calls admin_right function from the Authentication.py -> Bool
@@ -114,22 +225,22 @@ class StateMachine:
                 self.previousState = State.SignUp
                 self.logger.info("User Added")
 
-                self.connectionHandler.pushMessage({"action": "SignUp",
+                self.respond({"action": "SignUp",
                                                     "message": "Success"})
             elif done == "User already exists":
                 self.currentState = State.Start
-                self.connectionHandler.pushMessage({"action":"signup",
+                self.respond({"action":"signup",
                                                     "message":"User already exists"})
                 self.logger.info("User already exists")
             else:
                 self.currentState = State.Start
-                self.connectionHandler.pushMessage({"action": "signup",
+                self.respond({"action": "signup",
                                                     "message": "Error"})
                 self.logger.error("Error creating user")
 
         except Exception as e:
             self.logger.error(f"Error while creating new user {username}: {e}")
-            self.connectionHandler.pushMessage({"action": "signup",
+            self.respond({"action": "signup",
                                                 "message": "Error"})
 
         finally:
@@ -139,121 +250,188 @@ class StateMachine:
     def handle_action(self,data):
         """Handles action"""
         action = data["action"]
+        self.request_context.request_id = data.get("request_id")
         self.logger.debug(f"Received data: {data}")
         self.logger.debug(f"Received action: {action}")
-        if self.currentState == State.Start:
-            if action == "login":
-                username = data["username"]
-                password = data["password"]
-                self.handle_login(username, password)
-            elif action == "signup":
-                username = data["username"]
-                password = data["password"]
-                self.handle_signup(username, password)
 
-            else:
-                self.logger.error("Invalid action at the start of the client. In start state, only login or signup is available. The client will now close")
-                message = {"action": "Exit",
-                           "message": "Exiting...An error occured during start."}
+        retry_after = self.server.rate_limiter.check(self.connectionHandler, self.username, action)
+        if retry_after:
+            self.respond({"action": "Retry Later",
+                          "message": {"action": action, "retry_after": round(retry_after, 3)}})
+            return
 
-                self.connectionHandler.pushMessage(message)
-                self.server.close_client(self.connectionHandler)
+        route = self.router.find(self.currentState, action)
+        if route is not None and route.idempotent and "idempotency_key" in data:
+            self.call_idempotent(route, data)
+
+        elif route is not None:
+            self.router.call(route, self, data)
 
-        elif self.currentState == State.Dashboard or self.currentState == State.AdminDashboard:
-            message =data.get("message", {})
-            username = data.get("username")
-            self.process(action,message,username)
+        elif self.currentState == State.Start:
+            self.logger.error("Invalid action at the start of the client. In start state, only login or signup is available. The client will now close")
+            message = {"action": "Exit",
+                       "message": "Exiting...An error occured during start."}
+
+            self.respond(message)
+            self.server.close_client(self.connectionHandler)
+
+        elif self.currentState in USER:
+            self.logger.warning(f"Action {action} is not available in {self.currentState}")
+            self.reject(action, "Failed. Not allowed")
 
         else:
             self.logger.warning("Login required to continue.")
+            self.reject(action, "Failed. Login required")
+
+    def reject(self, action, reason):
+        """Answers a request that has no route in this state. Only one with a request_id, the client waits for that
+        one. Without it an old client would take the Failed as a request to send the action again."""
+        if self.request_context.request_id is not None:
+            self.respond({"action": action, "message": reason})
+
+    def call_idempotent(self, route, data):
+        """Runs a request that has an idempotency key, unless the key was already used. Then the client gets the
+        response of the first time again"""
+        key = data["idempotency_key"]
+        action = data["action"]
+        if not isinstance(key, str) or not key or len(key) > Idempotency.MAX_KEY_LENGTH:
+            self.respond({"action": action, "message": "Failed. Invalid idempotency key"})
+            return
 
+        store = self.server.idempotency
+        request_hash = Idempotency.fingerprint(data.get("message"))
+        found, response = store.begin(self.username, key, action, request_hash)
+        if found == Idempotency.REPLAY:
+            self.logger.info(f"{action} with key {key} of {self.username} already done, sending its response again")
+            response["replayed"] = True
+            self.respond(response)
+            return
+        if found == Idempotency.RUNNING:
+            self.respond({"action": "Retry Later",
+                          "message": {"action": action, "retry_after": Idempotency.RUNNING_RETRY_AFTER}})
+            return
+        if found == Idempotency.CONFLICT:
+            self.logger.warning(f"Idempotency key {key} of {self.username} reused for another request")
+            self.respond({"action": action, "message": "Failed. The idempotency key was used for another request"})
+            return
 
+        # The responses are held back until the first one is stored, a client that got it must not find the key missing
+        responses = self.request_context.responses = []
+        stored = None
+        try:
+            self.router.call(route, self, data)
+            # Only a change that was made is kept. A failure (e.g. the database was locked) runs again when retried
+            if responses and self.succeeded(responses[0]):
+                stored = {name: value for name, value in responses[0].items() if name != "request_id"}
+        finally:
+            self.request_context.responses = None
+            store.finish(self.username, key, action, request_hash, stored)
+            for message in responses:
+                self.connectionHandler.pushMessage(message)
 
+    @staticmethod
+    def succeeded(response):
+        """If a response of a task change says it was done. A batch that ran answers with its results, even if some
+        items failed, those are kept too"""
+        message = response.get("message")
+        return isinstance(message, dict) or message in ("Success", "Task created successfully.")
+
+    # The handlers of the router. They get the whole message, the dashboard ones take the request out of "message".
+
+    def on_login(self, data):
+        self.handle_login(data["username"], data["password"])
+
+    def on_signup(self, data):
+        self.handle_signup(data["username"], data["password"])
+
+    def on_create_task(self, data):
+        message = data.get("message", {})
+        if isinstance(message, dict):
+            self.logger.info(f"Creating task: {message}")
+            self.createTask(message)
+
+    def on_update_task(self, data):
+        message = data.get("message", {})
+        if isinstance(message, dict): #wont process client response of success or failed
+            self.update_task(message, data.get("username"))
+
+    def on_delete_task(self, data):
+        message = data.get("message", {})
+        if isinstance(message, str) and message == "Success":
+            self.logger.info("Delete task operation was successful")
+            self.show_tasks()
+        else:
+            self.delete_task(message)
 
+    def on_batch_tasks(self, data):
+        """The message is a list of what the single action would get, e.g. Batch Update Tasks -> a list of Update Task messages"""
+        action = data["action"]
+        items = data.get("message")
+        if not isinstance(items, list) or not items or len(items) > MAX_BATCH_SIZE:
+            self.respond({"action": action, "message": f"Failed. Send a list of 1 to {MAX_BATCH_SIZE} tasks"})
+            return
 
-    def process(self,action,message,username):
-        """The main functionality of the program after authentication(login/signup)"""
-        self.logger.info("State Machine Started")
-        if self.currentState == State.Dashboard:
-            self.currentState = State.Dashboard
-            self.previousState = State.LoggingIn
-            self.logger.info(f"State changed to {self.currentState}")
-            if action == "Create Task":
-                if isinstance(message, dict):
-                    self.logger.info(f"Creating task: {message}")
-                    self.createTask(message)
-            elif action == "Update Task":
-                if isinstance(message, dict): #wont process client response of success or failed
-                    self.update_task(message, username)
-            elif action == "Delete Task":
-                if isinstance(message, str) and message == "Success":
-                    self.logger.info("Delete task operation was successful")
-                    self.show_tasks()
-                else:
-                    self.delete_task(message)
-            elif action == "View Tasks":
-                self.show_tasks()
-            elif action == "Exit":
-                self.logger.info(f"{username} requesting exit.")
-                message = {"action": "Exit",
-                           "message": "Exiting... Goodbye..."}
+        changes = []
+        results = self.db.apply_task_batch(BATCH_ACTIONS[action], items, changes)
+        if results is None:
+            self.respond({"action": action, "message": "Failed"})
+            return
 
-                self.connectionHandler.pushMessage(message)
-                self.server.close_client(self.connectionHandler)
+        succeeded = sum(1 for result in results if result["result"] == "Success")
+        self.logger.info(f"{action}: {succeeded} of {len(items)} tasks done")
+        self.respond({"action": action,
+                      "message": {"succeeded": succeeded,
+                                  "failed": len(items) - succeeded,
+                                  "results": results}})
+        if changes:
+            self.server.notification(changes) # Once for the whole batch
+
+    def on_view_tasks(self, data):
+        self.show_tasks()
+
+    def on_sync_tasks(self, data):
+        message = data.get("message", {})
+        version = message.get("version") if isinstance(message, dict) else None
+        if isinstance(version, int) and not isinstance(version, bool):
+            self.sync_tasks(version)
+        else:
+            self.respond({"action": "Sync Tasks", "message": "Failed. Send the version of the tasks you have"})
 
-        elif self.currentState == State.AdminDashboard:
-            """The main functionality of the program after authentication(login/signup)"""
-            self.logger.info("State Machine Started")
-            if self.currentState == State.AdminDashboard:
-                self.currentState = State.AdminDashboard
-                self.previousState = State.LoggingIn
-                self.logger.info(f"State changed to {self.currentState}")
-                if action == "Create Task":
-                    if isinstance(message, dict):
-                        self.logger.info(f"Creating task: {message}")
-                        self.createTask(message)
-                elif action == "Update Task":
-                    if isinstance(message, dict):  # wont process client response of success or failed
-                        self.update_task(message, username)
-                elif action == "Delete Task":
-                    if isinstance(message, str) and message == "Success":
-                        self.logger.info("Delete task operation was successful")
-                        self.show_tasks()
-                    else:
-                        self.delete_task(message)
-                elif action == "View Tasks":
-                    self.show_tasks()
-                elif action == "Exit":
-                    self.logger.info(f"{username} requesting exit.")
-                    message = {"action": "Exit",
-                               "message": "Exiting... Goodbye..."}
-
-                    self.connectionHandler.pushMessage(message)
-                    self.server.close_client(self.connectionHandler)
-                elif action == "View Users":
-                    self.view_users()
+    def on_view_users(self, data):
+        self.view_users()
+
+    def on_exit(self, data):
+        self.logger.info(f"{data.get('username')} requesting exit.")
+        message = {"action": "Exit",
+                   "message": "Exiting... Goodbye..."}
+
+        self.respond(message)
+        self.server.sessions.revoke(self.connectionHandler.sessionId) # Logged out, the ticket is no good anymore
+        self.server.close_client(self.connectionHandler)
 
 
     def get_userID(self,username):
         return self.db.get_userID_fromDB(username)
 
     def createTask(self, message):
+        changes = []
         result = self.db.insert_task(
             message["description"],
             message["due_date"],
             message["active"],
             message["assigned_to"],
-            message["username"]
+            message["username"],
+            changes=changes
         )
         if result == "Success":
             message = {"action": "Create Task",
                        "message": "Task created successfully."}
-            self.connectionHandler.pushMessage(message)
+            self.respond(message)
+            self.server.notification(changes)
         else:
             message = {"action": "Create Task",
                        "message": "Failed to create task."}
-            self.connectionHandler.pushMessage(message)
-            self.server.notification()
+            self.respond(message)
 
     def update_task(self, message, username):
         if isinstance(message, str):
@@ -263,43 +441,52 @@ class StateMachine:
         if not assigned_by:
             self.logger.error(f"Creator user ID not found for {username}")
             response = {"action": "Update Task", "message": "Failed"}
-            self.connectionHandler.pushMessage(response)
+            self.respond(response)
             return
 
+        changes = []
         result = self.db.update_task(
             message["TaskID"],
             message["description"],
             message["due_date"],
             message["active"],
             message["assigned_to"],
-            assigned_by
+            assigned_by,
+            changes=changes
         )
 
-        self.connectionHandler.pushMessage({
+        self.respond({
             "action": "Update Task",
             "message": "Success" if result == "Success" else "Failed"
         })
-        self.server.notification()
+        if changes:
+            self.server.notification(changes)
 
     def delete_task(self, message):
         task_id = message["task_id"]
-        if self.db.delete_task(task_id) == "Success":
+        changes = []
+        if self.db.delete_task(task_id, changes=changes) == "Success":
             self.logger.info(f"Task {task_id} deleted")
             response = {
                 "action": "Delete Task",
                 "message": "Success"
             }
-            self.connectionHandler.pushMessage(response)
+            self.respond(response)
+            if changes:
+                self.server.notification(changes)
         else:
             response = {
                 "action": "Delete Task",
                 "message": "Failed"
             }
-            self.connectionHandler.pushMessage(response)
-            self.server.notification()
+            self.respond(response)
 
     def show_tasks(self):
-        tasks_str = self.db.show_tasks()
+        # Read before the tasks. A change made in between is in the tasks and comes again as a notification, which the
+        # client applies once more with the same result. Read after, the client could skip a change it does not have.
+        version = self.db.task_version()
+        # Users see the tasks they are assigned or created, the ones they get notifications for. Admins see all of them
+        tasks_str = self.db.show_tasks(None if self.currentState == State.AdminDashboard else self.username)
         try:
             if not tasks_str:
                 self.logger.info("No tasks found in database")
@@ -313,8 +500,9 @@ class StateMachine:
                     "action": "View Tasks",
                     "message": tasks_str
                 }
+            response["version"] = version
 
-            self.connectionHandler.pushMessage(response)
+            self.respond(response)
 
         except Exception as e:
             self.logger.error(f"Error in show_tasks: {e}")
@@ -322,14 +510,33 @@ class StateMachine:
                 "action": "View Tasks",
                 "message": "Error retrieving tasks."
             }
-            self.connectionHandler.pushMessage(response)
-
+            self.respond(response)
+
+
+    def sync_tasks(self, version):
+        """The tasks changed since the version the client has, in the format of the notifications. A client the change
+        log cannot catch up gets all its tasks, like View Tasks, with "full": True"""
+        admin = self.currentState == State.AdminDashboard
+        current, changes = self.db.changes_since(version, None if admin else self.username)
+        if current is None:
+            self.respond({"action": "Sync Tasks", "message": "Error retrieving tasks."})
+        elif changes is None:
+            self.logger.info(f"Version {version} is not in the change log anymore, sending all the tasks")
+            version = self.db.task_version() # Read before the tasks, see show_tasks
+            self.respond({"action": "Sync Tasks",
+                          "message": {"full": True,
+                                      "version": version,
+                                      "tasks": self.db.show_tasks(None if admin else self.username) or []}})
+        else:
+            self.logger.info(f"Sending {len(changes)} changed tasks since version {version}")
+            self.respond({"action": "Sync Tasks",
+                          "message": {"version": current, "changes": changes}})
 
     def view_users(self):
         result = self.db.show_users()
         message = {"action": "View users",
                   "message": result}
-        self.connectionHandler.pushMessage(message)
+        self.respond(message)
 
 
     """
@@ -350,3 +557,16 @@ class StateMachine:
 
     """
 
+
+# The action table. A new action is a handler method and a line here, or a router.add call from another module.
+StateMachine.router.add("login", StateMachine.on_login, GUEST)
+StateMachine.router.add("signup", StateMachine.on_signup, GUEST)
+StateMachine.router.add("Create Task", StateMachine.on_create_task, USER, pipelined=True, idempotent=True)
+StateMachine.router.add("Update Task", StateMachine.on_update_task, USER, pipelined=True, idempotent=True)
+StateMachine.router.add("Delete Task", StateMachine.on_delete_task, USER, pipelined=True, idempotent=True)
+StateMachine.router.add("View Tasks", StateMachine.on_view_tasks, USER, pipelined=True)
+StateMachine.router.add("Sync Tasks", StateMachine.on_sync_tasks, USER, pipelined=True)
+StateMachine.router.add("View Users", StateMachine.on_view_users, ADMIN, pipelined=True)
+StateMachine.router.add("Exit", StateMachine.on_exit, USER)
+for batch_action in BATCH_ACTIONS:
+    StateMachine.router.add(batch_action, StateMachine.on_batch_tasks, USER, pipelined=True, idempotent=True)
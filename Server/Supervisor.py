@@ -0,0 +1,254 @@
+"""This file is the multi-process mode of the server. It is started with 'python Server.py --processes 4'.
+
+One server process does the json, AES and SQLite work of all its clients under one GIL, so it uses one core. The
+supervisor opens the listening socket and forks worker processes that all accept clients from it, each one a normal
+Server (or AsyncServer) with its own threads. The supervisor itself serves no clients. It starts a new worker when one
+crashes and passes SIGTERM (and Ctrl+C) on to the workers, which then shut down like a single server does.
+
+Every worker is connected to the supervisor with a socketpair (the IPC channel) that carries json lines. A worker sends
+its notifications and its session ticket changes there and the supervisor forwards them to all the other workers. That
+way a task update on worker 1 still reaches the clients of worker 3, and a client can resume its session on any worker.
+
+The RSA host key and the session ticket key are made once before forking, so all the workers use the same ones.
+
+It needs os.fork, so it only runs on Linux and macOS.
+"""
+
+
+
+import json
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+
+import Encryption
+import ServerLogger
+
+
+RESTART_DELAY = 1.0 # A worker that dies sooner than this after starting is restarted only after waiting this long
+SHUTDOWN_TIMEOUT = 10.0 # Workers still running this long after SIGTERM are killed
+
+
+class WorkerChannel:
+    """The worker's end of the IPC channel"""
+
+    def __init__(self, channel_socket, server):
+        self.socket = channel_socket
+        self.server = server
+        self.logger = ServerLogger.server_logger
+        self.lock = threading.Lock() # Notifications are sent from many threads
+        self.readThread = threading.Thread(target=self.read, daemon=True)
+
+    def attach(self):
+        """Hooks the channel into the server and starts reading what the other workers send"""
+        self.server.on_notification = lambda message: self.send({"type": "notification", "message": message})
+        self.server.sessions.on_issued = lambda session_id, expires: self.send(
+            {"type": "session_issued", "id": session_id, "expires": expires})
+        self.server.sessions.on_removed = lambda session_id: self.send({"type": "session_removed", "id": session_id})
+        self.readThread.start()
+
+    def send(self, event):
+        data = (json.dumps(event) + "\n").encode('utf-8')
+        try:
+            with self.lock:
+                self.socket.sendall(data)
+        except OSError as e:
+            self.logger.error(f"Could not send {event['type']} to the supervisor: {e}")
+
+    def read(self):
+        try:
+            with self.socket.makefile("rb") as lines:
+                for line in lines:
+                    self.handle(json.loads(line))
+        except (OSError, ValueError) as e:
+            self.logger.error(f"IPC channel closed: {e}")
+
+    def handle(self, event):
+        if event["type"] == "notification":
+            self.server.notify_clients(event["message"])
+        elif event["type"] == "session_issued":
+            self.server.sessions.add(event["id"], event["expires"])
+        elif event["type"] == "session_removed":
+            self.server.sessions.discard(event["id"])
+
+
+class Worker:
+    def __init__(self, index, channel_socket):
+        self.index = index
+        self.channel = channel_socket # The supervisor's end
+        self.started = time.monotonic()
+        self.buffer = b"" # Received from the worker, up to the last complete line
+
+
+class Supervisor:
+    def __init__(self, ADDRESS, PORT, processes, engine="threads", server_options=None):
+        self.ADDRESS = ADDRESS
+        self.PORT = PORT
+        self.processes = processes
+        self.engine = engine
+        self.server_options = server_options or {}
+        self.logger = ServerLogger.server_logger
+        self.workers = {} # pid -> Worker
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+        self.stop_deadline = None
+        self.restarts = 0
+
+    def run(self):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("The multi-process mode needs os.fork (Linux or macOS)")
+
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((self.ADDRESS, self.PORT))
+        self.listen_socket.listen(128)
+        # All the workers are woken up for a new client, the ones that lose the race must not block in accept
+        self.listen_socket.setblocking(False)
+
+        self.crypto = Encryption.CryptoServices()
+        self.ticket_key = os.urandom(32)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.logger.info(f"Supervisor listening on {self.ADDRESS}:{self.PORT}, starting {self.processes} workers")
+        for index in range(self.processes):
+            self.spawn(index)
+
+        # One thread only, so forking a new worker never copies a thread that is in the middle of something
+        while self.workers:
+            for key, _ in self.selector.select(timeout=0.5):
+                self.forward(key.data)
+            self.reap()
+            if self.stopping and time.monotonic() > self.stop_deadline:
+                self.kill_remaining()
+
+        self.listen_socket.close()
+        self.logger.info(f"Supervisor stopped, {self.restarts} workers were restarted")
+
+    def spawn(self, index):
+        supervisor_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            supervisor_end.close()
+            exit_code = 0
+            try:
+                self.run_worker(index, worker_end)
+            except Exception as e:
+                self.logger.critical(f"Worker {index} crashed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        worker_end.close()
+        self.workers[pid] = Worker(index, supervisor_end)
+        self.selector.register(supervisor_end, selectors.EVENT_READ, pid)
+        self.logger.info(f"Worker {index} started (pid {pid})")
+
+    def run_worker(self, index, channel_socket):
+        # The other workers' channels and the supervisor's selector came with the fork, they are not this worker's
+        for worker in self.workers.values():
+            worker.channel.close()
+        self.selector.close()
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+        if self.engine == "asyncio":
+            from AsyncServer import AsyncServer
+            server = AsyncServer(self.ADDRESS, self.PORT, listen_socket=self.listen_socket, crypto=self.crypto,
+                                 ticket_key=self.ticket_key, **self.server_options)
+        else:
+            from Server import Server
+            server = Server(self.ADDRESS, self.PORT, listen_socket=self.listen_socket, crypto=self.crypto,
+                            ticket_key=self.ticket_key, **self.server_options)
+
+        WorkerChannel(channel_socket, server).attach()
+        server.start_listen_thread()
+        self.logger.info(f"Worker {index} (pid {os.getpid()}) serving")
+
+        while not stop.wait(timeout=1.0):
+            pass
+        self.logger.info(f"Worker {index} shutting down")
+        server.quit_server()
+
+    def forward(self, pid):
+        """Passes what a worker sent on to all the other workers"""
+        worker = self.workers.get(pid)
+        if worker is None:
+            return
+        try:
+            data = worker.channel.recv(65536)
+        except OSError:
+            data = b""
+        if not data:
+            # The worker is exiting, reap() takes care of it
+            self.selector.unregister(worker.channel)
+            return
+
+        worker.buffer += data
+        lines, _, worker.buffer = worker.buffer.rpartition(b"\n")
+        if not lines:
+            return
+        lines += b"\n"
+        for other_pid, other in list(self.workers.items()):
+            if other_pid == pid:
+                continue
+            try:
+                other.channel.sendall(lines)
+            except OSError as e:
+                self.logger.error(f"Could not forward to worker {other.index}: {e}")
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            try:
+                self.selector.unregister(worker.channel)
+            except (KeyError, ValueError):
+                pass
+            worker.channel.close()
+
+            if self.stopping:
+                self.logger.info(f"Worker {worker.index} (pid {pid}) stopped")
+                continue
+
+            self.logger.warning(f"Worker {worker.index} (pid {pid}) died with status {status}, restarting it")
+            if time.monotonic() - worker.started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY) # Do not restart a worker that crashes on start as fast as the cpu allows
+            self.restarts += 1
+            self.spawn(worker.index)
+
+    def stop(self, signum, frame):
+        """Signal handler of the supervisor. Passes the signal on as SIGTERM, the workers shut down gracefully"""
+        if self.stopping:
+            return
+        self.logger.info("Supervisor stopping the workers...")
+        self.stopping = True
+        self.stop_deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def kill_remaining(self):
+        for pid, worker in list(self.workers.items()):
+            self.logger.warning(f"Worker {worker.index} (pid {pid}) did not stop in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.stop_deadline = float("inf")